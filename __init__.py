@@ -1,5 +0,0 @@
-# from contoroller import app_controller
-from model import calc_vegindex, preprocessing_images
-from view.home_screen import ApplicationView
-import main
-from controller.app_controller import ApplicationController
\ No newline at end of file
@@ -0,0 +1,93 @@
+"""GUIを使わずにフォルダ内の全フレームの植生指数を書き出すコマンド
+
+例:
+    python batch_cli.py test/frames --panel test/frames/panel.tif --roi 200 200 300 300 \\
+        --indices ndvi gndvi --formats npy png --out output
+"""
+import os
+import sys
+import argparse
+from PIL import Image
+from model.batch_pipeline import BatchPipeline, OUTPUT_FORMATS, DEFAULT_QUEUE_SIZE, list_frames
+from model.multispectral_img_model import measure_panel_brightness, reflectance_gains
+from model.vegindex_engine import DEFAULT_FORMULAS
+from model.sensor_profile import DEFAULT_PROFILE, PROFILES, get_profile, load_profiles
+from model.index_codec import STORAGE_FORMATS
+from model.band_registration import load_registration
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='植生指数の一括書き出し（GUIなし）')
+    parser.add_argument('folder', help='フレーム画像のフォルダ')
+    parser.add_argument('--out', required=True, help='出力フォルダ')
+    parser.add_argument('--panel', help='標準化パネル画像（指定時は反射率に変換）')
+    parser.add_argument('--roi', type=float, nargs=4, metavar=('X0', 'Y0', 'X1', 'Y1'),
+                        help='パネル画像上の矩形範囲')
+    parser.add_argument('--indices', nargs='+', default=['ndvi', 'gndvi', 'ndre', 'cigreen'],
+                        choices=sorted(DEFAULT_FORMULAS))
+    parser.add_argument('--formats', nargs='+', default=['npy'], choices=OUTPUT_FORMATS)
+    parser.add_argument('--queue-size', type=int, default=DEFAULT_QUEUE_SIZE,
+                        help='ステージ間キューの上限（メモリ上のフレーム数）')
+    parser.add_argument('--profile', default=DEFAULT_PROFILE.name,
+                        help=f"カメラのバンド配置（{', '.join(sorted(PROFILES))} または --profile-file で読み込んだ名前）")
+    parser.add_argument('--profile-file', action='append', default=[], metavar='JSON',
+                        help='バンド配置のプロファイルをJSONファイルから読み込む（複数指定可）')
+    parser.add_argument('--tile-rows', type=int,
+                        help='指定した行数のタイル単位で処理（大きなフレームの作業メモリを抑える）')
+    parser.add_argument('--register', choices=['flight', 'camera'],
+                        help='バンドの位置合わせ（ずれはフライトまたはカメラごとに1回だけ推定して保存）')
+    parser.add_argument('--storage', default='float32', choices=STORAGE_FORMATS,
+                        help='植生指数の保持・書き出し形式（int16はscale/offset付きの符号、範囲は表示範囲に切り詰め）')
+    parser.add_argument('--stats', metavar='CSV',
+                        help='フレームごと・全体の統計量をCSVに保存（同じ名前の.jsonにヒストグラムも保存）')
+    args = parser.parse_args(argv)
+    if args.panel and not args.roi:
+        parser.error('--panel を指定した場合は --roi も指定してください')
+    try:
+        for path in args.profile_file:
+            load_profiles(path)
+        get_profile(args.profile)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    profile = get_profile(args.profile)
+
+    # 標準化パネルから反射率変換の係数を算出
+    gains = None
+    if args.panel:
+        with Image.open(args.panel) as panel_img:
+            panel_brightness = measure_panel_brightness(panel_img, args.roi, profile)
+        gains = reflectance_gains(panel_brightness)
+        print("panel brightness: " + ", ".join(f"{value:.2f}" for value in panel_brightness))
+
+    paths = list_frames(args.folder, exclude=[args.panel])
+    if not paths:
+        print(f"Error: フレーム画像が見つかりません: {args.folder}", file=sys.stderr)
+        return 1
+
+    registration = None
+    if args.register:
+        registration = load_registration(paths, profile, args.register)
+        print("band shifts (dy, dx): " + ", ".join(f"({dy:.2f}, {dx:.2f})" for dy, dx in registration.shifts))
+
+    pipeline = BatchPipeline(paths, args.out, args.indices, args.formats, gains, args.queue_size,
+                             profile=profile, tile_rows=args.tile_rows, registration=registration,
+                             storage=args.storage)
+    result = pipeline.run()
+    print(f"{result['frames']} frames in {result['seconds']:.2f} s ({result['fps']:.1f} frames/s)")
+    if args.stats:
+        pipeline.statistics.export_csv(args.stats)
+        pipeline.statistics.export_json(os.path.splitext(args.stats)[0] + '.json',
+                                        frame_names=[os.path.basename(path) for path in paths])
+        for name in args.indices:
+            stats = pipeline.statistics.flight_stats(name).summary()
+            print(f"{name}: mean {stats['mean']:.3f} median {stats['p50']:.3f} "
+                  f"p5-p95 {stats['p5']:.3f} - {stats['p95']:.3f}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
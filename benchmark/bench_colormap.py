@@ -0,0 +1,62 @@
+"""スライダー操作時のカラーマップ描画時間の計測
+
+使い方:
+    python -m benchmark.bench_colormap [--folder test/frames] [--passes 3]
+
+スライダーで全フレームを順に送る操作を想定し、1フレームあたりの描画時間を比較する。
+  - matplotlib: Visualizer.make_colormap + Figureの再描画（従来の表示経路、Tkへの転送は含まない）
+  - LUT: Visualizer.render_colormap（ルックアップテーブルで画像化、カラーバーは変更時のみ）
+植生指数は事前に計算してキャッシュに載せ、描画のみの時間を計測する。
+"""
+import os
+import time
+import argparse
+from PIL import Image
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from model.datacube_store import DatacubeStore
+from model.multispectral_img_model import MultispectralImgModel, Visualizer, VEGINDEX_NAMES
+from model.batch_pipeline import list_frames
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def scrub(render, frames, passes):
+    """全フレームをpasses回送ったときの1フレームあたりの時間（ミリ秒）"""
+    start = time.perf_counter()
+    for _ in range(passes):
+        for frame in range(frames):
+            render(frame)
+    return (time.perf_counter() - start) * 1000 / (frames * passes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='カラーマップ描画時間の計測')
+    parser.add_argument('--folder', default=os.path.join(ROOT_DIR, 'test', 'frames'))
+    parser.add_argument('--passes', type=int, default=3)
+    args = parser.parse_args()
+
+    paths = list_frames(args.folder, exclude=[os.path.join(args.folder, 'panel.tif')])
+    model = MultispectralImgModel(datacube_store=DatacubeStore.from_images([Image.open(p) for p in paths]))
+    visualizer = Visualizer(model)
+    visualizer.cmap_init_figure()
+    canvas = FigureCanvasAgg(visualizer.cmap_fig)
+    frames = model.get_datacube_len()
+
+    for vegindex_num, index_name in VEGINDEX_NAMES.items():
+        list(model.index_list(index_name))   # 計算済みにしておく
+
+        def render_matplotlib(frame):
+            visualizer.make_colormap(frame, vegindex_num)
+            canvas.draw()
+
+        def render_lut(frame):
+            visualizer.render_colormap(frame, vegindex_num)
+
+        slow = scrub(render_matplotlib, frames, args.passes)
+        fast = scrub(render_lut, frames, args.passes)
+        print(f"{index_name:8s} matplotlib: {slow:7.2f} ms/frame ({1000 / slow:6.1f} fps)"
+              f"  LUT: {fast:6.2f} ms/frame ({1000 / fast:6.1f} fps)  x{slow / fast:.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""画像読み込み（デコード・バンド分割・datacube書き込み）のスループット計測
+
+使い方:
+    python -m benchmark.bench_loader [--workers N] [--repeat R] [--processes]
+
+test/frames と test/kouyou_images について、ワーカー1とNでの frames/s を比較する。
+キャッシュの影響を除くため、毎回一時ディレクトリにメモリマップファイルを作成する。
+"""
+import os
+import time
+import shutil
+import tempfile
+import argparse
+from model.datacube_store import DatacubeStore
+from model.image_loader import DEFAULT_WORKERS
+from model.batch_pipeline import list_frames
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATASETS = ['test/frames', 'test/kouyou_images']
+
+
+def measure(paths, workers, repeat, use_processes):
+    """repeat回読み込み、最速の所要時間（秒）を返す"""
+    best = float('inf')
+    for _ in range(repeat):
+        cache_dir = tempfile.mkdtemp(prefix='ms-bench-')
+        try:
+            start = time.perf_counter()
+            DatacubeStore.open(paths, cache_dir=cache_dir, workers=workers, use_processes=use_processes)
+            best = min(best, time.perf_counter() - start)
+        finally:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='画像読み込みのスループット計測')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--processes', action='store_true', help='スレッドではなくプロセスで並列化')
+    args = parser.parse_args()
+
+    for dataset in DATASETS:
+        folder = os.path.join(ROOT_DIR, dataset)
+        paths = list_frames(folder, exclude=[os.path.join(folder, 'panel.tif')])
+        if not paths:
+            continue
+        single = measure(paths, 1, args.repeat, False)
+        multi = measure(paths, args.workers, args.repeat, args.processes)
+        print(f"{dataset}: {len(paths)} frames")
+        print(f"  workers=1: {len(paths) / single:8.1f} frames/s ({single * 1000:.1f} ms)")
+        print(f"  workers={args.workers}: {len(paths) / multi:8.1f} frames/s ({multi * 1000:.1f} ms)"
+              f"  x{single / multi:.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+"""モザイク（フライト全体のオーバービュー）の作成時間と位置の推定精度の確認
+
+使い方:
+    python -m benchmark.bench_mosaic [--folder test/kouyou_images] [--index ndvi] [--step 60] [--repeat 3] [--out result.json]
+
+test のフォルダのフレームは互いに重ならないため、フォルダの4フレームを並べて2倍に拡大した場面から
+既知の位置で切り出したフレーム（step画素ずつ進み、行の端で折り返す往復の経路）を作って使う。
+1フレームあたりの 移動量の推定（縮小したNIRの位相限定相関）/ 植生指数の計算と加算 / 全体 の時間と、
+経路の半分を加算した後に残りを追加した場合（増分）、メモリ上限を小さくしてタイルを退避した場合の時間、
+推定した位置と既知の位置の最大誤差（画素）、クリック位置から正しいフレームを引けた割合を示す。
+"""
+import os
+import json
+import time
+import argparse
+import numpy as np
+from model.datacube_store import DatacubeStore
+from model.multispectral_img_model import MultispectralImgModel
+from model.batch_pipeline import list_frames
+from model.tiled_processing import downsample
+from model import mosaic
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# 場面に使うフォルダのフレームと経路の行数・行の間隔（フレームの高さに対する割合）
+SCENE_FRAMES = (3, 5, 1, 7)
+PATH_ROWS = 4
+ROW_SPACING = 0.6
+
+
+def best_time(func, repeat):
+    """repeat回実行した最速の所要時間（秒）と最後の結果"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def survey_frames(raw, step):
+    """フレームを2x2に並べて2倍に拡大した場面を、往復の経路で切り出したフレームとその位置 (y, x)"""
+    tiles = [raw[i % len(raw)] for i in SCENE_FRAMES]
+    scene = np.concatenate([np.concatenate(tiles[:2], 1), np.concatenate(tiles[2:], 1)], 0)
+    scene = scene.repeat(2, 0).repeat(2, 1)
+    height, width = raw.shape[1:3]
+    row_step = int(height * ROW_SPACING)
+    positions = []
+    for row in range(PATH_ROWS):
+        xs = list(range(0, scene.shape[1] - width + 1, step))
+        positions += [(row * row_step, x) for x in (xs if row % 2 == 0 else xs[::-1])]
+    positions = [(y, x) for y, x in positions if y + height <= scene.shape[0]]
+    frames = np.stack([scene[y:y + height, x:x + width] for y, x in positions])
+    return frames, np.array(positions, dtype=np.float64)
+
+
+def build(frames, index, memory_budget=mosaic.DEFAULT_MEMORY_BUDGET, split=None):
+    """モザイクを作成（splitを指定すると先頭splitフレームを加算した後に残りを追加）"""
+    store = DatacubeStore(frames[:split] if split else frames)
+    model = MultispectralImgModel(datacube_store=store)
+    builder = mosaic.MosaicBuilder(model, index, memory_budget=memory_budget)
+    builder.update()
+    if split:
+        store.raw = frames
+        builder.update()
+    builder.render_overview()
+    return builder
+
+
+def main():
+    parser = argparse.ArgumentParser(description='モザイクの作成時間と位置の推定精度')
+    parser.add_argument('--folder', default=os.path.join(ROOT_DIR, 'test', 'kouyou_images'))
+    parser.add_argument('--index', default='ndvi')
+    parser.add_argument('--step', type=int, default=60, help='フレーム間の移動量（画素）')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--out', help='結果を保存するJSONファイル')
+    args = parser.parse_args()
+
+    raw = DatacubeStore.open(list_frames(args.folder, exclude=[os.path.join(args.folder, 'panel.tif')])).raw
+    frames, truth = survey_frames(np.asarray(raw), args.step)
+    count = len(frames)
+    builder = mosaic.MosaicBuilder(MultispectralImgModel(datacube_store=DatacubeStore(frames)), args.index)
+    nir = frames[..., 3]
+
+    def estimate():
+        previous = None
+        for band in nir:
+            current = downsample(band, builder.estimate_factor)
+            if previous is not None:
+                mosaic.estimate_step(previous, current)
+            previous = current
+    estimate_s, _ = best_time(estimate, args.repeat)
+    total_s, builder = best_time(lambda: build(frames, args.index), args.repeat)
+    incremental_s, _ = best_time(lambda: build(frames, args.index, split=count // 2), args.repeat)
+    spill_budget = 8 * mosaic.TILE_SIZE ** 2 * 8
+    spill_s, spilled = best_time(lambda: build(frames, args.index, memory_budget=spill_budget), args.repeat)
+
+    error = np.abs(builder.positions - (truth - truth[0])).max()
+    height, width = frames.shape[1:3]
+    hits = sum(builder.frame_at(y + height / 2, x + width / 2) == frame
+               for frame, (y, x) in enumerate(truth - truth[0]))
+    image, placement = builder.render_overview()
+    result = {'frames': count, 'band_shape': [height, width], 'index': args.index, 'step': args.step,
+              'scale': builder.scale, 'estimate_factor': builder.estimate_factor,
+              'estimate_ms_per_frame': estimate_s * 1000 / count,
+              'mosaic_ms_per_frame': total_s * 1000 / count,
+              'incremental_ms_per_frame': incremental_s * 1000 / count,
+              'spill_ms_per_frame': spill_s * 1000 / count,
+              'spilled_tiles': len(spilled.canvas._spilled),
+              'max_position_error_px': float(error),
+              'unreliable_frames': int((~builder.reliable).sum()),
+              'click_hits': int(hits),
+              'overview_size': list(image.size)}
+    print(f"{count} frames {height}x{width}, step {args.step} px, canvas 1/{builder.scale}, "
+          f"estimate on 1/{builder.estimate_factor} NIR")
+    print(f"estimate (phase corr.)  {result['estimate_ms_per_frame']:8.2f} ms/frame")
+    print(f"whole mosaic            {result['mosaic_ms_per_frame']:8.2f} ms/frame")
+    print(f"half + incremental add  {result['incremental_ms_per_frame']:8.2f} ms/frame")
+    print(f"spilled tiles ({result['spilled_tiles']:3d})     {result['spill_ms_per_frame']:8.2f} ms/frame")
+    print(f"max position error {error:.2f} px, {result['unreliable_frames']} unreliable steps, "
+          f"clicks {hits}/{count}, overview {image.size[0]}x{image.size[1]}")
+    spilled.close()
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
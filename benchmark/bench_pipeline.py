@@ -0,0 +1,223 @@
+"""モデルの処理段階ごとの計測（時間・ピークRSS・メモリ確保量）
+
+使い方:
+    python -m benchmark.bench_pipeline [--folder test/frames] [--repeat 3] [--out result.json]
+    python -m benchmark.bench_pipeline --synthetic 200 --size 512 512 --out result.json
+    python -m benchmark.bench_pipeline --synthetic 200 --compare old.json
+
+段階: デコード → 8bit変換・バンド分割 → datacube作成 → 植生指数4種 → 反射率変換 → カラーマップ描画
+各段階は全フレームを処理する時間を計測し、repeat回のうち最速の値を採用する。
+メモリ確保量はtracemallocを有効にした別の1回で計測する（計測の負荷が時間に影響しないように）。
+結果はJSONで保存でき、--compareで以前の結果（別のコミットなど）と比較できる。
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import argparse
+import subprocess
+import tracemalloc
+import numpy as np
+from PIL import Image
+from model.image_loader import split_bands
+from model.datacube_store import DatacubeStore
+from model.multispectral_img_model import MultispectralImgModel, VEGINDEX_NAMES, COLORMAP_SETTINGS
+from model.colormap_lut import get_lut
+from model.batch_pipeline import list_frames
+
+try:
+    import resource
+except ImportError:     # Windows
+    resource = None
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# 反射率変換に使うパネルの放射輝度（計測用の固定値）
+PANEL_BRIGHTNESS = [120.0, 110.0, 130.0, 150.0]
+
+
+def peak_rss_mb():
+    """プロセスのピークRSS（MB、取得できない環境ではNone）"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linuxはキロバイト、macOSはバイト単位
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def synthetic_frames(folder, count, band_shape, seed=0):
+    """バンドごとに明るさの異なる縦4バンドの8bit TIFFをcount枚作成"""
+    rng = np.random.default_rng(seed)
+    height, width = band_shape
+    levels = np.array([60, 50, 90, 140])[:, np.newaxis, np.newaxis]
+    paths = []
+    for i in range(count):
+        bands = np.clip(levels + rng.normal(0, 25, (4, height, width)), 0, 255).astype(np.uint8)
+        path = os.path.join(folder, f"synthetic_{i:05d}.tif")
+        Image.fromarray(bands.reshape(4 * height, width)).save(path)
+        paths.append(path)
+    return paths
+
+
+def pipeline_stages(paths):
+    """(段階名, 関数) のリストを返す（関数は前の段階の結果をstateで受け取る）"""
+    state = {}
+
+    def decode():
+        imgs = []
+        for path in paths:
+            img = Image.open(path)
+            img.load()
+            imgs.append(img)
+        state['imgs'] = imgs
+
+    def convert_to_8bit():
+        state['cubes'] = [split_bands(img) for img in state.pop('imgs')]
+
+    def create_datacube():
+        model = MultispectralImgModel(datacube_store=DatacubeStore(np.stack(state.pop('cubes'))))
+        out = np.empty(model.datacube_store.frame_shape, dtype=np.float32)
+        for frame in range(model.get_datacube_len()):
+            model.datacube_list.get(frame, out=out)
+        state['model'] = model
+
+    def index_stage(index_name):
+        def compute():
+            model = state['model']
+            # キャッシュを通さずに計算時間のみ計測（結果はカラーマップ描画で使用）
+            state[index_name] = [model.compute_index(index_name, frame) for frame in range(model.get_datacube_len())]
+        return compute
+
+    def convert_to_reflectance():
+        model = state['model']
+        model.panel_brightness = PANEL_BRIGHTNESS
+        model.convert_to_reflectance()
+        out = np.empty(model.datacube_store.frame_shape, dtype=np.float32)
+        for frame in range(model.get_datacube_len()):
+            model.datacube_list.get(frame, out=out)
+
+    def colormap():
+        for index_name in VEGINDEX_NAMES.values():
+            lut = get_lut(*COLORMAP_SETTINGS[index_name][:3])
+            for values in state[index_name]:
+                lut.to_image(values)
+
+    stages = [('decode', decode), ('convert_to_8bit', convert_to_8bit), ('create_datacube', create_datacube)]
+    stages += [(index_name, index_stage(index_name)) for index_name in VEGINDEX_NAMES.values()]
+    stages += [('convert_to_reflectance', convert_to_reflectance), ('colormap', colormap)]
+    return stages
+
+
+def measure_times(paths, repeat):
+    """段階ごとの最速の所要時間（秒）とピークRSS"""
+    results = {}
+    for _ in range(repeat):
+        for name, stage in pipeline_stages(paths):
+            start = time.perf_counter()
+            stage()
+            seconds = time.perf_counter() - start
+            result = results.setdefault(name, {'seconds': seconds})
+            result['seconds'] = min(result['seconds'], seconds)
+            result['peak_rss_mb'] = peak_rss_mb()
+    return results
+
+
+def measure_allocations(paths):
+    """段階ごとのメモリ確保量（ピーク・段階後に残った量、バイト）"""
+    results = {}
+    tracemalloc.start()
+    try:
+        for name, stage in pipeline_stages(paths):
+            before, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            stage()
+            after, peak = tracemalloc.get_traced_memory()
+            results[name] = {'alloc_peak_bytes': peak - before, 'alloc_retained_bytes': after - before}
+    finally:
+        tracemalloc.stop()
+    return results
+
+
+def run(paths, repeat, allocations=True):
+    frames = len(paths)
+    stages = measure_times(paths, repeat)
+    if allocations:
+        for name, result in measure_allocations(paths).items():
+            stages[name].update(result)
+    for result in stages.values():
+        result['ms_per_frame'] = result['seconds'] * 1000 / frames
+        result['fps'] = frames / result['seconds'] if result['seconds'] else None
+        for key in ('alloc_peak_bytes', 'alloc_retained_bytes'):
+            if key in result:
+                result[f"{key}_per_frame"] = result[key] / frames
+    total = sum(result['seconds'] for result in stages.values())
+    with Image.open(paths[0]) as img:
+        size = img.size
+    return {'meta': {'commit': git_commit(), 'python': platform.python_version(), 'numpy': np.__version__,
+                     'platform': platform.platform(), 'frames': frames, 'image_size': list(size), 'repeat': repeat},
+            'stages': stages,
+            'total': {'seconds': total, 'ms_per_frame': total * 1000 / frames, 'peak_rss_mb': peak_rss_mb()}}
+
+
+def print_report(report, baseline=None):
+    print(f"{report['meta']['frames']} frames {report['meta']['image_size']} (commit {report['meta']['commit']})")
+    rows = list(report['stages'].items()) + [('total', report['total'])]
+    for name, result in rows:
+        line = f"{name:24s} {result['ms_per_frame']:9.3f} ms/frame"
+        if 'alloc_peak_bytes_per_frame' in result:
+            line += f"  alloc peak {result['alloc_peak_bytes_per_frame'] / 1024 ** 2:8.2f} MB/frame"
+        if result.get('peak_rss_mb') is not None:
+            line += f"  peak RSS {result['peak_rss_mb']:8.1f} MB"
+        if baseline:
+            old = baseline['total'] if name == 'total' else baseline['stages'].get(name)
+            if old:
+                line += f"  x{old['ms_per_frame'] / result['ms_per_frame']:.2f} vs {baseline['meta']['commit']}"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='モデルの処理段階ごとの計測')
+    parser.add_argument('--folder', default=os.path.join(ROOT_DIR, 'test', 'frames'))
+    parser.add_argument('--synthetic', type=int, metavar='N', help='合成フレームN枚で計測（--folderは使わない）')
+    parser.add_argument('--size', type=int, nargs=2, default=(512, 512), metavar=('H', 'W'),
+                        help='合成フレームの1バンドの大きさ')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--no-alloc', action='store_true', help='メモリ確保量を計測しない')
+    parser.add_argument('--out', help='結果を保存するJSONファイル')
+    parser.add_argument('--compare', help='比較する以前の結果のJSONファイル')
+    args = parser.parse_args()
+
+    synthetic_dir = None
+    try:
+        if args.synthetic:
+            synthetic_dir = tempfile.mkdtemp(prefix='ms-bench-')
+            paths = synthetic_frames(synthetic_dir, args.synthetic, args.size)
+        else:
+            paths = list_frames(args.folder, exclude=[os.path.join(args.folder, 'panel.tif')])
+        report = run(paths, args.repeat, allocations=not args.no_alloc)
+    finally:
+        if synthetic_dir:
+            shutil.rmtree(synthetic_dir, ignore_errors=True)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
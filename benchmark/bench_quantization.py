@@ -0,0 +1,99 @@
+"""植生指数の量子化（float16 / int16）によるメモリ削減量・誤差・表示の一致の確認
+
+使い方:
+    python -m benchmark.bench_quantization [--folder test/frames] [--out result.json]
+
+フォルダ内の全フレームの植生指数をfloat32で計算し、保持形式ごとに
+バイト数・削減率・最大/RMS誤差（保持範囲内の値）・範囲外で切り詰めた画素数と、
+カラーマップの色がfloat32から作った色と異なる画素の割合、量子化とカラーマップ変換の時間を示す。
+"""
+import os
+import json
+import time
+import argparse
+import numpy as np
+from PIL import Image
+from model.image_loader import split_bands
+from model.vegindex_engine import VegIndexEngine
+from model.multispectral_img_model import VEGINDEX_NAMES, COLORMAP_SETTINGS
+from model.colormap_lut import get_lut
+from model.index_codec import QuantizedIndex, make_codec, quantization_report
+from model.batch_pipeline import list_frames
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STORAGES = ('float16', 'int16')
+
+
+def measure(frames, index_name, storage):
+    """1つの指数・保持形式について全フレームを集計"""
+    cmap, vmin, vmax, _ = COLORMAP_SETTINGS[index_name]
+    codec = make_codec(storage, vmin, vmax)
+    lut = get_lut(cmap, vmin, vmax)
+    result = {'float32_bytes': 0, 'bytes': 0, 'max_abs_error': 0.0, 'sq_error': 0.0, 'pixels': 0, 'clipped': 0,
+              'color_mismatch': 0, 'encode_s': 0.0, 'render_float32_s': 0.0, 'render_quantized_s': 0.0}
+    for values in frames:
+        report = quantization_report(values, codec)
+        for key in ('float32_bytes', 'bytes', 'clipped'):
+            result[key] += report[key]
+        result['max_abs_error'] = max(result['max_abs_error'], report['max_abs_error'])
+        result['sq_error'] += report['rms_error'] ** 2 * values.size
+        result['pixels'] += values.size
+
+        start = time.perf_counter()
+        quantized = QuantizedIndex.encode(values, codec)
+        result['encode_s'] += time.perf_counter() - start
+        start = time.perf_counter()
+        reference = lut.apply(values)
+        result['render_float32_s'] += time.perf_counter() - start
+        start = time.perf_counter()
+        rendered = lut.apply(quantized)
+        result['render_quantized_s'] += time.perf_counter() - start
+        result['color_mismatch'] += int(np.count_nonzero((rendered != reference).any(axis=-1)))
+
+    frame_count = len(frames)
+    return {'storage': storage,
+            'float32_bytes': result['float32_bytes'],
+            'bytes': result['bytes'],
+            'saving': 1 - result['bytes'] / result['float32_bytes'],
+            'max_abs_error': result['max_abs_error'],
+            'rms_error': float(np.sqrt(result['sq_error'] / result['pixels'])),
+            'clipped_pixels': result['clipped'],
+            'color_mismatch_ratio': result['color_mismatch'] / result['pixels'],
+            'encode_ms_per_frame': result['encode_s'] * 1000 / frame_count,
+            'render_float32_ms_per_frame': result['render_float32_s'] * 1000 / frame_count,
+            'render_quantized_ms_per_frame': result['render_quantized_s'] * 1000 / frame_count}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='植生指数の量子化の評価')
+    parser.add_argument('--folder', default=os.path.join(ROOT_DIR, 'test', 'frames'))
+    parser.add_argument('--out', help='結果を保存するJSONファイル')
+    args = parser.parse_args()
+
+    paths = list_frames(args.folder, exclude=[os.path.join(args.folder, 'panel.tif')])
+    cubes = []
+    for path in paths:
+        with Image.open(path) as img:
+            cubes.append(split_bands(img))
+    names = list(VEGINDEX_NAMES.values())
+    with np.errstate(divide='ignore', invalid='ignore'):
+        indices = VegIndexEngine().compute(np.stack(cubes), names)
+
+    report = {}
+    print(f"{len(paths)} frames {cubes[0].shape[:2]}")
+    for name in names:
+        report[name] = [measure(indices[name], name, storage) for storage in STORAGES]
+        for result in report[name]:
+            print(f"{name:8s} {result['storage']:8s} {result['bytes'] / 1024 ** 2:7.1f} MB "
+                  f"(-{result['saving']:.0%} of {result['float32_bytes'] / 1024 ** 2:.1f} MB)  "
+                  f"max err {result['max_abs_error']:.2e}  rms {result['rms_error']:.2e}  "
+                  f"clipped {result['clipped_pixels']:7d}  color mismatch {result['color_mismatch_ratio']:.3%}  "
+                  f"render {result['render_float32_ms_per_frame']:.2f} -> "
+                  f"{result['render_quantized_ms_per_frame']:.2f} ms/frame")
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
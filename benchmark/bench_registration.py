@@ -0,0 +1,90 @@
+"""バンドの位置合わせのコスト計測（デコードとの比較）と推定精度の確認
+
+使い方:
+    python -m benchmark.bench_registration [--folder test/frames] [--batch 8] [--repeat 3] [--out result.json]
+
+1フレームあたりの デコード・バンド分割 / 位置合わせ（batchフレームずつまとめて補正）の時間を比較する。
+ずれの推定はフライトごとに1回なので、推定時間はフレーム数で割った値も示す。
+精度は既知のずれを加えたフレームから推定し直し、加えたずれとの最大誤差（画素）で示す。
+"""
+import os
+import json
+import time
+import argparse
+import numpy as np
+from PIL import Image
+from model.image_loader import split_bands
+from model.band_registration import BandRegistration, sample_frames
+from model.batch_pipeline import list_frames
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# 精度の確認に加えるずれ (dy, dx)（最後のNIRが基準）
+TEST_SHIFTS = [[3.4, -2.25], [-1.5, 0.75], [0.6, 5.2], [0.0, 0.0]]
+
+
+def best_time(func, repeat):
+    """repeat回実行した最速の所要時間（秒）と最後の結果"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def decode(paths):
+    frames = []
+    for path in paths:
+        with Image.open(path) as img:
+            frames.append(split_bands(img))
+    return np.stack(frames)
+
+
+def register(frames, registration, batch):
+    out = np.empty_like(frames)
+    for start in range(0, len(frames), batch):
+        registration.apply(frames[start:start + batch], out[start:start + batch])
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description='バンドの位置合わせのコスト計測')
+    parser.add_argument('--folder', default=os.path.join(ROOT_DIR, 'test', 'frames'))
+    parser.add_argument('--batch', type=int, default=8, help='まとめて補正するフレーム数')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--out', help='結果を保存するJSONファイル')
+    args = parser.parse_args()
+
+    paths = list_frames(args.folder, exclude=[os.path.join(args.folder, 'panel.tif')])
+    count = len(paths)
+    decode_s, frames = best_time(lambda: decode(paths), args.repeat)
+    estimate_s, registration = best_time(lambda: BandRegistration.estimate(frames[sample_frames(count)]),
+                                         args.repeat)
+    warp_s, _ = best_time(lambda: register(frames, registration, args.batch), args.repeat)
+
+    # 既知のずれを加えて推定し直し（元のフレームのずれとの差で比較）
+    shifted = BandRegistration(-np.asarray(TEST_SHIFTS)).apply(frames)
+    recovered = BandRegistration.estimate(shifted[sample_frames(count)]).shifts - registration.shifts
+    error = float(np.abs(recovered - np.asarray(TEST_SHIFTS)).max())
+
+    result = {'frames': count, 'band_shape': list(frames.shape[1:3]), 'batch': args.batch,
+              'decode_ms_per_frame': decode_s * 1000 / count,
+              'register_ms_per_frame': warp_s * 1000 / count,
+              'estimate_ms': estimate_s * 1000,
+              'estimate_ms_per_frame': estimate_s * 1000 / count,
+              'shifts': registration.shifts.tolist(),
+              'max_error_px': error}
+    print(f"{count} frames {frames.shape[1:3]}, batch {args.batch}")
+    print(f"decode + split     {result['decode_ms_per_frame']:8.2f} ms/frame")
+    print(f"register (warp)    {result['register_ms_per_frame']:8.2f} ms/frame"
+          f"  ({warp_s / decode_s * 100:.0f}% of decode)")
+    print(f"estimate (once)    {result['estimate_ms']:8.2f} ms  ({result['estimate_ms_per_frame']:.2f} ms/frame)")
+    print("band shifts (dy, dx): " + ", ".join(f"({dy:.2f}, {dx:.2f})" for dy, dx in registration.shifts))
+    print(f"max error for known shifts: {error:.3f} px")
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
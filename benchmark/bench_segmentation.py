@@ -0,0 +1,110 @@
+"""植生・土壌の分割（被覆率・株の数）の処理時間をデコードと比較
+
+使い方:
+    python -m benchmark.bench_segmentation [--folder test/frames] [--index ndvi] [--chunk 8] [--repeat 3] [--out result.json]
+
+1フレームあたりの デコード・バンド分割 / 植生指数の計算 / 閾値・マスクの整形 / 連結成分と株の指標 の時間と、
+フォルダ全体を MultispectralImgModel.compute_segmentation で処理した時間と、
+大津の閾値に使う統計量の集計（まだ集計していないフレームのみ、1回だけ必要）の時間を分けて示す。
+連結成分はscipyがあればndimage.label、なければnumpyのランのunion-findで求める。
+"""
+import os
+import json
+import time
+import argparse
+import numpy as np
+from PIL import Image
+from model.image_loader import split_bands
+from model.vegindex_engine import VegIndexEngine
+from model.datacube_store import DatacubeStore
+from model.multispectral_img_model import MultispectralImgModel
+from model.batch_pipeline import list_frames
+from model import segmentation
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def best_time(func, repeat):
+    """repeat回実行した最速の所要時間（秒）と最後の結果"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def decode(paths):
+    frames = []
+    for path in paths:
+        with Image.open(path) as img:
+            frames.append(split_bands(img))
+    return np.stack(frames)
+
+
+def chunked(func, values, chunk):
+    return [func(values[start:start + chunk]) for start in range(0, len(values), chunk)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='植生・土壌の分割の処理時間')
+    parser.add_argument('--folder', default=os.path.join(ROOT_DIR, 'test', 'frames'))
+    parser.add_argument('--index', default='ndvi')
+    parser.add_argument('--chunk', type=int, default=8, help='まとめて処理するフレーム数')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--out', help='結果を保存するJSONファイル')
+    args = parser.parse_args()
+
+    paths = list_frames(args.folder, exclude=[os.path.join(args.folder, 'panel.tif')])
+    count = len(paths)
+    decode_s, frames = best_time(lambda: decode(paths), args.repeat)
+    engine = VegIndexEngine()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        index_s, values = best_time(lambda: engine.compute(frames, [args.index], chunk_size=args.chunk)[args.index],
+                                    args.repeat)
+
+    model = MultispectralImgModel(datacube_store=DatacubeStore(frames, paths))
+    threshold = model.segmentation_threshold(args.index)
+    segmenter = segmentation.Segmenter(threshold)
+    mask_s, masks = best_time(lambda: np.concatenate(chunked(segmenter.masks, values, args.chunk)), args.repeat)
+    if segmentation.ndimage is None:
+        blob_s, _ = best_time(lambda: chunked(segmentation._run_blob_metrics, masks, args.chunk), args.repeat)
+    else:
+        blob_s, _ = best_time(lambda: chunked(lambda m: segmentation.blob_metrics(segmentation.label_components(m)),
+                                              masks, args.chunk), args.repeat)
+
+    def statistics():
+        model.statistics.discard_frames()
+        return model.segmentation_threshold(args.index)
+    otsu_s, _ = best_time(statistics, args.repeat)
+    total_s, metrics = best_time(lambda: model.compute_segmentation(args.index, threshold, chunk_size=args.chunk),
+                                 args.repeat)
+
+    result = {'frames': count, 'band_shape': list(frames.shape[1:3]), 'index': args.index, 'chunk': args.chunk,
+              'labeler': 'numpy' if segmentation.ndimage is None else 'scipy',
+              'threshold': threshold,
+              'decode_ms_per_frame': decode_s * 1000 / count,
+              'index_ms_per_frame': index_s * 1000 / count,
+              'mask_ms_per_frame': mask_s * 1000 / count,
+              'blobs_ms_per_frame': blob_s * 1000 / count,
+              'folder_ms_per_frame': total_s * 1000 / count,
+              'otsu_statistics_ms_per_frame': otsu_s * 1000 / count,
+              'cover': metrics['cover'].tolist(),
+              'blobs': metrics['blobs'].tolist()}
+    print(f"{count} frames {frames.shape[1:3]}, {args.index} threshold (otsu) {threshold:.3f}, "
+          f"labeler {result['labeler']}")
+    print(f"decode + split        {result['decode_ms_per_frame']:8.2f} ms/frame")
+    print(f"index                 {result['index_ms_per_frame']:8.2f} ms/frame")
+    print(f"threshold + morphology{result['mask_ms_per_frame']:8.2f} ms/frame")
+    print(f"components + blobs    {result['blobs_ms_per_frame']:8.2f} ms/frame")
+    print(f"whole folder          {result['folder_ms_per_frame']:8.2f} ms/frame"
+          f"  ({total_s / decode_s * 100:.0f}% of decode)")
+    print(f"otsu statistics       {result['otsu_statistics_ms_per_frame']:8.2f} ms/frame  (once per calibration)")
+    print(f"cover {np.nanmean(metrics['cover']):.1%} (mean), blobs {np.nansum(metrics['blobs']):.0f} (total)")
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""起動時間（最初のウィンドウが表示されるまで）の計測と予算の確認
+
+使い方:
+    python -m benchmark.bench_startup [--budget-ms 1500] [--repeat 3]
+
+子プロセスでコントローラを作成し、ウィンドウを1度描画するまでの時間（インタプリタの起動を含む）を計測する。
+最速の時間が予算を超えた場合、または起動時に重いモジュール（matplotlib, numpyなど）を読み込んでいた場合は
+終了コード1を返す（リポジトリにテストがないため、変更前の確認にはこのスクリプトを使う）。
+画面のない環境ではウィンドウを作らず、インポートまでの時間のみ計測する。
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# 最初のウィンドウまでに読み込まないモジュール（前処理開始やカラーマップの初回使用時に読み込む）
+DEFERRED_MODULES = ['numpy', 'matplotlib', 'model.multispectral_img_model', 'model.datacube_store',
+                    'model.colormap_lut']
+DEFAULT_BUDGET_MS = 1500
+
+# 子プロセスで実行するコード（結果をJSONで出力）
+CHILD_SCRIPT = """
+import sys, json, time
+start = time.perf_counter()
+result = {'error': None, 'window_ms': None}
+try:
+    from controller.app_controller import ApplicationController
+    result['import_ms'] = (time.perf_counter() - start) * 1000
+    controller = ApplicationController()
+    controller.view.update()
+    result['window_ms'] = (time.perf_counter() - start) * 1000
+    controller.view.destroy()
+except Exception as e:
+    result['error'] = f"{type(e).__name__}: {e}"
+result['loaded'] = [name for name in %r if name in sys.modules]
+print(json.dumps(result))
+"""
+
+
+def measure_once():
+    """子プロセスを1回起動し、(インタプリタ起動を含む合計時間[ms], 子プロセスの結果) を返す"""
+    start = time.perf_counter()
+    completed = subprocess.run([sys.executable, '-c', CHILD_SCRIPT % (DEFERRED_MODULES,)], cwd=ROOT_DIR,
+                               capture_output=True, text=True)
+    total_ms = (time.perf_counter() - start) * 1000
+    lines = completed.stdout.strip().splitlines()
+    if completed.returncode != 0 or not lines:
+        raise RuntimeError(completed.stderr.strip() or 'startup script failed')
+    return total_ms, json.loads(lines[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='起動時間の計測と予算の確認')
+    parser.add_argument('--budget-ms', type=float, default=DEFAULT_BUDGET_MS,
+                        help='最初のウィンドウまでの時間の上限（ミリ秒）')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    runs = [measure_once() for _ in range(args.repeat)]
+    total_ms, result = min(runs, key=lambda run: run[0])
+    if result.get('import_ms') is None:
+        print(f"Error: 起動できません: {result['error']}", file=sys.stderr)
+        return 1
+    print(f"import: {result['import_ms']:.0f} ms")
+    if result['window_ms'] is not None:
+        print(f"first window: {result['window_ms']:.0f} ms (process total {total_ms:.0f} ms)")
+    else:
+        # 画面のない環境ではウィンドウを作れないため、インポートまでの時間で判定
+        print(f"first window: skipped ({result['error']}), process total {total_ms:.0f} ms")
+
+    failed = False
+    if total_ms > args.budget_ms:
+        print(f"FAIL: {total_ms:.0f} ms > budget {args.budget_ms:.0f} ms")
+        failed = True
+    if result['loaded']:
+        print(f"FAIL: 起動時に読み込まれたモジュール: {', '.join(result['loaded'])}")
+        failed = True
+    if not failed:
+        print(f"OK: budget {args.budget_ms:.0f} ms")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,18 +1,37 @@
 import os
+import logging
 import tkinter as tk
-from tkinter import filedialog
+from tkinter import filedialog, messagebox
 import customtkinter
 from PIL import Image, ImageTk
 import glob
-import numpy as np
-from model.multispectral_img_model import MultispectralImgModel
-from model.multispectral_img_model import Visualizer
+from concurrent.futures import CancelledError
+# numpyを使うモデルのモジュールは起動を速くするため、最初に使う時に読み込む
+from controller.render_prefetcher import RenderPrefetcher
+from model.folder_watcher import FolderWatcher
+from model.instrumentation import TRACER, span
+from model.background_job import BackgroundJob
 from view.home_screen import ApplicationView
 from view.home_screen import PanelWindowView
+from view.home_screen import MosaicWindowView
+from view.home_screen import PROFILE_LOAD_CHOICE
 
 
 # 初期ディレクトリ設定
 INIT_DIR = 'C:/project/multispectral-app'
+# フォルダ監視のポーリング間隔（ミリ秒）
+WATCH_INTERVAL_MS = 1000
+# バックグラウンド処理の進捗を確認する間隔（ミリ秒）
+JOB_POLL_MS = 50
+# 植生指数の保持形式を指定する環境変数（'float16'・'int16'でメモリを半分に、既定は'float32'）
+INDEX_STORAGE_ENV = 'MULTISPECTRAL_INDEX_STORAGE'
+# 計測表示に載せるスパンとカウンタ
+OVERLAY_SPANS = ['load_images', 'create_datacube', 'batch_process', 'convert_to_reflectance',
+                 'compute_index', 'update_display', 'display_spectral', 'display_veg_index']
+OVERLAY_COUNTERS = ['frames_decoded', 'frames_indexed', 'bytes_allocated', 'index_cache_hit', 'index_cache_miss',
+                    'render_cache_hit', 'render_cache_miss', 'disk_cache_index_hit']
+
+logger = logging.getLogger(__name__)
 
 class ApplicationController:
     def __init__(self):
@@ -22,12 +41,29 @@ class ApplicationController:
         
         # 属性の初期化
         self.datacube_list = []
-        self.image_tmp_list = []
+        self.datacube_store = None
         self.select_dir_path = None
         self.slider_value = 0
         self.display_band = 5  # デフォルトの表示バンド
         self.display_vegindex = 1  # デフォルトの植生指数
         self.img_len = 0  # 画像の枚数を保持
+        self.load_workers = None  # 画像デコードの並列数（Noneなら読み込み時に既定値）
+        self.sensor_profile = None  # 読み込み済みのフライトのカメラのバンド配置
+        self.selected_profile = None  # 次の読み込みで使うバンド配置（Noneなら既定のプロファイル）
+        self.prefetcher = None  # スライダー周辺の表示画像の先読み
+        # 処理済みdatacube・植生指数のディスクキャッシュ（変更のないフレームは再処理しない、最初の読み込み時に作成）
+        self.processed_cache = None
+        self.mul_img_model = None
+        self.job = None  # 実行中のバックグラウンド処理
+        self.watcher = None  # フォルダ監視（有効時のみ）
+        self.watch_job = None
+        self.append_job = None  # 監視で見つかった画像の追加（実行中のみ）
+        self.stats_job = None  # 統計量の書き出し（実行中のみ）
+        self.canopy_job = None  # 植生マスクの分割（実行中のみ）
+        self.comparison = None  # 別のフライトとの比較（FlightComparison、比較フォルダの読み込み後）
+        self.compare_job = None
+        self.compare_mode = None    # 表示する比較の方法（'diff'・'ratio'、Noneなら植生指数を表示）
+        self.mosaic_window = None   # フライト全体のモザイク（MosaicWindowController、表示中のみ）
 
     def run(self):
         """アプリケーションを起動"""
@@ -46,32 +82,228 @@ class ApplicationController:
 
 
     def start_processing_callback(self):
-        """画像処理を開始するコールバック"""
+        """画像処理を開始するコールバック（読み込みはバックグラウンドで行い、読み込んだフレームから表示）"""
+        if self.job is not None:
+            return  # 処理中
         # 本番環境用にフォルダパスを取得
         self.select_dir_path = self.select_dir_path or INIT_DIR + '/test'
-        
-        # フォルダ内の画像をロード
-        self.load_images()
-        
-        # モデルの作成とデータキューブ生成
-        self.mul_img_model = MultispectralImgModel(self.image_tmp_list)
-        self.visualizer = Visualizer(self.mul_img_model)
-        
-        # スライダーと表示の設定
-        self.img_len = self.mul_img_model.get_datacube_len()
-        self.view.spectral_img_frame.create_widget_slider(self.img_len)
-        self.update_display()
+        self.stop_watch()
+        if self.prefetcher:
+            self.prefetcher.close()
+            self.prefetcher = None
+        if self.mosaic_window is not None:
+            self.mosaic_window.close()
+        self.cancel_flight_jobs()
+        self.mul_img_model = None
+        self.comparison = None
+        self.view.veg_index_frame.show_compare("比較: なし")
+        self.images = self.list_images()
+        self.view.menu_frame.set_processing(True)
+        self.job = BackgroundJob(self.load_images, name='load-images').start()
+        self.view.after(JOB_POLL_MS, self.poll_job)
 
-    def load_images(self):
-        """指定ディレクトリ内の画像を読み込む"""
+    def cancel_flight_jobs(self):
+        """読み込み済みのフライトに対する処理（画像の追加・統計量・植生マスク・比較フォルダ）を中止し、結果を破棄する
+        各ポーリングは自分のジョブが現在のものでなくなった時点で止まる"""
+        for name in ('append_job', 'stats_job', 'canopy_job', 'compare_job'):
+            job = getattr(self, name)
+            if job is not None:
+                job.cancel()
+                setattr(self, name, None)
+        self.view.veg_index_frame.show_canopy("")
+
+    def profile_choices(self):
+        """センサープロファイルの選択肢（登録済みの名前と、JSONファイルからの読み込み）"""
+        from model.sensor_profile import PROFILES
+        return sorted(PROFILES) + [PROFILE_LOAD_CHOICE]
+
+    def profile_event(self, choice):
+        """カメラのバンド配置の選択（次の前処理開始から使い、読み込み済みのフライトはそのまま）
+        JSONファイルのプロファイルも読み込める"""
+        from model.sensor_profile import DEFAULT_PROFILE, get_profile, load_profiles
+        menu = self.view.menu_frame.option_profile
+        if choice == PROFILE_LOAD_CHOICE:
+            current = (self.selected_profile or DEFAULT_PROFILE).name
+            path = filedialog.askopenfilename(filetypes=[("JSON", "*.json")])
+            if not path:
+                menu.set(current)
+                return
+            try:
+                choice = load_profiles(path)[0].name
+            except (OSError, ValueError) as e:
+                messagebox.showerror('エラー', f"プロファイルを読み込めません: {e}")
+                menu.set(current)
+                return
+            menu.configure(values=self.profile_choices())
+            menu.set(choice)
+        self.selected_profile = get_profile(choice)
+        logger.info("センサープロファイル", extra={'profile': self.selected_profile.to_dict()})
+
+    def list_images(self):
+        """指定ディレクトリ内の画像のパスを名前順に返す"""
         # dir_path = os.path.join(self.select_dir_path, 'frames', '*')
         dir_path = os.path.join(self.select_dir_path, '*')
-        self.images = glob.glob(dir_path)
-        self.image_tmp_list = [Image.open(img) for img in self.images]
+        return sorted(glob.glob(dir_path))
+
+    @TRACER.traced('load_images')
+    def load_images(self, job):
+        """指定ディレクトリ内の画像を読み込む（ワーカースレッドで実行）"""
+        from model.datacube_store import DatacubeStore, DEFAULT_CACHE_DIR
+        from model.processed_cache import ProcessedCache
+        from model.image_loader import DEFAULT_WORKERS
+        from model.sensor_profile import DEFAULT_PROFILE
+        if self.processed_cache is None:
+            self.processed_cache = ProcessedCache(os.path.join(DEFAULT_CACHE_DIR, 'frames'))
+        self.load_workers = self.load_workers or DEFAULT_WORKERS
+        self.sensor_profile = self.selected_profile or DEFAULT_PROFILE
+        # 放射輝度をメモリマップファイルに格納（同じフォルダはキャッシュから再利用）
+        datacube_store = DatacubeStore.open(self.images, workers=self.load_workers, progress=job.progress,
+                                            frame_cache=self.processed_cache, profile=self.sensor_profile,
+                                            on_ready=lambda store: job.post('frames', store), cancel=job.cancel_event)
+        logger.info(self.processed_cache.summary(), extra={'folder': self.select_dir_path,
+                                                            'frames': len(self.images)})
+        return datacube_store
+
+    def cancel_processing_callback(self):
+        """読み込みの中止を要求"""
+        if self.job is not None:
+            self.job.cancel()
+
+    def poll_job(self):
+        """ワーカースレッドからのメッセージを処理（Tkのスレッドで after() から呼ばれる）"""
+        for kind, payload in self.job.poll():
+            if kind == 'progress':
+                self.load_progress(*payload)
+            elif kind == 'frames':
+                self.show_loaded_frames(payload)
+            elif kind in ('done', 'cancelled', 'error'):
+                self.job = None
+                self.view.menu_frame.set_processing(False)
+                if kind == 'done':
+                    self.show_loaded_frames(payload)
+                    if self.view.menu_frame.switch_registration.get():
+                        self.registration_event()
+                    if self.view.menu_frame.switch_watch.get():
+                        self.start_watch()
+                elif kind == 'cancelled':
+                    self.view.menu_frame.label_progress.configure(text="読み込み: 中止")
+                else:
+                    messagebox.showerror('エラー', f"画像の読み込みに失敗しました: {payload}")
+                return
+        self.view.after(JOB_POLL_MS, self.poll_job)
+
+    def show_loaded_frames(self, datacube_store):
+        """読み込み済みのフレームを表示（初回はモデルとスライダーを作成し、以降は範囲を広げる）"""
+        frame_count = len(datacube_store)
+        if self.mul_img_model is None:
+            if not frame_count:
+                return
+            from model.multispectral_img_model import MultispectralImgModel, Visualizer
+            self.datacube_store = datacube_store
+            # モデルの作成とデータキューブ生成
+            self.mul_img_model = MultispectralImgModel(datacube_store=datacube_store,
+                                                       processed_cache=self.processed_cache,
+                                                       index_storage=os.environ.get(INDEX_STORAGE_ENV, 'float32'))
+            self.visualizer = Visualizer(self.mul_img_model)
+            self.prefetcher = RenderPrefetcher(self.render_frame)
+            self.view.menu_frame.switch_reflectance.deselect()
+            self.view.menu_frame.switch_reflectance.configure(state="disabled")
+            
+            # スライダーと表示の設定
+            self.slider_value = 0
+            self.img_len = frame_count
+            self.view.spectral_img_frame.create_widget_slider(self.img_len)
+            self.update_display()
+        elif frame_count > self.img_len:
+            self.mul_img_model.sync_frames()
+            self.img_len = frame_count
+            self.view.spectral_img_frame.update_slider_range(self.img_len)
+            self.refresh_comparison()
+            self.refresh_mosaic()
+
+    def load_progress(self, done, total):
+        """画像読み込みの進捗をビューに反映"""
+        self.view.menu_frame.update_progress(done, total)
+
+    def switch_watch_event(self):
+        """フォルダ監視の開始・停止"""
+        if self.view.menu_frame.switch_watch.get():
+            if self.mul_img_model is not None and self.job is None:
+                self.start_watch()
+        else:
+            self.stop_watch()
+
+    def start_watch(self):
+        """読み込み済みのフォルダの監視を開始（既存の画像は対象外）"""
+        self.stop_watch()
+        self.watcher = FolderWatcher(self.select_dir_path, known_paths=self.images)
+        self.watch_job = self.view.after(WATCH_INTERVAL_MS, self.poll_folder)
+
+    def stop_watch(self):
+        """フォルダ監視を停止"""
+        if self.watch_job is not None:
+            self.view.after_cancel(self.watch_job)
+        self.watch_job = None
+        self.watcher = None
+
+    def poll_folder(self):
+        """書き込みが完了した新しい画像をバックグラウンドで末尾のフレームとして追加する
+        前回の追加が終わるまでは新しい画像を探さない（見つからなかった画像は次回以降に追加）"""
+        if self.append_job is None:
+            paths = self.watcher.poll()
+            if paths:
+                self.append_job = BackgroundJob(self.append_frames, self.mul_img_model, paths,
+                                                name='append-frames').start()
+                self.view.after(JOB_POLL_MS, self.poll_append_job, self.append_job)
+        self.watch_job = self.view.after(WATCH_INTERVAL_MS, self.poll_folder)
+
+    def append_frames(self, job, model, paths):
+        """画像をモデルに追加し、追加できたパスのリストを返す（ワーカースレッドで実行）
+        まとめて並列に読み込み、失敗した場合（画像サイズの異なるファイルなど）は1枚ずつ読み込む"""
+        try:
+            model.append_frames(paths, workers=self.load_workers, sync=False)
+            return paths
+        except ValueError as e:
+            if len(paths) == 1:
+                logger.warning("追加された画像を読み込めません: %s", e, extra={'path': paths[0]})
+                return []
+        added = []
+        for path in paths:
+            if job.cancelled:
+                raise CancelledError()
+            added += self.append_frames(job, model, [path])
+        return added
+
+    def poll_append_job(self, job):
+        """画像の追加が完了したらスライダーの範囲を広げ、追加フレームを先読みする（破棄したジョブの結果は使わない）"""
+        if job is not self.append_job:
+            return
+        for kind, payload in job.poll():
+            if kind in ('done', 'cancelled', 'error'):
+                self.append_job = None
+                if kind == 'done' and payload:
+                    self.show_appended_frames(payload)
+                elif kind == 'error':
+                    logger.warning("追加された画像の読み込みに失敗しました: %s", payload)
+                return
+        self.view.after(JOB_POLL_MS, self.poll_append_job, job)
+
+    def show_appended_frames(self, added):
+        """追加したフレームをスライダー・先読み・比較・モザイクに反映"""
+        start = self.img_len
+        self.mul_img_model.sync_frames()
+        self.images += added
+        self.img_len = self.mul_img_model.get_datacube_len()
+        self.view.spectral_img_frame.update_slider_range(self.img_len)
+        self.view.menu_frame.update_progress(self.img_len, self.img_len)
+        # 追加フレームの植生指数・表示画像をバックグラウンドで作成
+        self.prefetcher.request([self.display_key(frame) for frame in range(start, self.img_len)])
+        self.refresh_comparison()
+        self.refresh_mosaic()
 
     def slider_event(self, value):
         """スライダーの値が変更されたときのイベントハンドラ"""
-        new_value = int(value)
+        new_value = min(int(value), self.img_len - 1)  # 読み込み中で1枚のみの場合もスライダーの範囲は1以上
         if new_value != self.slider_value:  # スライダーの値が変更された場合のみ更新
             self.slider_value = new_value
             self.view.spectral_img_frame.value_label.configure(text=f"スライダー値: {self.slider_value}")
@@ -105,22 +337,336 @@ class ApplicationController:
         self.display_vegindex = self.view.menu_frame.radio_var_vegindex.get()
         self.update_display()
 
+    @TRACER.traced('update_display')
     def update_display(self):
         """現在の設定に基づいて画像とカラーマップを更新"""
+        # 表示画像を取得（先読み済みならキャッシュから）
+        band_img, index_img = self.prefetcher.get(self.display_key(self.slider_value))
+        
         # バンド画像の表示更新
-        self.view.spectral_img_frame.display_spectral(self.mul_img_model.datacube_list, self.display_band, self.slider_value)
+        with span('display_spectral', frame=self.slider_value):
+            self.view.spectral_img_frame.display_spectral(band_img)
         
-        # 選択された植生指数のカラーマップ更新
-        fig = self.visualizer.make_colormap(self.slider_value, self.display_vegindex)
-        self.view.veg_index_frame.display_veg_index(fig)
+        # 選択された植生指数のカラーマップ更新（カラーバーは変更時のみ）
+        with span('display_veg_index', frame=self.slider_value):
+            colorbar = self.visualizer.render_colorbar(self.display_vegindex, index_img.width,
+                                                       self.compare_setting())
+            self.view.veg_index_frame.display_veg_index(index_img, colorbar)
+        
+        # 前後のフレームをバックグラウンドで先読み
+        frames = self.prefetcher.neighbor_frames(self.slider_value, self.img_len)
+        self.prefetcher.request([self.display_key(frame) for frame in frames])
+        self.update_frame_stats()
+        self.update_canopy()
+        self.update_metrics()
+        self.refresh_mosaic()
+    
+    def update_frame_stats(self):
+        """表示中のフレームの植生指数の統計量をスライダーの横に表示（表示時に集計済み）"""
+        from model.multispectral_img_model import VEGINDEX_NAMES
+        index_name = VEGINDEX_NAMES[self.display_vegindex]
+        if self.compare_key() is not None:
+            self.update_change_stats(index_name)
+            return
+        stats = self.mul_img_model.frame_summary(index_name, self.slider_value)
+        text = "" if stats is None else (
+            f"{index_name.upper()}  平均 {stats['mean']:.3f}  標準偏差 {stats['std']:.3f}\n"
+            f"中央値 {stats['p50']:.3f}  P5-P95 {stats['p5']:.3f} - {stats['p95']:.3f}")
+        self.view.spectral_img_frame.show_frame_stats(text)
+    
+    def update_change_stats(self, index_name):
+        """比較の表示中は、表示中のフレームの差・比の統計量を表示（表示時に集計済み）"""
+        stats = self.comparison.frame_summary(index_name, self.slider_value, self.compare_mode)
+        if self.comparison.target_frame(self.slider_value) is None:
+            text = "比較対象に対応するフレームがありません"
+        elif stats is None:
+            text = ""
+        else:
+            label = "差" if self.compare_mode == 'diff' else "比"
+            text = (f"{index_name.upper()} {label}  平均 {stats['mean']:.3f}  標準偏差 {stats['std']:.3f}\n"
+                    f"中央値 {stats['p50']:.3f}  P5-P95 {stats['p5']:.3f} - {stats['p95']:.3f}")
+        self.view.spectral_img_frame.show_frame_stats(text)
+    
+    def export_stats_callback(self):
+        """全フレームの統計量を集計してCSVとJSON（同じ名前）に保存（未集計のフレームはバックグラウンドで計算）"""
+        if self.mul_img_model is None or self.stats_job is not None:
+            return
+        path = filedialog.asksaveasfilename(defaultextension='.csv', filetypes=[('CSV', '*.csv')],
+                                            initialfile='vegindex-stats.csv')
+        if not path:
+            return
+        self.stats_job = BackgroundJob(self.export_stats, path, name='export-stats').start()
+        self.view.after(JOB_POLL_MS, self.poll_stats_job, self.stats_job)
+    
+    def export_stats(self, job, path):
+        """統計量の集計と書き出し（ワーカースレッドで実行、比較の表示中は表示中の指数の差・比の統計量）"""
+        model, comparison = self.mul_img_model, self.comparison
+        if self.compare_key() is not None:
+            from model.multispectral_img_model import VEGINDEX_NAMES
+            comparison.change_statistics(VEGINDEX_NAMES[self.display_vegindex], self.compare_mode,
+                                         progress=job.progress, cancel=job.cancel_event)
+            if job.cancelled:
+                raise CancelledError()  # 別のフォルダの読み込みで中止された場合は書き出さない
+            comparison.export(path)
+            return path
+        statistics = model.compute_statistics(progress=job.progress, cancel=job.cancel_event)
+        if job.cancelled:
+            raise CancelledError()
+        statistics.export_csv(path)
+        frame_names = [os.path.basename(image) for image in model.datacube_store.paths]
+        statistics.export_json(os.path.splitext(path)[0] + '.json', frame_names=frame_names or None)
+        return path
+    
+    def poll_stats_job(self, job):
+        """統計量の書き出しの進捗と結果を表示（中止して破棄したジョブなら何もしない）"""
+        if job is not self.stats_job:
+            return
+        for kind, payload in job.poll():
+            if kind == 'progress':
+                self.view.spectral_img_frame.show_frame_stats(f"統計を集計中: {payload[0]}/{payload[1]}")
+            elif kind in ('done', 'cancelled', 'error'):
+                self.stats_job = None
+                self.update_frame_stats()
+                if kind == 'done':
+                    logger.info("統計量を保存しました", extra={'path': payload})
+                elif kind == 'error':
+                    messagebox.showerror('エラー', f"統計量の保存に失敗しました: {payload}")
+                return
+        self.view.after(JOB_POLL_MS, self.poll_stats_job, job)
+    
+    def segmentation_event(self):
+        """植生マスクの重ね表示の切り替え（未分割の指数はバックグラウンドで全フレームを分割）"""
+        if self.mul_img_model is not None:
+            self.update_display()
+    
+    def mask_key(self):
+        """表示画像キャッシュのキーに含める植生マスクの閾値（重ね表示しない・未分割ならNone）"""
+        if not self.view.veg_index_frame.switch_mask.get():
+            return None
+        from model.multispectral_img_model import VEGINDEX_NAMES
+        metrics = self.mul_img_model.canopy.get(VEGINDEX_NAMES[self.display_vegindex])
+        return None if metrics is None else metrics.threshold
+    
+    def update_canopy(self):
+        """表示中のフレームの被覆率・株の数を表示（マスクが有効で未分割なら分割を開始）"""
+        if not self.view.veg_index_frame.switch_mask.get():
+            self.view.veg_index_frame.show_canopy("")
+            return
+        from model.multispectral_img_model import VEGINDEX_NAMES
+        index_name = VEGINDEX_NAMES[self.display_vegindex]
+        metrics = self.mul_img_model.canopy.get(index_name)
+        row = None if metrics is None else metrics.frame(self.slider_value)
+        if row is None:
+            if self.canopy_job is None:
+                self.canopy_job = BackgroundJob(self.compute_canopy, index_name, name='segmentation').start()
+                self.view.after(JOB_POLL_MS, self.poll_canopy_job, self.canopy_job)
+            return
+        self.view.veg_index_frame.show_canopy(
+            f"被覆率 {row['cover']:.1%}  株 {row['blobs']:.0f}（平均 {row['mean_blob_area']:.0f} px, "
+            f"最大 {row['largest_blob']:.0f} px）  閾値 {metrics.threshold:.3f}")
+    
+    def compute_canopy(self, job, index_name):
+        """全フレームの植生・土壌の分割（ワーカースレッドで実行、閾値は大津の方法）"""
+        return self.mul_img_model.compute_segmentation(index_name, progress=job.progress, cancel=job.cancel_event)
+    
+    def poll_canopy_job(self, job):
+        """植生マスクの分割の進捗を表示し、完了したらマスクを重ねて再表示（破棄したジョブなら何もしない）"""
+        if job is not self.canopy_job:
+            return
+        for kind, payload in job.poll():
+            if kind == 'progress':
+                self.view.veg_index_frame.show_canopy(f"植生マスクを計算中: {payload[0]}/{payload[1]}")
+            elif kind in ('done', 'cancelled', 'error'):
+                self.canopy_job = None
+                if kind == 'done':
+                    self.update_display()
+                elif kind == 'error':
+                    self.view.veg_index_frame.switch_mask.deselect()
+                    messagebox.showerror('エラー', f"植生マスクの計算に失敗しました: {payload}")
+                return
+        self.view.after(JOB_POLL_MS, self.poll_canopy_job, job)
+    
+    def compare_dir_callback(self):
+        """比較するフライトのフォルダを選び、バックグラウンドで読み込んでフレームを対応付ける"""
+        if self.mul_img_model is None or self.job is not None or self.compare_job is not None:
+            return
+        init_dir = os.path.dirname(self.select_dir_path) if self.select_dir_path else os.path.expanduser('~')
+        folder = filedialog.askdirectory(initialdir=init_dir)
+        if not folder:
+            return
+        self.compare_job = BackgroundJob(self.load_comparison, folder, name='load-comparison').start()
+        self.view.after(JOB_POLL_MS, self.poll_compare_job, self.compare_job)
+    
+    def load_comparison(self, job, folder):
+        """比較するフォルダを読み込み、表示中のフライトと同じ設定のモデルを作成（ワーカースレッドで実行）
+        フレームは名前で対応付け、対応数が少なければ撮影時刻、それも少なければフレーム番号で対応付ける
+        反射率は表示中のフライトのパネルの値（1枚のパネルの場合）で変換する"""
+        from model.datacube_store import DatacubeStore, DEFAULT_CACHE_DIR
+        from model.batch_pipeline import list_frames
+        from model.multispectral_img_model import MultispectralImgModel
+        from model.band_registration import ShiftCache, registration_key
+        from model.flight_comparison import FlightComparison, match_flights
+        base = self.mul_img_model   # 読み込み中に別のフォルダが読み込まれても、開始時のフライトと比較する
+        paths = list_frames(folder)
+        if not paths:
+            raise FileNotFoundError(f"フレーム画像が見つかりません: {folder}")
+        store = DatacubeStore.open(paths, workers=self.load_workers, progress=job.progress,
+                                   frame_cache=self.processed_cache, profile=self.sensor_profile,
+                                   cancel=job.cancel_event)
+        model = MultispectralImgModel(datacube_store=store, processed_cache=self.processed_cache,
+                                      index_storage=base.index_storage)
+        if base.registration is not None:
+            shift_cache = ShiftCache(os.path.join(DEFAULT_CACHE_DIR, 'band_shifts.json'))
+            model.set_registration(model.estimate_registration(shift_cache,
+                                                               registration_key(paths, self.sensor_profile)))
+        if base.is_refconvert and base.panel_schedule is None and base.panel_brightness is not None:
+            model.panel_brightness = base.panel_brightness
+            model.convert_to_reflectance()
+        by, pairs = match_flights(base.datacube_store, model.datacube_store)
+        if not len(pairs):
+            raise ValueError("対応するフレームがありません")
+        return folder, FlightComparison([base, model], by=by, pairs={1: pairs})
+    
+    def poll_compare_job(self, job):
+        """比較フォルダの読み込みの進捗を表示し、完了したら比較を表示（破棄したジョブの結果は使わない）"""
+        if job is not self.compare_job:
+            return
+        for kind, payload in job.poll():
+            if kind == 'progress':
+                self.view.veg_index_frame.show_compare(f"比較: 読み込み {payload[0]}/{payload[1]}")
+            elif kind in ('done', 'cancelled', 'error'):
+                self.compare_job = None
+                if kind == 'done':
+                    folder, self.comparison = payload
+                    self.view.veg_index_frame.show_compare(
+                        f"比較: {os.path.basename(folder)}（{len(self.comparison.matched_frames())}フレーム, "
+                        f"{self.comparison.by}）")
+                    if self.compare_mode is None:
+                        self.view.veg_index_frame.option_compare.set("差分")
+                        self.compare_mode = 'diff'
+                    self.update_display()
+                else:
+                    self.view.veg_index_frame.show_compare("比較: なし")
+                    if kind == 'error':
+                        messagebox.showerror('エラー', f"比較フォルダの読み込みに失敗しました: {payload}")
+                return
+        self.view.after(JOB_POLL_MS, self.poll_compare_job, job)
+    
+    def compare_mode_event(self, choice):
+        """比較の表示の切り替え（差分・比・比較しない）"""
+        from view.home_screen import COMPARE_MODES
+        self.compare_mode = COMPARE_MODES[choice]
+        if self.mul_img_model is not None:
+            self.update_display()
+    
+    def compare_key(self):
+        """表示画像キャッシュのキーに含める比較の方法（比較しない場合はNone）"""
+        return self.compare_mode if self.comparison is not None else None
+    
+    def compare_setting(self):
+        """比較の表示中は差・比のカラーバーの設定（それ以外はNoneで植生指数の設定）"""
+        if self.compare_key() is None:
+            return None
+        from model.multispectral_img_model import VEGINDEX_NAMES
+        from model.flight_comparison import difference_setting
+        return difference_setting(VEGINDEX_NAMES[self.display_vegindex], self.compare_mode)
+    
+    def mosaic_callback(self):
+        """フライト全体のモザイクのウィンドウを開く（開いていれば前面に出す）"""
+        if self.mul_img_model is None:
+            logger.error("モデルが生成されていません。最初に画像を処理してください。")
+        elif self.mosaic_window is not None:
+            self.mosaic_window.mosaic_view.lift()
+        else:
+            self.mosaic_window = MosaicWindowController(self)
+    
+    def refresh_comparison(self):
+        """比較の表示中は、追加フレームを含めて対応付けをやり直す（対応の変わった表示画像も破棄）"""
+        if self.comparison is not None:
+            self.comparison.rematch()
+            if self.compare_key() is not None:
+                self.prefetcher.clear()
     
+    def refresh_mosaic(self):
+        """モザイクの表示中は、追加フレーム・表示中の指数・校正状態の変更をモザイクに反映"""
+        if self.mosaic_window is not None:
+            self.mosaic_window.refresh()
+    
+    def metrics_event(self):
+        """計測表示の切り替え（表示中はトレースのイベントも記録する）"""
+        TRACER.enabled = bool(self.view.menu_frame.switch_metrics.get())
+        if TRACER.enabled:
+            self.update_metrics()
+        else:
+            self.view.veg_index_frame.hide_metrics()
+    
+    def update_metrics(self):
+        """計測表示を更新（直近の所要時間とカウンタ）"""
+        if not self.view.menu_frame.switch_metrics.get():
+            return
+        summary = TRACER.summary()
+        lines = [f"{name:24s}{stat['last_ms']:9.1f} ms (max {stat['max_ms']:.1f})"
+                 for name, stat in ((name, summary['spans'].get(name)) for name in OVERLAY_SPANS) if stat]
+        counters = summary['counters']
+        lines += [f"{name:24s}{counters[name]:>12,}" for name in OVERLAY_COUNTERS if name in counters]
+        self.view.veg_index_frame.show_metrics("\n".join(lines))
+    
+    def save_trace_callback(self):
+        """記録したトレースをChromeトレース形式(JSON)で保存"""
+        path = filedialog.asksaveasfilename(defaultextension='.json', filetypes=[('Chrome trace', '*.json')],
+                                            initialfile='multispectral-trace.json')
+        if path:
+            events = TRACER.export_chrome_trace(path)
+            logger.info("トレースを保存しました", extra={'path': path, 'events': events})
+    
+    def display_key(self, frame):
+        """表示画像キャッシュのキー (フレーム, バンド, 植生指数, 校正状態, 植生マスクの閾値, 比較の方法)
+        比較の表示中は比較対象の校正状態もキーに含める"""
+        calibration = self.mul_img_model.calibration_version
+        if self.compare_key() is not None:
+            calibration = tuple(model.calibration_version for model in self.comparison.models)
+        return (frame, self.display_band, self.display_vegindex, calibration, self.mask_key(), self.compare_key())
+    
+    def render_frame(self, key, cancel=None):
+        """表示画像（バンド画像とカラーマップ画像）を作成（先読みスレッドからも呼ばれる）
+        比較の表示中はカラーマップの代わりに対応するフレームとの差・比を表示する
+        cancel（先読みの打ち切り）がセットされていれば植生指数の計算前に中止する"""
+        frame, display_band, vegindex_num, _, mask, compare = key
+        band_img = self.mul_img_model.render_band_image(frame, display_band)
+        if cancel is not None and cancel.is_set():
+            raise CancelledError()
+        if compare is not None:
+            from model.multispectral_img_model import VEGINDEX_NAMES
+            return band_img, self.comparison.render_image(VEGINDEX_NAMES[vegindex_num], frame, compare)
+        return band_img, self.visualizer.render_index_image(frame, vegindex_num, mask is not None)
+    
+    
+    def registration_event(self):
+        """バンドの位置合わせの切り替え（ずれはフライトごとに1回だけ推定してキャッシュに保存）"""
+        if self.mul_img_model is None or self.job is not None:
+            return  # 読み込み完了時に適用
+        registration = None
+        if self.view.menu_frame.switch_registration.get():
+            from model.datacube_store import DEFAULT_CACHE_DIR
+            from model.band_registration import ShiftCache, registration_key
+            shift_cache = ShiftCache(os.path.join(DEFAULT_CACHE_DIR, 'band_shifts.json'))
+            registration = self.mul_img_model.estimate_registration(
+                shift_cache, registration_key(self.images, self.sensor_profile))
+            logger.info("バンドのずれ", extra={'shifts': registration.shifts.tolist()})
+        self.mul_img_model.set_registration(registration)
+        self.update_display()
+    
+    def switch_reflectance_event(self):
+        """放射輝度と反射率の表示を切り替え（datacubeの再計算やコピーは行わない）"""
+        self.mul_img_model.set_reflectance(bool(self.view.menu_frame.switch_reflectance.get()))
+        self.update_display()
     
     def reflectance_event(self):
         """パネルウィンドウの生成とモデルの渡し"""
-        if self.mul_img_model:
+        if self.mul_img_model is not None:
             PanelWindowController(self)
         else:
-            print("Error: モデルが生成されていません。最初に画像を処理してください。")
+            logger.error("モデルが生成されていません。最初に画像を処理してください。")
 
 
 class PanelWindowController:
@@ -150,28 +696,32 @@ class PanelWindowController:
         try:
             # ファイルパスが正しいかチェック
             if not hasattr(self, 'select_panelfile_path') or not self.select_panelfile_path:
-                print("Error: No file path specified.")
+                logger.error("No file path specified.")
                 return
 
             # 画像の読み込み
             if not os.path.exists(self.select_panelfile_path):
-                print(f"Error: The file {self.select_panelfile_path} does not exist.")
+                logger.error("The file does not exist.", extra={'path': self.select_panelfile_path})
                 return
 
             # 画像の読み込み
+            from model.panel_roi import PanelROIExtractor
             self.panel_img = Image.open(self.select_panelfile_path)
-            panel_size = self.panel_img.size
-
-            if panel_size == (512, 2048):
-                self.panel_img_crop = self.panel_img.crop((0, 0, 512, 512))
+            # 全バンドの積分画像を作成（ドラッグ中の統計量の更新用）
+            profile = self.app_controller.sensor_profile
+            self.panel_extractor = PanelROIExtractor.from_image(self.panel_img, profile)
+            
+            # 表示はGreenバンド（範囲は画像サイズとセンサープロファイルから算出）
+            self.panel_img_crop = self.panel_img.crop(profile.band_rect(0, self.panel_img.size))
             
             self.imgtk = ImageTk.PhotoImage(self.panel_img_crop)
             
             # パネルビューに画像を表示
             self.panel_view.display_canvas_panel(self.imgtk)
             
-        except Exception as e:
-            print(f"An unexpected error occurred while opening the image: {e}")
+        except Exception:
+            logger.exception("An unexpected error occurred while opening the image.",
+                             extra={'path': self.select_panelfile_path})
             
 
     def rect_drawing(self, event):
@@ -193,6 +743,10 @@ class PanelWindowController:
         else:
             # 既存の矩形の右下隅を更新
             self.panel_view.canvas_panel.coords("rect1", self.start_x, self.start_y, end_x, end_y)
+        
+        # ドラッグ中の範囲の統計量を表示（積分画像により範囲の大きさによらず一定時間）
+        stats = self.panel_extractor.rect_stats([(self.start_x, self.start_y, end_x, end_y)])
+        self.update_brightness_labels(stats)
 
     def release_action(self, event):
         """ マウスボタンを離したときに最終的な座標を取得 """
@@ -201,19 +755,136 @@ class PanelWindowController:
 
         # パネルの各バンドの放射輝度を受け取る
         self.panel_brightness_list = self.mul_img_model.get_panel_brightness(self.panel_img, self.rectangle_area)
-        # 放射輝度ラベル更新
-        bands = ["Green", "Red", "RedEdge", "NIR"]
-        for i, value in enumerate(self.panel_brightness_list):
-            self.panel_view.update_brightness_label(i, value)
-            
+        # 放射輝度ラベル更新（確定時は中央値も表示）
+        self.update_brightness_labels(self.panel_extractor.rect_stats([self.rectangle_area], median=True))
         
+
         # 開始点をリセット
         del self.start_x
         del self.start_y
         
+    def add_sample(self):
+        """現在のパネル範囲を表示中のフレームに対応付けて登録（フレーム間は補間）"""
+        if not getattr(self, 'panel_brightness_list', None):
+            return
+        frame = self.app_controller.slider_value
+        self.mul_img_model.add_panel_sample(self.panel_brightness_list, frame)
+        sample_count = len(self.mul_img_model.panel_schedule)
+        self.panel_view.text_label.configure(text=f"フレーム{frame}にパネルを追加しました（{sample_count}件）")
+        self.enable_reflectance_switch()
+        self.app_controller.update_display()
+    
+    def enable_reflectance_switch(self):
+        """反射率表示の切り替えスイッチを有効化"""
+        switch = self.app_controller.view.menu_frame.switch_reflectance
+        switch.configure(state="normal")
+        switch.select()
+    
+    def update_brightness_labels(self, stats):
+        """ROIの統計量（1件目）をバンドごとのラベルに表示"""
+        for i in range(len(self.panel_view.bands)):
+            median = stats['median'][0][i] if 'median' in stats else None
+            self.panel_view.update_brightness_label(i, round(float(stats['mean'][0][i]), 2), median,
+                                                    float(stats['std'][0][i]), int(stats['saturated'][0][i]))
+        
     def confirm_rect(self):
         if self.panel_brightness_list:
             self.panel_view.destroy()
             self.mul_img_model.convert_to_reflectance()
+            self.enable_reflectance_switch()
             self.app_controller.update_display()
             tk.messagebox.showinfo('メッセージ', '反射率に変換しました  ')
+
+
+class MosaicWindowController:
+    def __init__(self, master):
+        """フライト全体のモザイクのウィンドウ（フレームの加算はバックグラウンドで行い、途中経過も表示）"""
+        from model.mosaic import MosaicBuilder
+        self.app_controller = master
+        self.mosaic_view = MosaicWindowView(master.view, self)
+        self.builder = MosaicBuilder(master.mul_img_model, self.index_name())
+        self.job = None
+        self.placement = None   # 表示中のモザイク画像の配置（画像上の点からフレームを引く）
+        self.closed = False
+        self.refresh()
+    
+    def index_name(self):
+        from model.multispectral_img_model import VEGINDEX_NAMES
+        return VEGINDEX_NAMES[self.app_controller.display_vegindex]
+    
+    def refresh(self):
+        """未加算のフレームがあれば加算を開始し、なければ表示中のフレームの枠を更新
+        加算中に指数が変わった場合は中止して、完了時に新しい指数で作り直す"""
+        if self.job is not None:
+            if self.builder.index_name != self.index_name():
+                self.job.cancel()
+            return
+        self.builder.set_index(self.index_name())
+        if self.builder.pending:
+            self.job = BackgroundJob(self.update_mosaic, name='update-mosaic').start()
+            self.app_controller.view.after(JOB_POLL_MS, self.poll_job)
+        else:
+            self.show_current()
+    
+    def update_mosaic(self, job):
+        """未加算のフレームの位置を推定してモザイクに加算（ワーカースレッドで実行）"""
+        return self.builder.update(progress=job.progress, cancel=job.cancel_event)
+    
+    def poll_job(self):
+        """加算の進捗に合わせてモザイクを再表示し、完了したら残りのフレーム（加算中の追加・変更分）を処理"""
+        messages = self.job.poll()
+        progress = [payload for kind, payload in messages if kind == 'progress']
+        if progress and not self.closed:
+            done, total = progress[-1]
+            self.mosaic_view.show_status(f"モザイク: 作成中 {done}/{total}")
+            self.show_overview()
+        for kind, payload in messages:
+            if kind in ('done', 'cancelled', 'error'):
+                self.job = None
+                if self.closed:
+                    self.builder.close()
+                    return
+                if kind == 'error':
+                    self.mosaic_view.show_status("モザイク: 作成に失敗しました")
+                    messagebox.showerror('エラー', f"モザイクの作成に失敗しました: {payload}")
+                    return
+                self.show_overview()
+                unreliable = int((~self.builder.reliable[:self.builder.placed]).sum())
+                self.mosaic_view.show_status(f"モザイク: {self.builder.index_name.upper()} {self.builder.placed}フレーム"
+                                             + (f"（移動量を推定できないフレーム {unreliable}）" if unreliable else ""))
+                self.refresh()
+                return
+        self.app_controller.view.after(JOB_POLL_MS, self.poll_job)
+    
+    def show_overview(self):
+        """モザイク全体の画像と表示中のフレームの枠を表示"""
+        result = self.builder.render_overview()
+        if result is None:
+            return
+        img, self.placement = result
+        self.mosaic_view.display_mosaic(img)
+        self.show_current()
+    
+    def show_current(self):
+        if self.placement is not None:
+            self.mosaic_view.show_frame_outline(
+                self.builder.frame_outline(self.placement, self.app_controller.slider_value))
+    
+    def overview_click(self, event):
+        """クリックした位置のフレーム（中心が最も近いもの）にスライダーを移動"""
+        if self.placement is None:
+            return
+        frame = self.builder.frame_at_pixel(self.placement, event.x, event.y)
+        if frame is not None and frame < self.app_controller.img_len:
+            self.app_controller.slider_value = frame
+            self.app_controller.update_slider_display()
+    
+    def close(self):
+        """ウィンドウを閉じる（加算中なら中止し、一時フォルダは加算の終了後に削除）"""
+        self.closed = True
+        self.app_controller.mosaic_window = None
+        if self.job is not None:
+            self.job.cancel()
+        else:
+            self.builder.close()
+        self.mosaic_view.destroy()
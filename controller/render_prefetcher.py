@@ -0,0 +1,110 @@
+import threading
+from collections import OrderedDict, deque
+from model.instrumentation import count
+
+# 表示画像キャッシュの上限件数と先読みするフレーム範囲（現在のフレームの前後）
+DEFAULT_CAPACITY = 64
+DEFAULT_RADIUS = 4
+
+
+class RenderPrefetcher:
+    """スライダー周辺のフレームの表示画像をワーカースレッドで事前に作成し、上限付きキャッシュに保持する
+    キーは (フレーム, 表示バンド, 植生指数, 校正状態, 植生マスク, 比較の方法)、render_func(key, cancel) で画像を作成する
+    cancel（threading.Event）は先読みが不要になった時にセットされ、render_funcは途中で打ち切ってよい"""
+    def __init__(self, render_func, capacity=DEFAULT_CAPACITY, radius=DEFAULT_RADIUS):
+        self.render_func = render_func
+        self.capacity = capacity
+        self.radius = radius
+        self._cache = OrderedDict()
+        self._pending = deque()
+        self._in_progress = None
+        self._cancel = threading.Event()    # 作成中の先読みの打ち切り
+        self._cond = threading.Condition()
+        self._closed = False
+        self.hits = 0
+        self.misses = 0
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def get(self, key):
+        """表示画像を取得（先読み済みならキャッシュから、先読み中なら完了を待ち、未作成ならこの場で作成）"""
+        with self._cond:
+            if key == self._in_progress:
+                self._cancel.clear()    # 打ち切りの要求を取り消して完了を待つ
+                while key == self._in_progress:
+                    self._cond.wait()
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                count('render_cache_hit')
+                return self._cache[key]
+            self.misses += 1
+        count('render_cache_miss')
+        value = self.render_func(key, None)
+        self._store(key, value)
+        return value
+
+    def request(self, keys):
+        """先読みするキーを優先順に指定（以前の未着手の要求は破棄し、範囲外になった作成中の先読みは打ち切る）"""
+        keys = list(keys)
+        with self._cond:
+            self._pending.clear()
+            self._pending.extend(key for key in keys if key not in self._cache and key != self._in_progress)
+            if self._in_progress is not None and self._in_progress not in keys:
+                self._cancel.set()
+            self._cond.notify_all()
+
+    def neighbor_frames(self, frame, frame_count):
+        """現在のフレームから近い順に前後のフレーム番号を返す"""
+        frames = []
+        for offset in range(1, self.radius + 1):
+            for candidate in (frame + offset, frame - offset):
+                if 0 <= candidate < frame_count:
+                    frames.append(candidate)
+        return frames
+
+    def clear(self):
+        """キャッシュと未着手の要求を全て破棄（作成中の先読みは打ち切る）"""
+        with self._cond:
+            self._cache.clear()
+            self._pending.clear()
+            if self._in_progress is not None:
+                self._cancel.set()
+
+    def close(self):
+        """ワーカースレッドを終了"""
+        with self._cond:
+            self._closed = True
+            self._pending.clear()
+            self._cancel.set()
+            self._cond.notify_all()
+
+    def _store(self, key, value):
+        with self._cond:
+            self._cache[key] = value
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.capacity:
+                self._cache.popitem(last=False)
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                key = self._pending.popleft()
+                if key in self._cache:
+                    continue
+                self._in_progress = key
+                self._cancel.clear()
+            try:
+                value = self.render_func(key, self._cancel)
+            except Exception:
+                # 先読みの失敗・打ち切りは無視（表示時に改めて作成してエラーを出す）
+                value = None
+            if value is not None and not self._cancel.is_set():
+                self._store(key, value)
+            with self._cond:
+                self._in_progress = None
+                self._cond.notify_all()     # 完了を待っているget()に通知
@@ -0,0 +1,75 @@
+"""複数のフライト（フォルダ）の植生指数をプロセスプールで並列に書き出すコマンド（GUIなし）
+
+例:
+    python flight_batch_cli.py flights.json --indices ndvi gndvi --formats npy png --out output
+
+flights.json（相対パスはこのファイルのフォルダから）:
+    [{"folder": "test/frames", "panel": "test/frames/panel.tif", "roi": [200, 200, 300, 300]},
+     {"folder": "test/kouyou_images"}]
+
+途中で止めた場合も同じコマンドで再実行すると、完了済みのフォルダは処理しない（--no-resume で全て再処理）。
+"""
+import sys
+import argparse
+from model.flight_batch import (FlightBatchRunner, load_manifest, DEFAULT_SHARD_FRAMES, DEFAULT_RETRIES,
+                                SUMMARY_FILE)
+from model.batch_pipeline import OUTPUT_FORMATS
+from model.vegindex_engine import DEFAULT_FORMULAS
+from model.index_codec import STORAGE_FORMATS
+from model.sensor_profile import PROFILES, load_profiles
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='複数フライトの植生指数の一括書き出し（GUIなし）')
+    parser.add_argument('manifest', help='フライトの一覧（JSON: folder, panel, roi, name, profile）')
+    parser.add_argument('--profile-file', action='append', default=[], metavar='JSON',
+                        help=f"マニフェストのprofileで使うバンド配置をJSONファイルから読み込む（登録済み: "
+                             f"{', '.join(sorted(PROFILES))}、複数指定可）")
+    parser.add_argument('--out', required=True, help='出力フォルダ（フライトごとのフォルダと run_summary.json）')
+    parser.add_argument('--indices', nargs='+', default=['ndvi', 'gndvi', 'ndre', 'cigreen'],
+                        choices=sorted(DEFAULT_FORMULAS))
+    parser.add_argument('--formats', nargs='+', default=['npy'], choices=OUTPUT_FORMATS)
+    parser.add_argument('--storage', default='float32', choices=STORAGE_FORMATS,
+                        help='植生指数の保持・書き出し形式')
+    parser.add_argument('--register', choices=['flight', 'camera'],
+                        help='バンドの位置合わせ（ずれはフライトまたはカメラごとに1回だけ推定して保存）')
+    parser.add_argument('--workers', type=int,
+                        help='ワーカープロセス数の上限（省略時はコア数とメモリ上限から決める）')
+    parser.add_argument('--memory-budget', type=float, metavar='MB',
+                        help='全ワーカーのメモリ上限（MB、省略時は空きメモリの半分）')
+    parser.add_argument('--shard-frames', type=int, default=DEFAULT_SHARD_FRAMES,
+                        help='1つのワーカーにまとめて渡すフレーム数')
+    parser.add_argument('--retries', type=int, default=DEFAULT_RETRIES, help='失敗したシャードの再実行回数')
+    parser.add_argument('--no-resume', action='store_true', help='完了済みのフォルダも再処理する')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    try:
+        for path in args.profile_file:
+            load_profiles(path)
+        entries = load_manifest(args.manifest)
+    except (OSError, ValueError, KeyError) as error:
+        print(f"Error: マニフェスト・プロファイルを読み込めません: {error}", file=sys.stderr)
+        return 1
+
+    runner = FlightBatchRunner(entries, args.out, args.indices, args.formats, args.storage, args.register,
+                               workers=args.workers,
+                               memory_budget=int(args.memory_budget * 1024 ** 2) if args.memory_budget else None,
+                               shard_frames=args.shard_frames, max_retries=args.retries,
+                               resume=not args.no_resume)
+    summary = runner.run(progress=lambda done, total: print(f"\r{done}/{total} frames", end='', flush=True))
+    print()
+    for result in summary['results']:
+        print(f"{result['name']}: {result['status']} {result['frames']} frames"
+              + (f", {result['retries']} retries" if result['retries'] else '')
+              + ''.join(f"\n  {error}" for error in result['errors'] if result['status'] == 'failed'))
+    print(f"{summary['frames']} frames in {summary['seconds']:.2f} s ({summary['fps']:.1f} frames/s), "
+          f"{summary['workers'] or 0} workers, {summary['failed']} failed, {summary['skipped']} skipped, "
+          f"{summary['retries']} retries -> {SUMMARY_FILE}")
+    return 1 if summary['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,9 +1,13 @@
 from view.home_screen import ApplicationView
 from controller.app_controller import ApplicationController
 import customtkinter
+import os
+from model.instrumentation import configure_logging
 
 
 if __name__ == '__main__':
+    # MULTISPECTRAL_LOG にパスを指定するとJSON形式のログをファイルにも出力
+    configure_logging(os.environ.get('MULTISPECTRAL_LOG'))
     controller = ApplicationController()
     controller.run()
     
\ No newline at end of file
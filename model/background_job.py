@@ -0,0 +1,64 @@
+import queue
+import logging
+import threading
+from concurrent.futures import CancelledError
+
+logger = logging.getLogger(__name__)
+
+
+class BackgroundJob:
+    """関数をワーカースレッドで実行し、進捗や結果をメッセージとして受け渡す（GUIに依存しない）
+    func(job, *args) は job.post / job.progress でメッセージを送り、job.cancel_event で中止要求を確認する
+    GUIからは poll() を after() で定期的に呼び、メインスレッドでメッセージを処理する"""
+    def __init__(self, func, *args, name='background-job'):
+        self.func = func
+        self.args = args
+        self.cancel_event = threading.Event()
+        self._messages = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self.finished = False
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def post(self, kind, payload=None):
+        """メッセージ (種類, 内容) を送る（ワーカースレッドから呼ぶ）"""
+        self._messages.put((kind, payload))
+
+    def progress(self, done, total):
+        """進捗を送る（load_framesなどのprogress引数にそのまま渡せる）"""
+        self.post('progress', (done, total))
+
+    def cancel(self):
+        """中止を要求（実際に止まるのは関数が中止要求を確認した時点）"""
+        self.cancel_event.set()
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def poll(self):
+        """届いているメッセージを全て取り出す（最後は 'done'・'cancelled'・'error' のいずれか）"""
+        messages = []
+        while True:
+            try:
+                messages.append(self._messages.get_nowait())
+            except queue.Empty:
+                return messages
+
+    def join(self, timeout=None):
+        self._thread.join(timeout)
+
+    def _run(self):
+        try:
+            result = self.func(self, *self.args)
+        except CancelledError:
+            self.post('cancelled')
+        except Exception as e:
+            logger.exception("バックグラウンド処理でエラーが発生しました")
+            self.post('error', e)
+        else:
+            self.post('done', result)
+        finally:
+            self.finished = True
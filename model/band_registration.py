@@ -0,0 +1,305 @@
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+from model.vegindex_engine import BAND_INDEX
+from model.tiled_processing import pyramid_factors, downsample
+from model.instrumentation import span
+
+# ずれの推定に使う縮小後のバンドの大きさ（長辺）と、推定に使うフレーム数
+ESTIMATE_SIZE = 256
+DEFAULT_SAMPLE_FRAMES = 8
+# 位置合わせの基準にするバンド
+DEFAULT_REFERENCE = 'nir'
+
+
+def _edges(bands):
+    """バンド (..., h, w) の勾配の大きさ（バンド間で明暗が逆転しても輪郭の位置は一致する）"""
+    gy = np.abs(np.diff(bands, axis=-2))[..., :, :-1]
+    gx = np.abs(np.diff(bands, axis=-1))[..., :-1, :]
+    return gy + gx
+
+
+def _subpixel_peak(values):
+    """3点の放物線近似によるピーク位置の補正量（-0.5〜0.5）"""
+    left, center, right = values
+    denominator = left - 2 * center + right
+    if denominator == 0:
+        return 0.0
+    return float(np.clip(0.5 * (left - right) / denominator, -0.5, 0.5))
+
+
+def taper_window(length, taper=1.0):
+    """両端のtaperの割合を余弦で減衰させる窓（Tukey窓、1ならハニング窓）"""
+    if taper >= 1:
+        return np.hanning(length)
+    window = np.ones(length)
+    edge = int(taper * (length - 1) / 2)
+    if edge > 0:
+        ramp = 0.5 * (1 - np.cos(np.pi * np.arange(edge) / edge))
+        window[:edge] = ramp
+        window[-edge:] = ramp[::-1]
+    return window
+
+
+def phase_correlation(reference, moving, taper=1.0):
+    """位相限定相関で moving の reference に対するずれ (dy, dx) をサブピクセルで求める
+    moving(y, x) = reference(y - dy, x - dx) のとき (dy, dx) を返す
+    movingは (..., h, w) で複数バンドを一度に処理できる（結果は (..., 2)）
+    taperは窓で減衰させる端の割合（重なりが端に寄る大きなずれを求める場合は小さくする）"""
+    height, width = reference.shape[-2:]
+    window = np.outer(taper_window(height, taper), taper_window(width, taper)).astype(np.float32)
+    ref_spectrum = np.fft.rfft2((reference - reference.mean()) * window)
+    moving = np.asarray(moving, dtype=np.float32)
+    mov_spectrum = np.fft.rfft2((moving - moving.mean(axis=(-2, -1), keepdims=True)) * window)
+    cross = np.conj(ref_spectrum) * mov_spectrum
+    cross /= np.maximum(np.abs(cross), 1e-12)
+    surface = np.fft.irfft2(cross, s=(height, width))
+
+    flat = surface.reshape(-1, height, width)
+    shifts = np.empty((len(flat), 2), dtype=np.float32)
+    for i, corr in enumerate(flat):
+        py, px = np.unravel_index(np.argmax(corr), corr.shape)
+        dy = py + _subpixel_peak(corr[[(py - 1) % height, py, (py + 1) % height], px])
+        dx = px + _subpixel_peak(corr[py, [(px - 1) % width, px, (px + 1) % width]])
+        # 半分を超えるずれは負の方向（周期境界）
+        shifts[i] = (dy - height if dy > height / 2 else dy, dx - width if dx > width / 2 else dx)
+    return shifts.reshape(surface.shape[:-2] + (2,))
+
+
+class BandRegistration:
+    """バンドごとのずれ (4, 2)=(dy, dx) を補正してdatacubeの各バンドを基準バンドに合わせる
+    ずれはフレームによらず一定とみなし、フレームのまとまり(N, H, W, 4)に対して一度に線形補間で適用する"""
+    def __init__(self, shifts, reference=DEFAULT_REFERENCE):
+        self.shifts = np.asarray(shifts, dtype=np.float32).reshape(len(BAND_INDEX), 2)
+        self.reference = reference
+
+    @property
+    def key(self):
+        """キャッシュキーに含める文字列（ずれを0.01画素単位に丸めたハッシュ）"""
+        rounded = np.round(self.shifts, 2) + 0.0    # -0.0を0.0に揃える
+        return hashlib.sha1(rounded.tobytes()).hexdigest()[:12]
+
+    @property
+    def margin(self):
+        """補正で参照する上下の行数（タイル処理で読み足す行数）"""
+        return int(np.ceil(np.abs(self.shifts[:, 0]).max())) + 1
+
+    @property
+    def is_identity(self):
+        return not np.any(np.round(self.shifts, 2))
+
+    @classmethod
+    def estimate(cls, frames, reference=DEFAULT_REFERENCE, estimate_size=ESTIMATE_SIZE):
+        """フレーム (N, H, W, 4) からずれを推定（フレームごとの推定値の中央値）
+        縮小したバンド全体で大まかなずれを求め、中央の estimate_size 四方を元の解像度で照合して補正する"""
+        factor = pyramid_factors(frames.shape[1:3], estimate_size)[-1]
+        ref = BAND_INDEX[reference]
+        estimates = []
+        with span('estimate_registration', frames=len(frames)):
+            for frame in frames:
+                coarse = np.zeros((frame.shape[-1], 2), dtype=np.float32)
+                if factor > 1:
+                    edges = _edges(np.moveaxis(downsample(frame, factor), -1, 0))
+                    coarse = np.round(phase_correlation(edges[ref], edges) * factor)
+                estimates.append(coarse + cls._refine(frame, ref, coarse, estimate_size))
+        return cls(np.median(estimates, axis=0), reference)
+
+    @staticmethod
+    def _refine(frame, ref, coarse, size):
+        """大まかなずれだけ動かした中央の領域を元の解像度で照合し、残りのずれを求める"""
+        height, width = frame.shape[:2]
+        crop_h, crop_w = min(size, height), min(size, width)
+        y0, x0 = (height - crop_h) // 2, (width - crop_w) // 2
+        reference = _edges(frame[y0:y0 + crop_h, x0:x0 + crop_w, ref].astype(np.float32))
+        residual = np.zeros_like(coarse)
+        for channel, (dy, dx) in enumerate(coarse.astype(int)):
+            if channel == ref:
+                continue
+            top = int(np.clip(y0 + dy, 0, height - crop_h))
+            left = int(np.clip(x0 + dx, 0, width - crop_w))
+            moving = _edges(frame[top:top + crop_h, left:left + crop_w, channel].astype(np.float32))
+            residual[channel] = phase_correlation(reference, moving) + (top - y0 - dy, left - x0 - dx)
+        return residual
+
+    def apply(self, cube, out=None):
+        """datacube (H, W, 4) または (N, H, W, 4) のuint8を位置合わせして返す（範囲外は端の画素で補う）
+        補間の重みは全画素で共通なので、1/256単位の固定小数点でuint16のまま計算する"""
+        if out is None:
+            out = np.empty_like(cube)
+        for channel, (dy, dx) in enumerate(self.shifts):
+            if not np.round(dy, 2) and not np.round(dx, 2):
+                out[..., channel] = cube[..., channel]
+            else:
+                out[..., channel] = self._shift_band(cube[..., channel], float(dy), float(dx))
+        return out
+
+    @staticmethod
+    def _shift_band(band, dy, dx):
+        """out[y, x] = band[y + dy, x + dx] を双線形補間で求める"""
+        height, width = band.shape[-2:]
+        base_y, base_x = int(np.floor(dy)), int(np.floor(dx))
+        frac_y, frac_x = dy - base_y, dx - base_x
+        # 参照する範囲 [base, base + H + 1) が収まるように端の画素で広げる
+        top, left = max(-base_y, 0), max(-base_x, 0)
+        bottom, right = max(base_y + 2, 0), max(base_x + 2, 0)
+        padded = np.pad(band, [(0, 0)] * (band.ndim - 2) + [(top, bottom), (left, right)], mode='edge')
+        y0, x0 = base_y + top, base_x + left
+
+        taps = [((0, 0), (1 - frac_y) * (1 - frac_x)), ((0, 1), (1 - frac_y) * frac_x),
+                ((1, 0), frac_y * (1 - frac_x)), ((1, 1), frac_y * frac_x)]
+        weights = [int(round(weight * 256)) for _, weight in taps]
+        weights[int(np.argmax(weights))] += 256 - sum(weights)  # 合計を256に揃える
+        acc = None
+        term = None
+        for ((oy, ox), _), weight in zip(taps, weights):
+            if not weight:
+                continue
+            pixels = padded[..., y0 + oy:y0 + oy + height, x0 + ox:x0 + ox + width]
+            if weight == 256:
+                return pixels   # 整数画素のずれ
+            if acc is None:
+                acc = np.multiply(pixels, weight, dtype=np.uint16)
+                term = np.empty_like(acc)
+            else:
+                acc += np.multiply(pixels, weight, out=term, dtype=np.uint16)
+        acc += 128
+        acc >>= 8
+        return acc
+
+    def view(self, raw):
+        """rawを読み出し時に位置合わせするビュー（植生指数の計算にそのまま渡せる）"""
+        return RegisteredCube(raw, self)
+
+    def to_dict(self):
+        return {'shifts': self.shifts.tolist(), 'reference': self.reference}
+
+    @classmethod
+    def from_dict(cls, value):
+        return cls(value['shifts'], value.get('reference', DEFAULT_REFERENCE))
+
+
+class RegisteredCube:
+    """uint8のdatacube (N, H, W, 4) をフレーム単位で位置合わせして読み出すビュー"""
+    def __init__(self, raw, registration):
+        self.raw = raw
+        self.registration = registration
+
+    def __len__(self):
+        return len(self.raw)
+
+    @property
+    def shape(self):
+        return self.raw.shape
+
+    @property
+    def dtype(self):
+        return self.raw.dtype
+
+    def __getitem__(self, frames):
+        return self.registration.apply(self.raw[frames])
+
+
+class RegisteredTileSource:
+    """タイルの読み出し元（TiledFrameReaderなど）を位置合わせして読み出す
+    補正で参照する上下の行を読み足してから位置合わせし、タイルの範囲を切り出す"""
+    def __init__(self, source, registration):
+        self.source = source
+        self.registration = registration
+        self.band_shape = source.band_shape
+
+    def read_tile(self, y0, y1):
+        margin = self.registration.margin
+        top = max(y0 - margin, 0)
+        tile = self.registration.apply(self.source.read_tile(top, min(y1 + margin, self.band_shape[0])))
+        return tile[y0 - top:y1 - top]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if hasattr(self.source, 'close'):
+            self.source.close()
+
+
+def sample_frames(frame_count, samples=DEFAULT_SAMPLE_FRAMES):
+    """ずれの推定に使うフレーム番号（全体から等間隔に選ぶ）"""
+    return np.unique(np.linspace(0, frame_count - 1, min(samples, frame_count)).round().astype(int))
+
+
+def registration_key(paths, profile):
+    """フライト（フォルダ）とカメラ（バンド配置）ごとのキー（1つのフォルダ・カメラにつき1件だけ保存する）"""
+    return f"{profile.name}:{os.path.dirname(os.path.abspath(paths[0]))}"
+
+
+def source_signature(paths):
+    """推定に使ったフレームの [パス, 更新日時, サイズ]（保存済みのずれが古くなったかの判定に使う）"""
+    return [[os.path.abspath(p), os.stat(p).st_mtime_ns, os.stat(p).st_size] for p in paths]
+
+
+class ShiftCache:
+    """推定したずれをJSONファイルに保存し、同じフライト・カメラでは推定を省く
+    推定に使ったフレームを一緒に保存し、それらが変更・削除されていれば推定し直して置き換える
+    （フレームが追加されただけなら保存済みのずれをそのまま使う）"""
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _read(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, key):
+        """保存済みのBandRegistration（なければ、または推定に使ったフレームが変わっていればNone）"""
+        value = self._read().get(key)
+        if value is None:
+            return None
+        sources = [source for source, _, _ in value.get('sources', [])]
+        try:
+            if source_signature(sources) != value.get('sources', []):
+                return None
+        except OSError:
+            return None
+        return BandRegistration.from_dict(value)
+
+    def put(self, key, registration, sources=()):
+        """ずれを保存（同じキーの値は置き換える）。sourcesは推定に使ったフレームのパス"""
+        with self._lock:
+            entries = self._read()
+            entries[key] = dict(registration.to_dict(), sources=source_signature(sources))
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            with open(self.path, 'w', encoding='utf-8') as f:
+                json.dump(entries, f, indent=2)
+
+    def get_or_estimate(self, key, raw, samples=DEFAULT_SAMPLE_FRAMES, reference=DEFAULT_REFERENCE, paths=()):
+        """保存済みのずれを返し、なければrawの一部のフレームから推定して保存（pathsはrawの各フレームのファイル）"""
+        registration = self.get(key)
+        if registration is None:
+            frames = sample_frames(len(raw), samples)
+            registration = BandRegistration.estimate(raw[frames], reference)
+            self.put(key, registration, [paths[i] for i in frames] if len(paths) else ())
+        return registration
+
+
+def load_registration(paths, profile, scope='flight', shift_cache=None):
+    """保存済みのバンドのずれを読み込み、なければ一部のフレームをデコードして推定・保存
+    scopeが'flight'ならフォルダとカメラごと、'camera'ならカメラ（バンド配置）ごとに1つのずれを使う"""
+    from PIL import Image
+    from model.image_loader import split_bands
+    from model.datacube_store import DEFAULT_CACHE_DIR
+    shift_cache = shift_cache or ShiftCache(os.path.join(DEFAULT_CACHE_DIR, 'band_shifts.json'))
+    key = registration_key(paths, profile) if scope == 'flight' else profile.name
+    registration = shift_cache.get(key)
+    if registration is None:
+        sources = [paths[i] for i in sample_frames(len(paths))]
+        frames = []
+        for path in sources:
+            with Image.open(path) as img:
+                frames.append(split_bands(img, profile))
+        registration = BandRegistration.estimate(np.stack(frames))
+        shift_cache.put(key, registration, sources)
+    return registration
@@ -0,0 +1,245 @@
+import os
+import glob
+import json
+import time
+import queue
+import threading
+import numpy as np
+from PIL import Image
+from model.image_loader import split_bands
+from model.vegindex_engine import VegIndexEngine
+from model.sensor_profile import DEFAULT_PROFILE
+from model.tiled_processing import TiledFrameReader, TiledIndexProcessor
+from model.multispectral_img_model import COLORMAP_SETTINGS
+from model.index_stats import FlightStatistics
+from model.band_registration import RegisteredTileSource
+from model.colormap_lut import get_lut
+from model.index_codec import QuantizedIndex, make_codec, STORAGE_FORMATS
+from model.folder_watcher import IMAGE_EXTENSIONS
+
+OUTPUT_FORMATS = ('tif', 'npy', 'png')
+DEFAULT_QUEUE_SIZE = 4
+# 表示設定のない指数（SAVIなど）のカラーマップ設定
+DEFAULT_COLORMAP_SETTING = ('viridis', -1, 1, 0.2)
+# 量子化した植生指数のTIFFに書き込むタグ
+TIFF_TAG_IMAGE_DESCRIPTION = 270
+TIFF_TAG_SAMPLE_FORMAT = 339
+# ステージ終了の目印
+_END = object()
+
+
+def list_frames(folder, exclude=()):
+    """フォルダ内のTIFFフレームを名前順に列挙（パネル画像は除外）"""
+    exclude = {os.path.abspath(p) for p in exclude if p}
+    paths = sorted(glob.glob(os.path.join(folder, '*')))
+    return [p for p in paths
+            if p.lower().endswith(IMAGE_EXTENSIONS) and os.path.abspath(p) not in exclude]
+
+
+def index_path(out_dir, stem, index_name, fmt):
+    """植生指数の出力パス（フォルダがなければ作成）"""
+    index_dir = os.path.join(out_dir, index_name)
+    os.makedirs(index_dir, exist_ok=True)
+    return os.path.join(index_dir, f"{stem}.{fmt}")
+
+
+def write_scale_offset(path, values):
+    """int16に量子化した植生指数のnpyの横に scale/offset/nodata をJSONで保存（値 = 符号 * scale + offset）"""
+    if isinstance(values, QuantizedIndex) and values.codec.name == 'int16':
+        with open(os.path.splitext(path)[0] + '.json', 'w', encoding='utf-8') as f:
+            json.dump(values.codec.to_dict(), f)
+
+
+def write_index(out_dir, stem, index_name, values, fmt):
+    """1フレーム分の植生指数を指定形式で書き出す
+    量子化した植生指数（QuantizedIndex）はfloat32に戻さずに符号のまま書き出す
+    （npy・tifはint16の符号とscale/offset、float16のnpyはそのまま、pngは符号から直接カラーマップを引く）"""
+    path = index_path(out_dir, stem, index_name, fmt)
+    quantized = isinstance(values, QuantizedIndex)
+    if fmt == 'npy':
+        np.save(path, values.codes if quantized else values)
+        write_scale_offset(path, values)
+    elif fmt == 'tif':
+        if quantized and values.codec.name == 'int16':
+            # 符号付き16bit TIFF（SampleFormat=2）、scale/offsetはImageDescriptionにJSONで保存
+            Image.fromarray(np.ascontiguousarray(values.codes).view(np.uint16)).save(
+                path, tiffinfo={TIFF_TAG_IMAGE_DESCRIPTION: json.dumps(values.codec.to_dict()),
+                                TIFF_TAG_SAMPLE_FORMAT: 2})
+        else:
+            # 32bit浮動小数点TIFF（元フレームに位置情報がないためジオリファレンスなし、float16のTIFFは未対応）
+            Image.fromarray(np.ascontiguousarray(values, dtype=np.float32), mode='F').save(path)
+    elif fmt == 'png':
+        cmap, vmin, vmax, _ = COLORMAP_SETTINGS.get(index_name, DEFAULT_COLORMAP_SETTING)
+        rgba = get_lut(cmap, vmin, vmax).apply(values)
+        Image.fromarray(rgba, mode='RGBA').save(path, compress_level=1)
+    else:
+        raise ValueError(f"未対応の出力形式です: {fmt}")
+    return path
+
+
+class BatchPipeline:
+    """フレームを 読み込み→datacube→反射率→植生指数→書き出し の順にストリーム処理する
+    ステージ間は上限付きキューでつなぎ、同時にメモリ上にあるフレーム数を抑える
+    tile_rowsを指定するとフレームをタイル単位で読み込み・計算する（大きなフレーム用、npyは直接ファイルへ書き込む）
+    計算したフレームごとの統計量は self.statistics（FlightStatistics、フレーム番号はpathsの順）に集計する
+    registration（BandRegistration）を指定するとバンド分割の後、植生指数の計算の前にバンドの位置を合わせる
+    storageを'float16'・'int16'にすると計算後の植生指数を16bitに量子化して受け渡し・書き出す"""
+    def __init__(self, paths, out_dir, index_names, formats=('npy',), gains=None,
+                 queue_size=DEFAULT_QUEUE_SIZE, engine=None, profile=DEFAULT_PROFILE, tile_rows=None,
+                 registration=None, storage='float32'):
+        self.paths = list(paths)
+        self.out_dir = out_dir
+        self.index_names = list(index_names)
+        self.formats = list(formats)
+        self.gains = gains
+        self.queue_size = queue_size
+        self.engine = engine or VegIndexEngine()
+        self.profile = profile
+        self.tile_rows = tile_rows
+        self.registration = registration
+        self.statistics = FlightStatistics({name: settings[1:3] for name, settings in COLORMAP_SETTINGS.items()})
+        if storage not in STORAGE_FORMATS:
+            raise ValueError(f"未対応の保持形式です: {storage}")
+        self.codecs = {}
+        if storage != 'float32':
+            for name in self.index_names:
+                _, vmin, vmax, _ = COLORMAP_SETTINGS.get(name, DEFAULT_COLORMAP_SETTING)
+                self.codecs[name] = make_codec(storage, vmin, vmax)
+        for fmt in self.formats:
+            if fmt not in OUTPUT_FORMATS:
+                raise ValueError(f"未対応の出力形式です: {fmt}")
+        for name in self.index_names:
+            if name not in self.engine.formulas:
+                raise ValueError(f"未登録の植生指数です: {name}")
+
+    def run(self, progress=None):
+        """パイプラインを実行し、処理枚数・所要時間・frames/sを返す
+        progress(完了数, 総数) は呼び出し元のスレッドで呼ばれる"""
+        self._stop = threading.Event()
+        self._errors = []
+        decoded = queue.Queue(maxsize=self.queue_size)
+        computed = queue.Queue(maxsize=self.queue_size)
+        stages = [threading.Thread(target=self._guard, args=(self._read_stage, decoded), daemon=True),
+                  threading.Thread(target=self._guard, args=(self._compute_stage, decoded, computed), daemon=True)]
+
+        start = time.perf_counter()
+        for stage in stages:
+            stage.start()
+        done = self._write_stage(computed, progress)
+        for stage in stages:
+            stage.join()
+        seconds = time.perf_counter() - start
+
+        if self._errors:
+            raise self._errors[0]
+        return {'frames': done, 'seconds': seconds, 'fps': done / seconds if seconds else 0.0}
+
+    def _guard(self, stage, *queues):
+        """ステージの例外を記録し、後段に終了を伝える"""
+        try:
+            stage(*queues)
+        except Exception as e:
+            self._errors.append(e)
+            self._stop.set()
+            self._put(queues[-1], _END)
+
+    def _put(self, q, item):
+        """停止要求を確認しながらキューに投入（後段の異常終了で詰まらないように）"""
+        while True:
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                if self._stop.is_set():
+                    return
+
+    def _get(self, q):
+        """停止要求を確認しながらキューから取得（前段の異常終了で詰まらないように）"""
+        while True:
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                if self._stop.is_set():
+                    return _END
+
+    def _read_stage(self, out_q):
+        """画像をデコードしてバンド分割（タイル処理ではファイルを開くだけ）"""
+        for frame, path in enumerate(self.paths):
+            if self._stop.is_set():
+                break
+            if self.tile_rows:
+                source = TiledFrameReader(path, self.profile)
+                if self.registration is not None:
+                    source = RegisteredTileSource(source, self.registration)
+            else:
+                with Image.open(path) as img:
+                    source = split_bands(img, self.profile)
+                if self.registration is not None:
+                    source = self.registration.apply(source)
+            self._put(out_q, (frame, path, source))
+        self._put(out_q, _END)
+
+    def _compute_stage(self, in_q, out_q):
+        """反射率変換と植生指数の計算"""
+        while True:
+            item = self._get(in_q)
+            if item is _END:
+                break
+            frame, path, source = item
+            if self.tile_rows:
+                with source:
+                    indices = self._compute_tiled(frame, path, source)
+            else:
+                indices = self.engine.compute_chunk(source[np.newaxis], self.index_names, gains=self.gains)
+                indices = {name: values[0] for name, values in indices.items()}
+                for name, values in indices.items():
+                    self.statistics.add_frame(name, frame, values)
+                    if name in self.codecs:
+                        indices[name] = QuantizedIndex.encode(values, self.codecs[name])
+            self._put(out_q, (path, indices))
+        self._put(out_q, _END)
+
+    def _compute_tiled(self, frame, path, reader):
+        """タイル単位で計算し、npy出力はメモリマップで直接書き込む（統計量もタイルごとに集計）"""
+        outputs = {}
+        if 'npy' in self.formats:
+            stem = os.path.splitext(os.path.basename(path))[0]
+            outputs = {name: np.lib.format.open_memmap(index_path(self.out_dir, stem, name, 'npy'), mode='w+',
+                                                       dtype=self.codecs[name].dtype if name in self.codecs
+                                                       else np.float32, shape=reader.band_shape)
+                       for name in self.index_names}
+        processor = TiledIndexProcessor(self.index_names, gains=self.gains, tile_rows=self.tile_rows,
+                                        engine=self.engine)
+        stats = {name: self.statistics.new_stats(name) for name in self.index_names}
+        indices = processor.process(reader, outputs, stats, self.codecs)['indices']
+        for name, value in stats.items():
+            self.statistics.set_frame(name, frame, value)
+        for values in outputs.values():
+            values.flush()
+        return indices
+
+    def _write_stage(self, in_q, progress):
+        """植生指数をファイルに書き出す"""
+        done = 0
+        while True:
+            item = self._get(in_q)
+            if item is _END:
+                break
+            path, indices = item
+            try:
+                stem = os.path.splitext(os.path.basename(path))[0]
+                for name, values in indices.items():
+                    for fmt in self.formats:
+                        if fmt == 'npy' and self.tile_rows:
+                            # タイル処理では計算時に書き込み済み
+                            write_scale_offset(index_path(self.out_dir, stem, name, fmt), values)
+                            continue
+                        write_index(self.out_dir, stem, name, values, fmt)
+            except Exception as e:
+                self._errors.append(e)
+                self._stop.set()
+                break
+            done += 1
+            if progress:
+                progress(done, len(self.paths))
+        return done
@@ -0,0 +1,92 @@
+import threading
+import numpy as np
+from PIL import Image, ImageDraw
+from model.index_codec import QuantizedIndex
+
+LUT_SIZE = 256
+COLORBAR_HEIGHT = 50
+_lut_cache = {}
+
+
+def get_lut(cmap_name, vmin, vmax):
+    """(カラーマップ, 範囲)ごとのルックアップテーブルを取得（一度作成したものは再利用）"""
+    key = (cmap_name, vmin, vmax)
+    if key not in _lut_cache:
+        _lut_cache[key] = ColormapLUT(cmap_name, vmin, vmax)
+    return _lut_cache[key]
+
+
+class ColormapLUT:
+    """カラーマップを事前計算したRGBAテーブルで植生指数をRGBA画像に変換する"""
+    def __init__(self, cmap_name, vmin, vmax, size=LUT_SIZE):
+        self.cmap_name = cmap_name
+        self.vmin = vmin
+        self.vmax = vmax
+        self.size = size
+        import matplotlib   # カラーマップの定義のみ使用（起動時に読み込まないように）
+        cmap = matplotlib.colormaps[cmap_name]
+        # 最終行はNaN（ゼロ除算など）用の色
+        self.table = np.empty((size + 1, 4), dtype=np.uint8)
+        self.table[:size] = cmap(np.linspace(0, 1, size), bytes=True)
+        self.table[size] = cmap.get_bad() * 255
+        self._buffers = {}
+        self._code_tables = {}  # 量子化の設定 -> 16bitの符号ごとのRGBA (65536, 4)
+        self._lock = threading.Lock()   # 作業用バッファを先読みスレッドと共有するため
+
+    def _buffer(self, shape):
+        """フレームサイズごとの作業用バッファ（毎フレームの確保を避ける）"""
+        if shape not in self._buffers:
+            self._buffers[shape] = (np.empty(shape, dtype=np.float32), np.empty(shape, dtype=np.intp))
+        return self._buffers[shape]
+
+    def to_lut_index(self, values):
+        """植生指数の値をテーブルの行番号に変換"""
+        work, index = self._buffer(values.shape)
+        np.subtract(values, self.vmin, out=work)
+        np.multiply(work, self.size / (self.vmax - self.vmin), out=work)
+        np.clip(work, 0, self.size - 1, out=work)
+        np.copyto(work, self.size, where=np.isnan(work))
+        np.copyto(index, work, casting='unsafe')
+        return index
+
+    def code_table(self, codec):
+        """量子化した植生指数の符号ごとのRGBA（符号の値を1度だけテーブルの行番号に変換して作成）"""
+        key = tuple(sorted(codec.to_dict().items()))
+        if key not in self._code_tables:
+            values = codec.code_values()
+            with np.errstate(invalid='ignore'):     # float16のNaN・無限大の符号
+                index = np.clip((values - self.vmin) * (self.size / (self.vmax - self.vmin)), 0,
+                                self.size - 1)
+            index[np.isnan(values)] = self.size
+            self._code_tables[key] = self.table[index.astype(np.intp)]
+        return self._code_tables[key]
+
+    def apply(self, values, out=None):
+        """植生指数(H, W)をRGBA画像(H, W, 4)のuint8配列に変換
+        量子化した植生指数（QuantizedIndex）はfloat32に戻さず、符号から直接RGBAを引く"""
+        with self._lock:
+            if isinstance(values, QuantizedIndex):
+                return np.take(self.code_table(values.codec), values.code_index, axis=0, out=out)
+            return np.take(self.table, self.to_lut_index(values), axis=0, out=out)
+
+    def to_image(self, values):
+        """植生指数をPIL画像に変換"""
+        return Image.fromarray(self.apply(values)[:, :, :3], mode='RGB')
+
+    def colorbar_image(self, width, tick_interval, height=COLORBAR_HEIGHT, background=(43, 43, 43)):
+        """横向きのカラーバー画像（目盛り付き）を作成"""
+        bar_height = height // 2
+        img = Image.new('RGB', (width, height), background)
+        gradient = self.table[np.linspace(0, self.size - 1, width).astype(np.intp), :3]
+        img.paste(Image.fromarray(np.repeat(gradient[np.newaxis], bar_height, axis=0), mode='RGB'), (0, 0))
+
+        draw = ImageDraw.Draw(img)
+        ticks = np.arange(self.vmin, self.vmax + tick_interval / 2, tick_interval)
+        for tick in ticks:
+            x = int(round((tick - self.vmin) / (self.vmax - self.vmin) * (width - 1)))
+            draw.line([(x, bar_height), (x, bar_height + 4)], fill=(220, 220, 220))
+            label = f"{tick:g}" if abs(tick) > 1e-9 else "0"
+            text_width = draw.textlength(label)
+            text_x = min(max(0, x - text_width / 2), width - text_width)
+            draw.text((text_x, bar_height + 6), label, fill=(220, 220, 220))
+        return img
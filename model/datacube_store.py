@@ -0,0 +1,266 @@
+import os
+import glob
+import json
+import uuid
+import hashlib
+from datetime import datetime
+import numpy as np
+from PIL import Image
+from model.image_loader import DEFAULT_WORKERS, split_bands, load_frames
+from model.sensor_profile import DEFAULT_PROFILE
+from model.instrumentation import traced, count
+
+# メモリマップファイルを置くキャッシュディレクトリ
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'multispectral-app')
+TIFF_TAG_DATETIME = 306
+# キャッシュディレクトリに残すメモリマップファイル（フォルダ）の数
+MAX_STORES = 3
+
+
+def _cache_variant(profile):
+    """キャッシュキーに含める値（既定以外のバンド配置は別のdatacubeになるため）"""
+    return '' if profile is DEFAULT_PROFILE else profile.key
+
+
+def prune_stores(cache_dir, keep=(), max_stores=MAX_STORES):
+    """古いメモリマップファイルを削除し、直近max_stores個のフォルダ分のみ残す"""
+    metas = sorted(glob.glob(os.path.join(cache_dir, '*.json')), key=os.path.getmtime, reverse=True)
+    for meta_path in metas[max_stores:]:
+        key = os.path.splitext(os.path.basename(meta_path))[0]
+        if key in keep:
+            continue
+        for path in (os.path.join(cache_dir, f"{key}.npy"), meta_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass    # 使用中（Windowsでメモリマップ中など）の場合は次回に削除
+
+
+class DatacubeStore:
+    """全フレームの放射輝度(uint8)を1つの(N, H, W, 4)配列として保持
+    パス指定時はキャッシュディレクトリのメモリマップファイルに書き込み、次回起動時に再利用する"""
+    def __init__(self, raw, paths=None, data_path=None, frame_keys=None, profile=DEFAULT_PROFILE):
+        self.raw = raw
+        self.profile = profile  # バンドの配置（SensorProfile）
+        self.paths = paths or []
+        self.data_path = data_path
+        self.frame_keys = frame_keys    # フレームごとのディスクキャッシュのキー（ProcessedCache使用時）
+        self._buffer = raw  # 追加読み込み用の領域（rawはその先頭len(self)フレーム分）
+
+    def __len__(self):
+        return self.raw.shape[0]
+
+    @property
+    def frame_shape(self):
+        """1フレームのdatacubeの形状 (H, W, 4)"""
+        return self.raw.shape[1:]
+
+    def capture_times(self, frames=None):
+        """各フレーム（framesを渡すとその番号のフレーム）の撮影時刻（UNIX時刻[秒]）
+        TIFFのDateTimeタグがなければ更新日時を使用"""
+        frames = range(len(self)) if frames is None else frames
+        if not self.paths:
+            return np.array(frames, dtype=np.float64)
+        times = []
+        for path in [self.paths[i] for i in frames]:
+            with Image.open(path) as img:
+                stamp = img.getexif().get(TIFF_TAG_DATETIME)
+            try:
+                times.append(datetime.strptime(stamp, '%Y:%m:%d %H:%M:%S').timestamp())
+            except (TypeError, ValueError):
+                times.append(os.path.getmtime(path))
+        return np.array(times)
+
+    def append(self, paths, workers=DEFAULT_WORKERS, progress=None, frame_cache=None,
+               cache_dir=DEFAULT_CACHE_DIR):
+        """フレームを末尾に追加（既存のフレームは再デコードしない）
+        領域が足りない場合は容量を倍に広げた配列へ移すため、追加のコストは1フレームあたり一定"""
+        paths = [os.path.abspath(p) for p in paths]
+        if not paths:
+            return range(len(self), len(self))
+        start = len(self)
+        end = start + len(paths)
+        if end > self._buffer.shape[0]:
+            self._grow(max(end, 2 * self._buffer.shape[0]), cache_dir)
+        new_keys = [frame_cache.frame_key(p, _cache_variant(self.profile)) for p in paths] if frame_cache else None
+
+        missing = list(range(len(paths)))
+        if frame_cache:
+            missing = []
+            for i, frame_key in enumerate(new_keys):
+                datacube = frame_cache.load_datacube(frame_key)
+                if datacube is not None and datacube.shape == self.frame_shape:
+                    self._buffer[start + i] = datacube
+                else:
+                    missing.append(i)
+        load_frames(self._buffer, [paths[i] for i in missing], workers, progress,
+                    size=self.profile.image_size(self.frame_shape[:2]), indices=[start + i for i in missing],
+                    profile=self.profile)
+        count('frames_decoded', len(missing))
+        if frame_cache:
+            for i in missing:
+                frame_cache.save_datacube(new_keys[i], self._buffer[start + i])
+
+        # 書き込みが終わってから公開（先読みスレッドが未完成のフレームを読まないように）
+        self.paths = self.paths + paths
+        if self.frame_keys is not None or new_keys is not None:
+            self.frame_keys = (self.frame_keys or [None] * start) + (new_keys or [None] * len(paths))
+        self.raw = self._buffer[:end]
+        return range(start, end)
+
+    def _grow(self, capacity, cache_dir):
+        """追加用の領域をcapacityフレーム分に広げる（パス指定のストアはメモリマップファイルに確保）"""
+        shape = (capacity,) + self.frame_shape
+        if self.data_path is None:
+            buffer = np.empty(shape, dtype=np.uint8)
+        else:
+            # 元のキャッシュファイルはフォルダ全体の署名に対応するため変更せず、一時ファイルに移す
+            os.makedirs(cache_dir, exist_ok=True)
+            growth_path = os.path.join(cache_dir, f"append-{uuid.uuid4().hex[:16]}.npy")
+            buffer = np.lib.format.open_memmap(growth_path, mode='w+', dtype=np.uint8, shape=shape)
+            try:
+                os.remove(growth_path)  # マップ済みの領域は閉じるまで有効（残るのは削除できないOSのみ）
+            except OSError:
+                pass
+        buffer[:len(self)] = self.raw
+        self._buffer = buffer
+        self.raw = buffer[:len(self)]
+
+    @classmethod
+    def from_images(cls, imgs, profile=DEFAULT_PROFILE):
+        """PIL画像のリストからメモリ上のストアを作成"""
+        first = split_bands(imgs[0], profile)
+        raw = np.empty((len(imgs),) + first.shape, dtype=np.uint8)
+        raw[0] = first
+        for i, img in enumerate(imgs[1:], start=1):
+            raw[i] = split_bands(img, profile)
+        return cls(raw, profile=profile)
+
+    @classmethod
+    @traced('create_datacube')
+    def open(cls, paths, cache_dir=DEFAULT_CACHE_DIR, workers=DEFAULT_WORKERS, progress=None,
+             use_processes=False, frame_cache=None, profile=DEFAULT_PROFILE, on_ready=None, cancel=None):
+        """画像パスのリストからストアを開く（キャッシュが有効ならデコードせずに再利用）
+        キャッシュミス時はworkers数のプールで並列にデコードし、progress(完了数, 総数)で進捗を通知
+        frame_cache(ProcessedCache)を渡すと、フォルダに変更があっても変更のないフレームはそこから読み込む
+        バンドの配置はprofile（SensorProfile）に従う
+        on_ready(store) は先頭から連続して読み込み済みのフレームが増えるたびに呼ばれ、storeはその枚数分を見せる
+        cancel（threading.Event）がセットされると読み込みを中止してCancelledErrorを送出する
+        キャッシュの判定はパス・更新日時・サイズのみで行い、内容のハッシュ（フレームのキー）は
+        キャッシュミス時に計算してメタデータに保存する（ヒット時はファイルを読まない）"""
+        paths = [os.path.abspath(p) for p in paths]
+        variant = _cache_variant(profile)
+        signature = [[p, os.stat(p).st_mtime_ns, os.stat(p).st_size] for p in paths]
+        if variant:
+            signature.append(variant)
+        key = hashlib.sha1(json.dumps(signature).encode('utf-8')).hexdigest()[:16]
+        os.makedirs(cache_dir, exist_ok=True)
+        data_path = os.path.join(cache_dir, f"{key}.npy")
+        meta_path = os.path.join(cache_dir, f"{key}.json")
+
+        # キャッシュヒット：メモリマップで開くだけ
+        if os.path.exists(data_path) and os.path.exists(meta_path):
+            with open(meta_path, encoding='utf-8') as f:
+                meta = json.load(f)
+            if meta.get('signature') == signature:
+                raw = np.load(data_path, mmap_mode='r')
+                count('datacube_store_hit')
+                frame_keys = None
+                if frame_cache:
+                    # 古いメタデータ（フレームのキーなし）の場合のみ内容のハッシュを計算
+                    frame_keys = meta.get('frame_keys') or [frame_cache.frame_key(p, variant) for p in paths]
+                if progress:
+                    progress(len(paths), len(paths))
+                store = cls(raw, paths, data_path, frame_keys, profile)
+                if on_ready:
+                    on_ready(store)
+                return store
+
+        # キャッシュミス：デコードしてメモリマップファイルに直接書き込む
+        frame_keys = [frame_cache.frame_key(p, variant) for p in paths] if frame_cache else None
+        with Image.open(paths[0]) as img:
+            size = img.size
+        shape = (len(paths),) + profile.band_shape(size) + (profile.band_count,)
+        raw = np.lib.format.open_memmap(data_path, mode='w+', dtype=np.uint8, shape=shape)
+        count('datacube_store_miss')
+        count('bytes_allocated', raw.nbytes)
+
+        # 読み込み中は先頭から連続して完了したフレームのみを見せる
+        store = cls(raw, paths, data_path, frame_keys, profile)
+        store.raw = raw[:0]
+        completed = np.zeros(len(paths), dtype=bool)
+
+        def frames_done(frames):
+            completed[frames] = True
+            ready = len(paths) if completed.all() else int(np.argmin(completed))
+            if ready > len(store):
+                store.raw = raw[:ready]
+                if on_ready:
+                    on_ready(store)
+
+        # フレーム単位のキャッシュにあるものは読み込むだけ、新規・変更フレームのみデコード
+        missing = list(range(len(paths)))
+        if frame_cache:
+            missing = []
+            for i, frame_key in enumerate(frame_keys):
+                datacube = frame_cache.load_datacube(frame_key)
+                if datacube is not None and datacube.shape == shape[1:]:
+                    raw[i] = datacube
+                    completed[i] = True
+                else:
+                    missing.append(i)
+        cached = len(paths) - len(missing)
+        frames_done([])
+        frame_progress = (lambda done, total: progress(cached + done, len(paths))) if progress else None
+        load_frames(raw, [paths[i] for i in missing], workers, frame_progress, size=size,
+                    use_processes=use_processes, data_path=data_path, indices=missing, profile=profile,
+                    on_frame=frames_done, cancel=cancel)
+        count('frames_decoded', len(missing))
+        raw.flush()
+        if frame_cache:
+            for i in missing:
+                frame_cache.save_datacube(frame_keys[i], raw[i])
+            frame_cache.evict()
+
+        # 書き込み完了後にメタデータを保存（途中で中断したキャッシュは使わない）
+        with open(meta_path, 'w', encoding='utf-8') as f:
+            json.dump({'signature': signature, 'shape': list(shape), 'frame_keys': frame_keys}, f)
+        prune_stores(cache_dir, keep={key})
+        return store
+
+
+class DatacubeView:
+    """DatacubeStoreをfloat32のdatacubeリストとして見せるビュー
+    gainsを指定すると読み出し時にバンドごとの校正係数を掛け、registration（BandRegistration）でバンドの位置を合わせる"""
+    def __init__(self, store, gains=None, registration=None):
+        self.store = store
+        self.gains = None if gains is None else np.asarray(gains, dtype=np.float32)
+        self.registration = registration
+
+    def __len__(self):
+        return len(self.store)
+
+    def __getitem__(self, frame):
+        if isinstance(frame, slice):
+            return [self[i] for i in range(*frame.indices(len(self)))]
+        return self.get(frame)
+
+    def get(self, frame, out=None):
+        """float32のdatacubeを返す（outを渡すと新たな配列を確保せずに書き込む）"""
+        raw = self.store.raw[frame]
+        if self.registration is not None:
+            raw = self.registration.apply(raw)
+        gains = self.gains
+        if gains is not None and gains.ndim == 2:
+            gains = gains[frame]    # フレームごとの係数
+        if gains is None:
+            if out is None:
+                return raw.astype(np.float32)
+            np.copyto(out, raw)
+            return out
+        # uint8からfloat32への変換と校正係数の乗算を1回で行う
+        return np.multiply(raw, gains, out=out, dtype=np.float32)
+
+    def __iter__(self):
+        for frame in range(len(self)):
+            yield self[frame]
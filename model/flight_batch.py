@@ -0,0 +1,343 @@
+import os
+import json
+import time
+import hashlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+from PIL import Image
+from model.image_loader import load_frames
+from model.datacube_store import DatacubeStore
+from model.sensor_profile import DEFAULT_PROFILE, SensorProfile, get_profile
+from model.multispectral_img_model import MultispectralImgModel, measure_panel_brightness, COLORMAP_SETTINGS
+from model.batch_pipeline import list_frames, write_index
+from model.band_registration import BandRegistration, load_registration
+from model.index_stats import FlightStatistics
+
+# 1つのワーカーにまとめて渡すフレーム数（ワーカーのメモリはおよそこのフレーム数のdatacubeで決まる）
+DEFAULT_SHARD_FRAMES = 16
+# 失敗したシャードを再実行する回数
+DEFAULT_RETRIES = 1
+# ワーカー1つあたりの固定のメモリ（インタプリタ・numpy・PILなど）
+WORKER_OVERHEAD = 256 * 1024 ** 2
+# 1画素あたりの作業メモリ（植生指数の計算中の一時配列、float32で数枚分）
+WORK_BYTES_PER_PIXEL = 4 * 4
+# 空きメモリが分からない場合のメモリ上限
+FALLBACK_MEMORY_BUDGET = 2 * 1024 ** 3
+# フォルダごとの結果と全体の集計のファイル名
+RESULT_FILE = 'result.json'
+SUMMARY_FILE = 'run_summary.json'
+
+
+def load_manifest(path):
+    """フライトの一覧（JSON）を読み込む
+    [{"folder": フォルダ, "panel": パネル画像, "roi": [x0, y0, x1, y1], "name": 出力名, "profile": プロファイル名}, ...]
+    panel以下は省略可、相対パスはマニフェストのフォルダからのパス、nameの省略時はフォルダ名"""
+    with open(path, encoding='utf-8') as f:
+        entries = json.load(f)
+    base = os.path.dirname(os.path.abspath(path))
+    flights = []
+    for entry in entries:
+        folder = os.path.join(base, entry['folder'])
+        panel = os.path.join(base, entry['panel']) if entry.get('panel') else None
+        if panel and not entry.get('roi'):
+            raise ValueError(f"パネル画像を指定した場合はroiも指定してください: {entry['folder']}")
+        flights.append({'name': entry.get('name') or os.path.basename(os.path.normpath(folder)),
+                        'folder': folder,
+                        'panel': panel,
+                        'roi': entry.get('roi'),
+                        'profile': entry.get('profile', DEFAULT_PROFILE.name)})
+    names = [flight['name'] for flight in flights]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"出力名が重複しています（nameを指定してください）: {', '.join(duplicates)}")
+    return flights
+
+
+def available_cores():
+    """このプロセスが使えるCPUコア数"""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def available_memory():
+    """空きメモリ（バイト、取得できない場合はNone）"""
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def worker_memory(frame_shape, shard_frames, index_count):
+    """ワーカー1つが使うメモリの見積もり（シャードのdatacubeと1フレーム分の植生指数の計算）"""
+    pixels = frame_shape[0] * frame_shape[1]
+    return (shard_frames * int(np.prod(frame_shape)) + pixels * WORK_BYTES_PER_PIXEL * (index_count + 1)
+            + WORKER_OVERHEAD)
+
+
+def plan_workers(frame_shape, shard_frames, index_count, memory_budget=None, max_workers=None):
+    """使えるコア数とメモリ上限からワーカー数を決める（少なくとも1）
+    memory_budgetの省略時は空きメモリの半分"""
+    if memory_budget is None:
+        free = available_memory()
+        memory_budget = free // 2 if free else FALLBACK_MEMORY_BUDGET
+    by_memory = memory_budget // worker_memory(frame_shape, shard_frames, index_count)
+    return int(max(1, min(available_cores(), by_memory, max_workers or available_cores())))
+
+
+def process_shard(task):
+    """ワーカープロセスで1つのシャード（1フライトの連続したフレーム）をGUIなしで処理する
+    MultispectralImgModelで植生指数を計算して書き出し、フレームごとの統計量を返す
+    （FlightStatisticsはロックを持つためプロセス間で渡せず、IndexStatsの辞書で返す）"""
+    profile = SensorProfile.from_dict(task['profile'])   # JSONから読み込んだプロファイルもワーカーで使えるように
+    paths = task['paths']
+    raw = np.empty((len(paths),) + tuple(task['frame_shape']), dtype=np.uint8)
+    load_frames(raw, paths, workers=1, size=tuple(task['image_size']), profile=profile)
+
+    model = MultispectralImgModel(datacube_store=DatacubeStore(raw, paths, profile=profile),
+                                  index_storage=task['storage'])
+    if task['registration'] is not None:
+        model.set_registration(BandRegistration.from_dict(task['registration']))
+    if task['panel_brightness'] is not None:
+        model.panel_brightness = task['panel_brightness']
+        model.convert_to_reflectance()
+
+    stats = {}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for local, (frame, path) in enumerate(zip(task['frames'], paths)):
+            stem = os.path.splitext(os.path.basename(path))[0]
+            for name in task['index_names']:
+                values = model.compute_index(name, local)
+                for fmt in task['formats']:
+                    write_index(task['out_dir'], stem, name, values, fmt)
+                stats[(name, frame)] = model.statistics.frame_stats(name, local)
+    return stats
+
+
+class _Flight:
+    """実行中のフライト（フォルダ）1つ分の状態"""
+    def __init__(self, entry, out_dir, signature):
+        self.entry = entry
+        self.out_dir = out_dir
+        self.signature = signature
+        self.paths = []
+        self.remaining = 0
+        self.retries = 0
+        self.errors = []
+        self.failed_frames = []
+        self.statistics = None
+        self.started = None
+
+
+class FlightBatchRunner:
+    """複数のフライト（フォルダ）のフレームをシャードに分け、プロセスプールで並列に処理する
+    パネルの放射輝度とバンドのずれはフォルダごとに親プロセスで1回だけ求めてワーカーに渡す
+    出力: out_dir/フライト名/指数名/フレーム名.形式、フライトごとの stats.csv/json と result.json、
+    全体の run_summary.json（処理速度・失敗・再実行の回数）
+    resume=Trueなら、同じ設定・同じフレームで完了済みのフォルダは処理しない"""
+    def __init__(self, entries, out_dir, index_names, formats=('npy',), storage='float32', register=None,
+                 workers=None, memory_budget=None, shard_frames=DEFAULT_SHARD_FRAMES,
+                 max_retries=DEFAULT_RETRIES, resume=True):
+        self.entries = list(entries)
+        self.out_dir = out_dir
+        self.index_names = list(index_names)
+        self.formats = list(formats)
+        self.storage = storage
+        self.register = register    # バンドの位置合わせ（None・'flight'・'camera'）
+        self.max_workers = workers
+        self.memory_budget = memory_budget
+        self.shard_frames = shard_frames
+        self.max_retries = max_retries
+        self.resume = resume
+        self.workers = None
+
+    def flight_signature(self, entry, paths):
+        """フォルダの処理内容を表すハッシュ（フレームのファイル・パネル・出力設定が同じなら一致）"""
+        frames = [(os.path.basename(path), os.path.getsize(path), int(os.path.getmtime(path))) for path in paths]
+        settings = {'entry': {key: entry[key] for key in ('folder', 'panel', 'roi', 'profile')},
+                    'frames': frames, 'indices': self.index_names, 'formats': self.formats,
+                    'storage': self.storage, 'register': self.register}
+        return hashlib.sha1(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def read_result(flight_dir):
+        try:
+            with open(os.path.join(flight_dir, RESULT_FILE), encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def run(self, progress=None):
+        """全フライトを処理して集計結果を返す（progress(完了フレーム数, 総フレーム数) は親プロセスで呼ばれる）"""
+        start = time.perf_counter()
+        os.makedirs(self.out_dir, exist_ok=True)
+        results = []
+        flights = []
+        for entry in self.entries:
+            flight_dir = os.path.join(self.out_dir, entry['name'])
+            paths = list_frames(entry['folder'], exclude=[entry['panel']])
+            signature = self.flight_signature(entry, paths)
+            previous = self.read_result(flight_dir)
+            if (self.resume and previous and previous.get('status') == 'done'
+                    and previous.get('signature') == signature):
+                results.append(dict(previous, status='skipped'))
+                continue
+            flight = _Flight(entry, flight_dir, signature)
+            flight.paths = paths
+            try:
+                self._prepare(flight)
+            except Exception as error:
+                flight.errors.append(f"{type(error).__name__}: {error}")
+                results.append(self._finish(flight, start))
+                continue
+            flights.append(flight)
+
+        tasks = [task for flight in flights for task in self._shards(flight)]
+        total = sum(len(task['paths']) for task in tasks)
+        if tasks:
+            self.workers = plan_workers(max((task['frame_shape'] for task in tasks), key=np.prod),
+                                        self.shard_frames, len(self.index_names), self.memory_budget,
+                                        min(self.max_workers or len(tasks), len(tasks)))
+            results.extend(self._execute(flights, tasks, total, progress, start))
+        return self._write_summary(results, time.perf_counter() - start)
+
+    def _prepare(self, flight):
+        """フレームの大きさ・パネルの放射輝度・バンドのずれを求める（親プロセスで1回だけ）"""
+        entry = flight.entry
+        if not flight.paths:
+            raise FileNotFoundError(f"フレーム画像が見つかりません: {entry['folder']}")
+        profile = flight.profile = get_profile(entry['profile'])
+        with Image.open(flight.paths[0]) as img:
+            flight.image_size = img.size
+        flight.frame_shape = profile.band_shape(flight.image_size) + (len(profile.positions),)
+        flight.panel_brightness = None
+        if entry['panel']:
+            with Image.open(entry['panel']) as panel_img:
+                flight.panel_brightness = measure_panel_brightness(panel_img, entry['roi'], profile)
+        flight.registration = None
+        if self.register:
+            flight.registration = load_registration(flight.paths, profile, self.register).to_dict()
+        flight.statistics = FlightStatistics({name: settings[1:3] for name, settings in COLORMAP_SETTINGS.items()})
+
+    def _shards(self, flight):
+        """フライトのフレームを shard_frames ずつのタスクに分ける"""
+        tasks = []
+        for begin in range(0, len(flight.paths), self.shard_frames):
+            end = min(begin + self.shard_frames, len(flight.paths))
+            tasks.append({'flight': flight, 'attempts': 0,
+                          'paths': flight.paths[begin:end], 'frames': list(range(begin, end)),
+                          'image_size': flight.image_size, 'frame_shape': flight.frame_shape,
+                          'profile': flight.profile.to_dict(), 'out_dir': flight.out_dir,
+                          'index_names': self.index_names, 'formats': self.formats, 'storage': self.storage,
+                          'panel_brightness': flight.panel_brightness, 'registration': flight.registration})
+        flight.remaining = len(tasks)
+        return tasks
+
+    @staticmethod
+    def _payload(task):
+        """ワーカーに渡す部分（フライトの状態は親プロセスに残す）"""
+        return {key: value for key, value in task.items() if key not in ('flight', 'attempts')}
+
+    def _execute(self, flights, tasks, total, progress, start):
+        """シャードをプロセスプールで実行（失敗したシャードは max_retries 回まで再実行）
+        ワーカーが異常終了してプールが使えなくなった場合は、プールを作り直して実行中のシャードを再実行する"""
+        results = []
+        queue = deque(tasks)
+        running = {}
+        done_frames = 0
+        executor = ProcessPoolExecutor(self.workers)
+        try:
+            while queue or running:
+                # 先読みとして各ワーカーに2つまで渡す（シャードのdatacubeは各ワーカーの中でのみ作成）
+                while queue and len(running) < self.workers * 2:
+                    task = queue.popleft()
+                    task['flight'].started = task['flight'].started or time.perf_counter()
+                    running[executor.submit(process_shard, self._payload(task))] = task
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                broken = False
+                for future in finished:
+                    task = running.pop(future)
+                    flight = task['flight']
+                    try:
+                        stats = future.result()
+                    except Exception as error:
+                        broken = broken or isinstance(error, BrokenProcessPool)
+                        if self._retry(task, error, queue):
+                            continue
+                        flight.failed_frames.extend(task['frames'])
+                    else:
+                        for (name, frame), frame_stats in stats.items():
+                            flight.statistics.set_frame(name, frame, frame_stats)
+                    flight.remaining -= 1
+                    done_frames += len(task['paths'])
+                    if progress:
+                        progress(done_frames, total)
+                    if not flight.remaining:
+                        results.append(self._finish(flight, start))
+                if broken:
+                    # 残りの実行中のシャードも同じ理由で失敗するため、プールを作り直して再実行
+                    for task in running.values():
+                        self._retry(task, BrokenProcessPool('プロセスプールが停止しました'), queue)
+                    running.clear()
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    executor = ProcessPoolExecutor(self.workers)
+        finally:
+            executor.shutdown(cancel_futures=True)
+        return results
+
+    def _retry(self, task, error, queue):
+        """再実行できればキューに戻してTrue、上限に達していればエラーを記録してFalse"""
+        flight = task['flight']
+        message = f"frames {task['frames'][0]}-{task['frames'][-1]}: {type(error).__name__}: {error}"
+        if task['attempts'] < self.max_retries:
+            task['attempts'] += 1
+            flight.retries += 1
+            queue.append(task)
+            return True
+        flight.errors.append(message)
+        return False
+
+    def _finish(self, flight, start):
+        """フライトの統計量と結果（result.json）を書き出す"""
+        os.makedirs(flight.out_dir, exist_ok=True)
+        frames = len(flight.paths) - len(flight.failed_frames) if flight.statistics else 0
+        seconds = time.perf_counter() - (flight.started or start)
+        if flight.statistics and frames:
+            flight.statistics.export_csv(os.path.join(flight.out_dir, 'stats.csv'))
+            flight.statistics.export_json(os.path.join(flight.out_dir, 'stats.json'),
+                                          frame_names=[os.path.basename(path) for path in flight.paths])
+        result = {'name': flight.entry['name'],
+                  'folder': flight.entry['folder'],
+                  'status': 'failed' if flight.errors else 'done',
+                  'signature': flight.signature,
+                  'frames': frames,
+                  'failed_frames': sorted(flight.failed_frames),
+                  'retries': flight.retries,
+                  'errors': flight.errors,
+                  'seconds': seconds,
+                  'fps': frames / seconds if seconds > 0 else 0.0}
+        with open(os.path.join(flight.out_dir, RESULT_FILE), 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+        return result
+
+    def _write_summary(self, results, seconds):
+        processed = [result for result in results if result['status'] != 'skipped']
+        frames = sum(result['frames'] for result in processed)
+        summary = {'flights': len(results),
+                   'done': sum(result['status'] == 'done' for result in results),
+                   'failed': sum(result['status'] == 'failed' for result in results),
+                   'skipped': sum(result['status'] == 'skipped' for result in results),
+                   'workers': self.workers,
+                   'frames': frames,
+                   'seconds': seconds,
+                   'fps': frames / seconds if seconds > 0 else 0.0,
+                   'retries': sum(result['retries'] for result in processed),
+                   'failures': [{'name': result['name'], 'errors': result['errors'],
+                                 'failed_frames': result['failed_frames']}
+                                for result in processed if result['status'] == 'failed'],
+                   'results': results}
+        with open(os.path.join(self.out_dir, SUMMARY_FILE), 'w', encoding='utf-8') as f:
+            json.dump(summary, f, indent=2, ensure_ascii=False)
+        return summary
@@ -0,0 +1,254 @@
+import os
+from datetime import datetime
+import numpy as np
+from PIL import Image
+from model.index_store import IndexStore, DEFAULT_MEMORY_BUDGET
+from model.index_stats import FlightStatistics
+from model.colormap_lut import get_lut
+from model.instrumentation import span, traced
+from model.multispectral_img_model import COLORMAP_SETTINGS
+
+# フレームの対応付けの方法（名前・撮影時刻・フレーム番号）
+# 対応するフレームが少ない場合に次を試す順（フレーム番号は常に対応するため最後）
+MATCH_MODES = ('name', 'time', 'index')
+# 対応付けを採用する最小の対応数（短い方のフライトのフレーム数に対する割合、下回れば次の方法を試す）
+MIN_MATCH_FRACTION = 0.5
+# 比較の方法（差 = 基準 - 比較対象、比 = 基準 / 比較対象）
+DIFFERENCE_MODES = ('diff', 'ratio')
+# 撮影時刻で対応付ける場合の許容差（秒）と1日の秒数（時刻は日付を除いて比べる）
+DEFAULT_TIME_TOLERANCE = 2.0
+SECONDS_PER_DAY = 24 * 60 * 60
+# 差・比のカラーマップ（0・1を中心に、減少が赤・増加が青）と比の表示範囲
+DIFFERENCE_CMAP = 'RdBu'
+RATIO_SETTING = (DIFFERENCE_CMAP, 0.0, 2.0, 0.2)
+# 対応するフレームがない場合の表示色
+UNMATCHED_COLOR = (64, 64, 64)
+
+
+def frame_names(store):
+    """ストアの各フレームの名前（拡張子を除いたファイル名、パスがなければ番号）"""
+    if not store.paths:
+        return [str(frame) for frame in range(len(store))]
+    return [os.path.splitext(os.path.basename(path))[0] for path in store.paths]
+
+
+def time_of_day(times):
+    """UNIX時刻[秒]の配列を現地時刻の0時からの秒数に変換"""
+    stamps = [datetime.fromtimestamp(t) for t in times]
+    return np.array([s.hour * 3600 + s.minute * 60 + s.second + s.microsecond / 1e6 for s in stamps])
+
+
+def match_frames(reference, target, by='name', tolerance=DEFAULT_TIME_TOLERANCE):
+    """2つのDatacubeStoreのフレームを対応付け、(基準のフレーム, 比較対象のフレーム) の (K, 2) 配列を返す
+    'name'は同じファイル名、'index'は同じフレーム番号、'time'は撮影時刻（日付を除いた時刻）が
+    tolerance秒以内で互いに最も近いフレームを対応付ける（同じ時間帯に撮影した別の日のフライトも比較できる）"""
+    if by == 'index':
+        frames = np.arange(min(len(reference), len(target)))
+        return np.stack([frames, frames], axis=1)
+    if by == 'name':
+        target_frames = {name: frame for frame, name in enumerate(frame_names(target))}
+        pairs = [(frame, target_frames[name]) for frame, name in enumerate(frame_names(reference))
+                 if name in target_frames]
+        return np.array(pairs, dtype=np.intp).reshape(-1, 2)
+    if by == 'time':
+        ref_times = reference.capture_times()
+        tgt_times = target.capture_times()
+        if not len(ref_times) or not len(tgt_times):
+            return np.empty((0, 2), dtype=np.intp)
+        distance = np.abs(time_of_day(ref_times)[:, np.newaxis] - time_of_day(tgt_times)[np.newaxis, :])
+        distance = np.minimum(distance, SECONDS_PER_DAY - distance)  # 0時をまたぐ場合
+        nearest_target = distance.argmin(axis=1)
+        nearest_reference = distance.argmin(axis=0)
+        frames = np.arange(len(ref_times))
+        mutual = (nearest_reference[nearest_target] == frames) & (distance[frames, nearest_target] <= tolerance)
+        return np.stack([frames[mutual], nearest_target[mutual]], axis=1)
+    raise ValueError(f"未対応の対応付けの方法です: {by}")
+
+
+def match_flights(reference, target, modes=MATCH_MODES, tolerance=DEFAULT_TIME_TOLERANCE,
+                  min_fraction=MIN_MATCH_FRACTION):
+    """modesの順に対応付けを試し、対応数が短い方のフライトのmin_fraction以上になった方法の (方法, 対応) を返す
+    どの方法も下回る場合は最後の方法の結果を返す"""
+    required = max(1, min_fraction * min(len(reference), len(target)))
+    for by in modes:
+        pairs = match_frames(reference, target, by, tolerance)
+        if len(pairs) >= required:
+            break
+    return by, pairs
+
+
+def difference_setting(index_name, mode):
+    """差・比の表示設定（カラーマップ, 最小値, 最大値, 目盛り間隔）、差は指数の表示範囲の幅の半分を上下に取る"""
+    if mode == 'ratio':
+        return RATIO_SETTING
+    _, vmin, vmax, tick_interval = COLORMAP_SETTINGS.get(index_name, ('', -1, 1, 0.2))
+    half = (vmax - vmin) / 2
+    return DIFFERENCE_CMAP, -half, half, tick_interval
+
+
+def combine(reference, target, mode, out=None):
+    """基準と比較対象の植生指数から差（reference - target）または比（reference / target）を求める"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if mode == 'diff':
+            return np.subtract(reference, target, out=out, dtype=np.float32)
+        if mode == 'ratio':
+            return np.divide(reference, target, out=out, dtype=np.float32)
+    raise ValueError(f"未対応の比較の方法です: {mode}")
+
+
+def statistics_name(index_name, mode, target=1):
+    """変化の統計量の名前（CSVのindex列）"""
+    return f"{index_name}_{mode}" if target == 1 else f"{index_name}_{mode}{target}"
+
+
+class FlightComparison:
+    """複数のフライト（MultispectralImgModel）のフレームを対応付け、植生指数の差・比を比較する
+    models[0]が基準（スライダーで表示するフライト）、models[1:]が比較対象で、結果は基準のフレーム番号で引く
+    差・比はフレーム単位で参照時に計算してLRUキャッシュに保持し、全フレームの変化の統計量はチャンク単位の1回の走査で求める
+    各モデルの校正状態（反射率・位置合わせ）はそのまま使い、変わった場合はキャッシュと統計量を破棄する"""
+    def __init__(self, models, by='name', tolerance=DEFAULT_TIME_TOLERANCE, pairs=None,
+                 memory_budget=DEFAULT_MEMORY_BUDGET // 2):
+        self.models = list(models)
+        if len(self.models) < 2:
+            raise ValueError("比較には2つ以上のフライトが必要です")
+        shape = self.models[0].datacube_store.frame_shape
+        if any(model.datacube_store.frame_shape != shape for model in self.models[1:]):
+            raise ValueError("フレームの大きさが異なるフライトは比較できません")
+        self.by = by
+        self.tolerance = tolerance
+        # キャッシュのキーは ((指数名, 比較の方法, 比較対象), 基準のフレーム)
+        self.store = IndexStore(self.compute_difference, memory_budget)
+        self.display_store = IndexStore(self.compute_display_difference, memory_budget // 4)
+        self.statistics = FlightStatistics()
+        self._versions = self._calibration_versions()
+        # 比較対象ごとの (基準のフレーム, 比較対象のフレーム)（pairs {比較対象の番号: 配列} で直接指定も可）
+        self._set_pairs(pairs or {})
+
+    def _set_pairs(self, pairs):
+        self.pairs = [None] + [np.asarray(pairs[target], dtype=np.intp).reshape(-1, 2) if target in pairs
+                               else match_frames(self.models[0].datacube_store, model.datacube_store,
+                                                 self.by, self.tolerance)
+                               for target, model in enumerate(self.models[1:], start=1)]
+        self._target_frames = [None] + [dict(map(tuple, pair.tolist())) for pair in self.pairs[1:]]
+
+    def rematch(self):
+        """フレームの追加後に同じ方法で対応付けをやり直し、差・比と統計量を破棄"""
+        self._set_pairs({})
+        self.store.invalidate()
+        self.display_store.invalidate()
+        self.statistics.discard_frames()
+
+    def _calibration_versions(self):
+        return tuple(model.calibration_version for model in self.models)
+
+    def sync(self):
+        """いずれかのモデルの校正状態が変わっていれば差・比と統計量を破棄"""
+        versions = self._calibration_versions()
+        if versions != self._versions:
+            self.store.invalidate()
+            self.display_store.invalidate()
+            self.statistics.discard_frames()
+            self._versions = versions
+
+    def target_frame(self, frame, target=1):
+        """基準のフレームに対応する比較対象のフレーム（なければNone）"""
+        return self._target_frames[target].get(int(frame))
+
+    def matched_frames(self, target=1):
+        """比較対象と対応付けられた基準のフレーム番号"""
+        return self.pairs[target][:, 0]
+
+    def _stats_for(self, index_name, mode, target=1):
+        name = statistics_name(index_name, mode, target)
+        if name not in self.statistics.ranges:
+            self.statistics.ranges[name] = difference_setting(index_name, mode)[1:3]
+        return name
+
+    def difference(self, index_name, frame, mode='diff', target=1):
+        """基準のフレームの差・比 (h, w) float32（対応するフレームがなければNone）"""
+        self.sync()
+        if self.target_frame(frame, target) is None:
+            return None
+        return self.store.get((index_name, mode, target), frame)
+
+    def display_difference(self, index_name, frame, mode='diff', target=1):
+        """表示用の差・比（各モデルの表示用の植生指数から計算、表示サイズ以下のフレームは全解像度のまま）"""
+        self.sync()
+        if self.target_frame(frame, target) is None:
+            return None
+        if all(model.display_factor == 1 for model in self.models):
+            return self.store.get((index_name, mode, target), frame)
+        return self.display_store.get((index_name, mode, target), frame)
+
+    def compute_difference(self, key, frame):
+        """1フレームの差・比を各モデルの植生指数（キャッシュ済みならそれ）から計算（IndexStoreから呼ばれる）"""
+        index_name, mode, target = key
+        version = self.store.version
+        with span('compute_difference', index=index_name, frame=frame):
+            reference = np.asarray(self.models[0].get_index(index_name, frame))
+            compared = np.asarray(self.models[target].get_index(index_name, self.target_frame(frame, target)))
+            values = combine(reference, compared, mode)
+        name = self._stats_for(index_name, mode, target)
+        if version == self.store.version and not self.statistics.has_frame(name, frame):
+            self.statistics.set_frame(name, frame, self.statistics.new_stats(name).update(values))
+        return values
+
+    def compute_display_difference(self, key, frame):
+        index_name, mode, target = key
+        reference = np.asarray(self.models[0].get_display_index(index_name, frame))
+        compared = np.asarray(self.models[target].get_display_index(index_name, self.target_frame(frame, target)))
+        return combine(reference, compared, mode)
+
+    def iter_chunks(self, index_name, mode='diff', target=1, frames=None, chunk_size=8):
+        """対応付けられたフレームの差・比をチャンク単位で計算して (基準のフレーム, (n, h, w)) を順に返す（保持しない）"""
+        pairs = self.pairs[target]
+        if frames is not None:
+            pairs = pairs[np.isin(pairs[:, 0], frames)]
+        for start in range(0, len(pairs), chunk_size):
+            chunk = pairs[start:start + chunk_size]
+            reference = self.models[0].compute_frames(chunk[:, 0], [index_name])[index_name]
+            compared = self.models[target].compute_frames(chunk[:, 1], [index_name])[index_name]
+            yield chunk[:, 0], combine(reference, compared, mode, out=reference)
+
+    @traced('change_statistics')
+    def change_statistics(self, index_name, mode='diff', target=1, chunk_size=8, progress=None, cancel=None):
+        """全ての対応フレームの差・比の統計量を1回の走査で集計（集計済みのフレームは計算しない）
+        結果はフレームごととフライト全体（statistics.flight_stats(statistics_name(...))）で参照できる"""
+        self.sync()
+        version = self._versions
+        name = self._stats_for(index_name, mode, target)
+        pending = [frame for frame in self.matched_frames(target) if not self.statistics.has_frame(name, frame)]
+        done = 0
+        for frames, values in self.iter_chunks(index_name, mode, target, pending, chunk_size):
+            if cancel is not None and cancel.is_set():
+                break
+            if version != self._calibration_versions():
+                break
+            for frame, frame_values in zip(frames, values):
+                self.statistics.set_frame(name, frame, self.statistics.new_stats(name).update(frame_values))
+            done += len(frames)
+            if progress is not None:
+                progress(done, len(pending))
+        return self.statistics
+
+    def frame_summary(self, index_name, frame, mode='diff', target=1):
+        """基準のフレームの変化の統計量の辞書（未集計ならNone）"""
+        self.sync()
+        stats = self.statistics.frame_stats(statistics_name(index_name, mode, target), frame)
+        return None if stats is None else stats.summary()
+
+    def render_image(self, index_name, frame, mode='diff', target=1):
+        """差・比のカラーマップ画像（対応するフレームがなければ灰色の画像）"""
+        values = self.display_difference(index_name, frame, mode, target)
+        if values is None:
+            model = self.models[0]
+            height, width = (size // model.display_factor for size in model.datacube_store.frame_shape[:2])
+            return Image.new('RGB', (width, height), UNMATCHED_COLOR)
+        cmap, vmin, vmax, _ = difference_setting(index_name, mode)
+        return get_lut(cmap, vmin, vmax).to_image(values)
+
+    def export(self, path):
+        """集計済みの変化の統計量をCSVと同じ名前のJSON（基準のフレーム名付き）に保存"""
+        self.statistics.export_csv(path)
+        self.statistics.export_json(os.path.splitext(path)[0] + '.json',
+                                    frame_names=frame_names(self.models[0].datacube_store))
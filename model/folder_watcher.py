@@ -0,0 +1,62 @@
+import os
+from PIL import Image
+
+# 監視対象の拡張子
+IMAGE_EXTENSIONS = ('.tif', '.tiff')
+# サイズ・更新日時が変わらないことを確認するポーリング回数（書き込み中のファイルを読まないため）
+DEFAULT_SETTLE_POLLS = 1
+
+
+def is_complete_image(path):
+    """画像を最後までデコードできるか（書き込み途中のTIFFはデータが欠けて失敗する）"""
+    try:
+        with Image.open(path) as img:
+            img.load()
+        return True
+    except (OSError, SyntaxError, ValueError):
+        return False
+
+
+class FolderWatcher:
+    """フォルダをポーリングし、書き込みが完了した新しい画像を検出する（GUIに依存しない）
+    新しいファイルはサイズと更新日時がsettle_polls回続けて変わらず、最後までデコードできた時点で完了とみなす"""
+    def __init__(self, folder, known_paths=(), extensions=IMAGE_EXTENSIONS, settle_polls=DEFAULT_SETTLE_POLLS,
+                 exclude=()):
+        self.folder = folder
+        self.extensions = tuple(ext.lower() for ext in extensions)
+        self.settle_polls = settle_polls
+        self.known = set(os.path.abspath(p) for p in known_paths)
+        self.exclude = set(os.path.abspath(p) for p in exclude)   # 標準化パネルなどフレームでないファイル
+        self._pending = {}  # パス -> ((サイズ, 更新日時), 変化しなかった回数)
+
+    def poll(self):
+        """前回以降に完成した新しい画像のパスをファイル名順に返す"""
+        try:
+            names = os.listdir(self.folder)
+        except OSError:
+            return []
+        ready = []
+        for name in names:
+            if not name.lower().endswith(self.extensions):
+                continue
+            path = os.path.abspath(os.path.join(self.folder, name))
+            if path in self.known or path in self.exclude:
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue    # 一時ファイルからのリネーム中など
+            signature = (stat.st_size, stat.st_mtime_ns)
+            previous, stable = self._pending.get(path, (None, 0))
+            stable = stable + 1 if signature == previous else 0
+            self._pending[path] = (signature, stable)
+            if stat.st_size and stable >= self.settle_polls and is_complete_image(path):
+                ready.append(path)
+
+        # 消えたファイルの監視状態を破棄
+        for path in [p for p in self._pending if not os.path.exists(p)]:
+            del self._pending[path]
+        for path in ready:
+            del self._pending[path]
+            self.known.add(path)
+        return sorted(ready)
@@ -0,0 +1,98 @@
+import os
+from concurrent.futures import (ThreadPoolExecutor, ProcessPoolExecutor, CancelledError, wait,
+                                FIRST_COMPLETED)
+import numpy as np
+from PIL import Image
+from model.sensor_profile import DEFAULT_PROFILE
+
+# デフォルトのワーカー数
+DEFAULT_WORKERS = min(8, os.cpu_count() or 1)
+
+
+def split_bands(img, profile=DEFAULT_PROFILE, sanitize=True):
+    """センサープロファイルの配置でバンドを分割して(H, W, 4)のuint8配列を返す
+    sanitize=Trueの場合はデータクレンジング（0を1に置き換え、植生指数計算時のゼロ除算防止）を行う"""
+    bands = profile.split(np.asarray(img.convert('L')))
+    if sanitize:
+        bands = np.maximum(bands, 1)
+    return bands
+
+
+def _decode_into(raw, index, path, size, profile=DEFAULT_PROFILE):
+    """1枚の画像をデコード・バンド分割してraw[index]に直接書き込む"""
+    with Image.open(path) as img:
+        if size is not None and img.size != size:
+            raise ValueError(f"画像サイズが一致しません: {path} {img.size}")
+        raw[index] = split_bands(img, profile)
+
+
+def _decode_batch_into_file(data_path, indices, paths, size, profile=DEFAULT_PROFILE):
+    """プロセスワーカー用：メモリマップファイルを開いて複数枚を書き込む"""
+    raw = np.load(data_path, mmap_mode='r+')
+    for index, path in zip(indices, paths):
+        _decode_into(raw, index, path, size, profile)
+    raw.flush()
+    return len(indices)
+
+
+def load_frames(raw, paths, workers=DEFAULT_WORKERS, progress=None, size=None,
+                use_processes=False, data_path=None, indices=None, profile=DEFAULT_PROFILE,
+                on_frame=None, cancel=None):
+    """画像をワーカープールで並列にデコードし、共有のdatacube配列rawへ書き込む
+    indicesを指定するとpaths[k]をraw[indices[k]]に書き込む（一部のフレームのみ読み込む場合）
+    progress(完了数, 総数) と on_frame(書き込んだフレームのインデックスのリスト) は呼び出し元のスレッドで呼ばれる
+    cancel（threading.Event）がセットされると未着手のフレームを破棄してCancelledErrorを送出する
+    バンドの配置はprofile（SensorProfile）に従う
+    use_processes=True の場合はdata_pathのメモリマップファイルへ各プロセスが直接書き込む"""
+    indices = list(range(len(paths))) if indices is None else list(indices)
+    total = len(paths)
+    done = 0
+
+    def finished(frames):
+        nonlocal done
+        done += len(frames)
+        if on_frame:
+            on_frame(frames)
+        if progress:
+            progress(done, total)
+
+    if workers <= 1:
+        for i, path in zip(indices, paths):
+            if cancel is not None and cancel.is_set():
+                raise CancelledError()
+            _decode_into(raw, i, path, size, profile)
+            finished([i])
+        return
+
+    if use_processes:
+        if data_path is None:
+            raise ValueError("プロセス並列にはメモリマップファイル(data_path)が必要です")
+        raw.flush()
+        # プロセス起動コストを抑えるため数枚ずつまとめて渡す
+        batch = max(1, total // (workers * 4))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(_decode_batch_into_file, data_path,
+                                       indices[start:start + batch], paths[start:start + batch], size, profile):
+                       indices[start:start + batch]
+                       for start in range(0, total, batch)}
+            _collect(futures, finished, cancel)
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(_decode_into, raw, i, path, size, profile): [i]
+                   for i, path in zip(indices, paths)}
+        _collect(futures, finished, cancel)
+
+
+def _collect(futures, finished, cancel):
+    """完了したものから順に結果を確認し、中止要求があれば未着手のものを取り消す"""
+    pending = set(futures)
+    while pending:
+        completed, pending = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+        for future in completed:
+            future.result()
+            finished(futures[future])
+        if cancel is not None and cancel.is_set():
+            for future in pending:
+                future.cancel()
+            raise CancelledError()
@@ -0,0 +1,152 @@
+import numpy as np
+
+# 植生指数の保持形式
+STORAGE_FORMATS = ('float32', 'float16', 'int16')
+# 16bitの符号の数（符号ごとの値の表をこの大きさで作る）
+CODE_COUNT = 1 << 16
+# カラーマップの段階数（ColormapLUTのLUT_SIZEと同じ）
+DISPLAY_BINS = 256
+
+
+class Float16Codec:
+    """植生指数をfloat16で保持（相対誤差およそ5e-4、NaN・範囲外の値もそのまま保持）"""
+    name = 'float16'
+    dtype = np.float16
+
+    def encode(self, values):
+        return np.asarray(values).astype(np.float16)
+
+    def decode(self, codes, out=None):
+        if out is None:
+            return codes.astype(np.float32)
+        np.copyto(out, codes)
+        return out
+
+    def code_values(self):
+        """16bitの全ての符号に対応する値 (65536,) float32（符号をuint16として見た番号順）"""
+        return np.arange(CODE_COUNT, dtype=np.uint16).view(np.float16).astype(np.float32)
+
+    def to_dict(self):
+        return {'storage': self.name}
+
+
+class ScaledInt16Codec:
+    """植生指数を int16 の符号で保持（値 = 符号 * scale + offset）
+    [vmin, vmax] をカラーマップのbins段階に分け、各段階をさらにSUBSTEPS等分したセルの番号を符号にする
+    セルは段階の境界をまたがないため、符号から引いた色はfloat32の値から引いた色と常に一致する
+    値はセルの中央で復元し、誤差は最大で scale / 2（NDVIなど-1〜1の指数で約1.5e-5、CIgreenの-1〜10で約8.4e-5）
+    範囲外の値は端のセルに切り詰め、NaNは NODATA で表す"""
+    name = 'int16'
+    dtype = np.int16
+    NODATA = -32768
+    SUBSTEPS = 255
+
+    def __init__(self, vmin=-1.0, vmax=1.0, bins=DISPLAY_BINS):
+        self.vmin = float(vmin)
+        self.vmax = float(vmax)
+        self.bins = bins
+        self.cells = bins * self.SUBSTEPS
+        self.scale = (self.vmax - self.vmin) / self.cells
+        # 符号は セル番号 - cells // 2（int16に収める）、復元値はセルの中央
+        self.offset = self.vmin + (self.cells // 2 + 0.5) * self.scale
+
+    def encode(self, values):
+        # カラーマップと同じ計算で段階を求めてから、段階内のセルを求める
+        position = np.subtract(values, np.float32(self.vmin), dtype=np.float32)
+        position *= np.float32(self.bins / (self.vmax - self.vmin))
+        nan = np.isnan(position)
+        position[nan] = 0
+        # 最後の段階は上端（vmax以上）を含む
+        np.clip(position, 0, np.nextafter(np.float32(self.bins), np.float32(0)), out=position)
+        step = np.floor(position)
+        position -= step
+        position *= self.SUBSTEPS
+        np.floor(position, out=position)
+        np.minimum(position, self.SUBSTEPS - 1, out=position)
+        step *= self.SUBSTEPS
+        step += position
+        step -= self.cells // 2
+        codes = step.astype(np.int16)
+        codes[nan] = self.NODATA
+        return codes
+
+    def decode(self, codes, out=None):
+        out = np.multiply(codes, np.float32(self.scale), out=out, dtype=np.float32)
+        out += np.float32(self.offset)
+        out[codes == self.NODATA] = np.nan
+        return out
+
+    def code_values(self):
+        """16bitの全ての符号に対応する値 (65536,) float32（符号をuint16として見た番号順）"""
+        return self.decode(np.arange(CODE_COUNT, dtype=np.uint16).view(np.int16))
+
+    def to_dict(self):
+        return {'storage': self.name, 'scale': self.scale, 'offset': self.offset, 'nodata': self.NODATA}
+
+
+def make_codec(storage, vmin=-1.0, vmax=1.0):
+    """保持形式名からコーデックを作成（'float32'ならNone、int16は指数の範囲 vmin〜vmax を使う）"""
+    if storage == 'float32':
+        return None
+    if storage == 'float16':
+        return Float16Codec()
+    if storage == 'int16':
+        return ScaledInt16Codec(vmin, vmax)
+    raise ValueError(f"未対応の保持形式です: {storage}")
+
+
+class QuantizedIndex:
+    """16bitに量子化した植生指数 (H, W)
+    IndexStoreにそのまま格納でき、カラーマップ（ColormapLUT）は符号から直接変換する
+    np.asarray() などでfloat32の配列として読むと復号する"""
+    def __init__(self, codes, codec):
+        self.codes = codes
+        self.codec = codec
+
+    @classmethod
+    def encode(cls, values, codec):
+        return cls(codec.encode(values), codec)
+
+    @property
+    def shape(self):
+        return self.codes.shape
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes
+
+    @property
+    def code_index(self):
+        """符号をuint16として見た番号（符号ごとの表を引く添字、コピーなし）"""
+        return self.codes.view(np.uint16)
+
+    def decode(self, out=None):
+        return self.codec.decode(self.codes, out)
+
+    def __array__(self, dtype=None, copy=None):
+        values = self.decode()
+        return values if dtype is None else values.astype(dtype, copy=False)
+
+    def __getitem__(self, key):
+        return QuantizedIndex(self.codes[key], self.codec)
+
+    def __len__(self):
+        return len(self.codes)
+
+
+def quantization_report(values, codec):
+    """float32の植生指数を量子化した場合のメモリと誤差
+    誤差は保持範囲内（int16では vmin〜vmax）の有限な値について求める"""
+    values = np.asarray(values, dtype=np.float32)
+    decoded = codec.decode(codec.encode(values))
+    valid = np.isfinite(values)
+    if isinstance(codec, ScaledInt16Codec):
+        valid &= (values >= codec.vmin) & (values <= codec.vmax)
+    error = np.abs(decoded[valid] - values[valid]).astype(np.float64)
+    return {'storage': codec.name,
+            'float32_bytes': values.nbytes,
+            'bytes': values.size * np.dtype(codec.dtype).itemsize,
+            'saving': 1 - np.dtype(codec.dtype).itemsize / 4,
+            'max_abs_error': float(error.max()) if error.size else 0.0,
+            'rms_error': float(np.sqrt(np.mean(error ** 2))) if error.size else 0.0,
+            'clipped': int(np.count_nonzero(np.isfinite(values)) - np.count_nonzero(valid))}
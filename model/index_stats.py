@@ -0,0 +1,225 @@
+import csv
+import copy
+import json
+import threading
+import numpy as np
+
+# ヒストグラムのビン数（範囲を広げる際に2ビンずつまとめるため4の倍数）と、表示設定のない指数の初期範囲
+DEFAULT_BINS = 256
+DEFAULT_RANGE = (-1.0, 1.0)
+# 出力するパーセンタイル
+DEFAULT_PERCENTILES = (5, 25, 50, 75, 95)
+
+
+class IndexStats:
+    """植生指数の統計量を逐次更新する（画素数・和・二乗和・最小・最大とヒストグラム）
+    範囲外の値が来るとヒストグラムを中心から2倍ずつ広げる（隣り合う2ビンをまとめるため境界は揃ったまま）
+    どの値も加算で合成できるため、タイル・フレーム単位の結果をまとめてフライト全体の統計量にできる
+    パーセンタイルはヒストグラムからの近似値（誤差はビン幅程度）"""
+    def __init__(self, vmin=DEFAULT_RANGE[0], vmax=DEFAULT_RANGE[1], bins=DEFAULT_BINS):
+        self.vmin = float(vmin)
+        self.vmax = float(vmax)
+        self.bins = bins
+        # 先頭と末尾は範囲外（vmin未満・vmax超）の画素数
+        self.histogram = np.zeros(bins + 2, dtype=np.int64)
+        self.count = 0
+        self.nan_count = 0
+        self.total = 0.0
+        self.total_sq = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def update(self, values):
+        """値の配列（タイル・フレームなど）を加える"""
+        values = np.asarray(values, dtype=np.float32).ravel()
+        finite = values[np.isfinite(values)]
+        self.nan_count += len(values) - len(finite)
+        if not len(finite):
+            return self
+        self.count += len(finite)
+        self.total += float(np.sum(finite, dtype=np.float64))
+        self.total_sq += float(np.dot(finite.astype(np.float64), finite))
+        self.min = min(self.min, float(finite.min()))
+        self.max = max(self.max, float(finite.max()))
+        self.widen_to(self.min, self.max)
+        scaled = (finite - self.vmin) * (self.bins / (self.vmax - self.vmin))
+        bin_index = np.clip(np.floor(scaled), -1, self.bins).astype(np.intp)
+        bin_index[finite == self.vmax] = self.bins - 1    # 上端の値は最後のビンに含める
+        self.histogram += np.bincount(bin_index + 1, minlength=self.bins + 2)
+        return self
+
+    def widen(self):
+        """ヒストグラムの範囲を中心から2倍に広げる（元のビンは中央の半分に2ビンずつまとめる）"""
+        center, half = (self.vmin + self.vmax) / 2, self.vmax - self.vmin
+        inner = self.histogram[1:-1].reshape(-1, 2).sum(axis=1)
+        quarter = self.bins // 4
+        self.histogram[1:-1] = 0
+        self.histogram[1 + quarter:1 + quarter + len(inner)] = inner
+        self.vmin, self.vmax = center - half, center + half
+
+    def widen_to(self, vmin, vmax):
+        """vmin〜vmaxが収まるまで範囲を広げる"""
+        while vmin < self.vmin or vmax > self.vmax:
+            self.widen()
+        return self
+
+    def merge(self, other):
+        """同じ初期範囲・ビン数の統計量を加える（範囲が異なれば狭い方を広げて揃える）"""
+        other_center, center = (other.vmin + other.vmax) / 2, (self.vmin + self.vmax) / 2
+        if other.bins != self.bins or not np.isclose(other_center, center):
+            raise ValueError("ビンの設定が異なる統計量は合成できません")
+        if other.vmax - other.vmin > self.vmax - self.vmin:
+            self.widen_to(other.vmin, other.vmax)
+        if not (np.isclose(other.vmin, self.vmin) and np.isclose(other.vmax, self.vmax)):
+            other = copy.deepcopy(other).widen_to(self.vmin, self.vmax)
+            if not (np.isclose(other.vmin, self.vmin) and np.isclose(other.vmax, self.vmax)):
+                raise ValueError("ビンの設定が異なる統計量は合成できません")
+        self.histogram += other.histogram
+        self.count += other.count
+        self.nan_count += other.nan_count
+        self.total += other.total
+        self.total_sq += other.total_sq
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else np.nan
+
+    @property
+    def std(self):
+        if not self.count:
+            return np.nan
+        return float(np.sqrt(max(self.total_sq / self.count - self.mean ** 2, 0.0)))
+
+    @property
+    def bin_edges(self):
+        return np.linspace(self.vmin, self.vmax, self.bins + 1)
+
+    def percentiles(self, qs=DEFAULT_PERCENTILES):
+        """ヒストグラムから近似したパーセンタイル（ビン内は一様分布とみなして補間）
+        範囲外の画素はvmin・vmaxにあるものとして数え、結果は実際の最小値・最大値の範囲に収める"""
+        if not self.count:
+            return [np.nan] * len(qs)
+        cumulative = np.cumsum(self.histogram)
+        edges = np.concatenate([[self.vmin], self.bin_edges, [self.vmax]])
+        results = []
+        for q in qs:
+            rank = q / 100 * self.count
+            i = int(np.searchsorted(cumulative, rank, side='left'))
+            i = min(i, len(self.histogram) - 1)
+            below = cumulative[i - 1] if i else 0
+            fraction = (rank - below) / self.histogram[i] if self.histogram[i] else 0.0
+            value = edges[i] + fraction * (edges[i + 1] - edges[i])
+            results.append(float(np.clip(value, self.min, self.max)))
+        return results
+
+    def summary(self, qs=DEFAULT_PERCENTILES):
+        """統計量の辞書（画素数・平均・標準偏差・最小・最大・パーセンタイル）"""
+        row = {'count': self.count, 'nan': self.nan_count, 'mean': self.mean, 'std': self.std,
+               'min': self.min if self.count else np.nan, 'max': self.max if self.count else np.nan}
+        row.update({f"p{q:g}": value for q, value in zip(qs, self.percentiles(qs))})
+        return row
+
+
+class FlightStatistics:
+    """フレームごと・フライト全体の植生指数の統計量（フレームの指数が作られるたびに加える）
+    フライト全体の値はフレームごとの統計量を合成して求めるため、校正の変更で一部のフレームだけ入れ替えられる"""
+    def __init__(self, ranges=None, bins=DEFAULT_BINS):
+        self.ranges = dict(ranges or {})    # 指数名 -> (最小値, 最大値)
+        self.bins = bins
+        self._frames = {}   # (指数名, フレーム) -> IndexStats
+        self._lock = threading.Lock()
+
+    def new_stats(self, index_name):
+        """指数の範囲に合わせた空の統計量"""
+        vmin, vmax = self.ranges.get(index_name, DEFAULT_RANGE)
+        return IndexStats(vmin, vmax, self.bins)
+
+    def add_frame(self, index_name, frame, values):
+        """1フレーム分の指数を加える（同じフレームは置き換え）"""
+        self.set_frame(index_name, frame, self.new_stats(index_name).update(values))
+
+    def set_frame(self, index_name, frame, stats):
+        """タイル単位などで集計済みの統計量を登録"""
+        with self._lock:
+            self._frames[(index_name, int(frame))] = stats
+
+    def has_frame(self, index_name, frame):
+        return (index_name, int(frame)) in self._frames
+
+    def frame_stats(self, index_name, frame):
+        """フレームの統計量（未集計ならNone）"""
+        return self._frames.get((index_name, int(frame)))
+
+    def discard_frames(self, frames=None):
+        """指定フレーム（Noneなら全て）の統計量を破棄（校正係数の変更時）"""
+        with self._lock:
+            if frames is None:
+                self._frames.clear()
+                return
+            frames = set(int(frame) for frame in frames)
+            for key in [key for key in self._frames if key[1] in frames]:
+                del self._frames[key]
+
+    def index_names(self):
+        with self._lock:
+            return sorted(set(name for name, _ in self._frames))
+
+    def frames(self, index_name):
+        with self._lock:
+            return sorted(frame for name, frame in self._frames if name == index_name)
+
+    def flight_stats(self, index_name):
+        """フライト全体の統計量（集計済みのフレームを合成）"""
+        total = self.new_stats(index_name)
+        with self._lock:
+            stats = [value for (name, _), value in self._frames.items() if name == index_name]
+        for value in stats:
+            total.merge(value)
+        return total
+
+    def rows(self, qs=DEFAULT_PERCENTILES):
+        """CSV出力用の行（フレームごと、最後にフライト全体をframe='flight'で出力）"""
+        rows = []
+        for index_name in self.index_names():
+            for frame in self.frames(index_name):
+                rows.append({'index': index_name, 'frame': frame, **self.frame_stats(index_name, frame).summary(qs)})
+            rows.append({'index': index_name, 'frame': 'flight', **self.flight_stats(index_name).summary(qs)})
+        return rows
+
+    def export_csv(self, path, qs=DEFAULT_PERCENTILES):
+        rows = self.rows(qs)
+        fields = ['index', 'frame', 'count', 'nan', 'mean', 'std', 'min', 'max'] + [f"p{q:g}" for q in qs]
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows(rows)
+        return len(rows)
+
+    def export_json(self, path, qs=DEFAULT_PERCENTILES, frame_names=None):
+        """フレームごとの統計量とフライト全体の統計量・ヒストグラムをJSONで保存"""
+        def clean(row):
+            return {key: (None if isinstance(value, float) and not np.isfinite(value) else value)
+                    for key, value in row.items()}
+
+        result = {}
+        for index_name in self.index_names():
+            flight = self.flight_stats(index_name)
+            frames = []
+            for frame in self.frames(index_name):
+                row = clean(self.frame_stats(index_name, frame).summary(qs))
+                row['frame'] = frame
+                if frame_names is not None:
+                    row['name'] = frame_names[frame]
+                frames.append(row)
+            result[index_name] = {'flight': clean(flight.summary(qs)),
+                                  'histogram': {'edges': flight.bin_edges.tolist(),
+                                                'counts': flight.histogram[1:-1].tolist(),
+                                                'below': int(flight.histogram[0]),
+                                                'above': int(flight.histogram[-1])},
+                                  'frames': frames}
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        return result
@@ -0,0 +1,98 @@
+import threading
+from collections import OrderedDict
+from model.instrumentation import count
+
+# 植生指数キャッシュのデフォルトメモリ上限（バイト）
+DEFAULT_MEMORY_BUDGET = 256 * 1024 * 1024
+
+
+class IndexStore:
+    """植生指数をフレーム単位で必要時に計算し、LRUキャッシュで保持する"""
+    def __init__(self, compute_func, memory_budget=DEFAULT_MEMORY_BUDGET):
+        # compute_func(index_name, frame) -> np.ndarray
+        self.compute_func = compute_func
+        self.memory_budget = memory_budget
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()   # 先読みスレッドからも参照されるため
+        self.version = 0    # invalidateのたびに更新
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, index_name, frame):
+        """指定フレームの植生指数を取得（未計算なら計算してキャッシュ）"""
+        key = (index_name, frame)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                count('index_cache_hit')
+                return self._cache[key]
+            self.misses += 1
+            version = self.version
+        count('index_cache_miss')
+
+        # 計算はロックの外で行う
+        value = self.compute_func(index_name, frame)
+        with self._lock:
+            # 計算中に校正状態が変わった場合は古い結果をキャッシュしない
+            if version == self.version and key not in self._cache:
+                self._cache[key] = value
+                self.nbytes += value.nbytes
+                self._evict()
+        return value
+
+    def set_memory_budget(self, memory_budget):
+        """メモリ上限を変更し、超過分を破棄"""
+        with self._lock:
+            self.memory_budget = memory_budget
+            self._evict()
+
+    def invalidate(self):
+        """キャッシュを全て破棄（反射率変換など校正状態の変更時）"""
+        with self._lock:
+            self._cache.clear()
+            self.nbytes = 0
+            self.version += 1
+
+    def invalidate_frames(self, frames):
+        """指定フレームのキャッシュのみ破棄（フレームごとの校正係数の変更時）"""
+        frames = set(int(frame) for frame in frames)
+        with self._lock:
+            for key in [key for key in self._cache if key[1] in frames]:
+                self.nbytes -= self._cache.pop(key).nbytes
+            self.version += 1
+
+    def _evict(self):
+        """メモリ上限を超えた分を古い順に破棄（直近の1件は常に保持）"""
+        while self.nbytes > self.memory_budget and len(self._cache) > 1:
+            _, value = self._cache.popitem(last=False)
+            self.nbytes -= value.nbytes
+
+    def view(self, index_name, len_func):
+        """リストと同じようにインデックスアクセスできる遅延ビューを返す"""
+        return LazyIndexList(self, index_name, len_func)
+
+
+class LazyIndexList:
+    """IndexStoreをリストとして見せるためのビュー"""
+    def __init__(self, store, index_name, len_func):
+        self.store = store
+        self.index_name = index_name
+        self.len_func = len_func
+
+    def __len__(self):
+        return self.len_func()
+
+    def __getitem__(self, frame):
+        if isinstance(frame, slice):
+            return [self[i] for i in range(*frame.indices(len(self)))]
+        if frame < 0:
+            frame += len(self)
+        if not 0 <= frame < len(self):
+            raise IndexError(f"frame {frame} out of range")
+        return self.store.get(self.index_name, frame)
+
+    def __iter__(self):
+        for frame in range(len(self)):
+            yield self[frame]
@@ -0,0 +1,124 @@
+import os
+import json
+import time
+import logging
+import functools
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+# トレースを保持するイベント数の上限（古いものから破棄）
+DEFAULT_MAX_EVENTS = 100000
+# 起動時からトレースを記録する場合に設定する環境変数
+TRACE_ENV = 'MULTISPECTRAL_TRACE'
+
+
+class Tracer:
+    """処理時間のスパンとカウンタを記録する
+    スパンの集計（回数・合計・最大・直近）は常に行い、Chromeトレース用のイベントは有効時のみ保持する"""
+    def __init__(self, max_events=DEFAULT_MAX_EVENTS, enabled=False):
+        self.enabled = enabled
+        self._events = deque(maxlen=max_events)
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+        self.stats = {}     # スパン名 -> {'count', 'total', 'max', 'last'}（秒）
+        self.counters = {}  # カウンタ名 -> 値
+
+    @contextmanager
+    def span(self, name, **args):
+        """with文で囲んだ処理の時間を記録"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.perf_counter(), args)
+
+    def traced(self, name):
+        """関数全体をスパンとして記録するデコレータ"""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def record(self, name, start, end, args=None):
+        duration = end - start
+        with self._lock:
+            stat = self.stats.get(name)
+            if stat is None:
+                stat = self.stats[name] = {'count': 0, 'total': 0.0, 'max': 0.0, 'last': 0.0}
+            stat['count'] += 1
+            stat['total'] += duration
+            stat['max'] = max(stat['max'], duration)
+            stat['last'] = duration
+            if self.enabled:
+                self._events.append({'name': name, 'ph': 'X', 'ts': (start - self._origin) * 1e6,
+                                     'dur': duration * 1e6, 'pid': os.getpid(), 'tid': threading.get_ident(),
+                                     'args': args or {}})
+
+    def count(self, name, value=1):
+        """カウンタを加算（処理フレーム数、確保したバイト数、キャッシュヒット数など）"""
+        with self._lock:
+            total = self.counters[name] = self.counters.get(name, 0) + value
+            if self.enabled:
+                self._events.append({'name': name, 'ph': 'C', 'ts': (time.perf_counter() - self._origin) * 1e6,
+                                     'pid': os.getpid(), 'tid': threading.get_ident(), 'args': {name: total}})
+
+    def summary(self):
+        """スパンとカウンタの集計（時間はミリ秒）"""
+        with self._lock:
+            spans = {name: {'count': stat['count'],
+                            'total_ms': stat['total'] * 1000,
+                            'mean_ms': stat['total'] * 1000 / stat['count'],
+                            'max_ms': stat['max'] * 1000,
+                            'last_ms': stat['last'] * 1000}
+                     for name, stat in self.stats.items()}
+            return {'spans': spans, 'counters': dict(self.counters)}
+
+    def export_chrome_trace(self, path):
+        """記録したイベントをChromeトレース形式(JSON)で保存（chrome://tracing や Perfetto で表示）"""
+        with self._lock:
+            events = list(self._events)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms',
+                       'otherData': {'counters': dict(self.counters)}}, f)
+        return len(events)
+
+    def reset(self):
+        with self._lock:
+            self._events.clear()
+            self.stats.clear()
+            self.counters.clear()
+
+
+# アプリ全体で共有するトレーサー
+TRACER = Tracer(enabled=bool(os.environ.get(TRACE_ENV)))
+span = TRACER.span
+traced = TRACER.traced
+count = TRACER.count
+
+
+class JsonLogFormatter(logging.Formatter):
+    """ログを1行1件のJSONで出力（extraで渡した項目も含める）"""
+    _STANDARD = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+    def format(self, record):
+        entry = {'time': self.formatTime(record), 'level': record.levelname, 'logger': record.name,
+                 'message': record.getMessage()}
+        entry.update({key: value for key, value in vars(record).items() if key not in self._STANDARD})
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def configure_logging(path=None, level=logging.INFO):
+    """アプリのログ出力を設定（pathを指定するとJSON形式でファイルにも出力）"""
+    handlers = [logging.StreamHandler()]
+    if path:
+        file_handler = logging.FileHandler(path, encoding='utf-8')
+        file_handler.setFormatter(JsonLogFormatter())
+        handlers.append(file_handler)
+    logging.basicConfig(level=level, handlers=handlers,
+                        format='%(asctime)s %(levelname)s %(name)s: %(message)s')
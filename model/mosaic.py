@@ -0,0 +1,357 @@
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+import numpy as np
+from PIL import Image
+from model.vegindex_engine import BAND_INDEX
+from model.band_registration import phase_correlation
+from model.tiled_processing import pyramid_factors, downsample
+from model.colormap_lut import get_lut
+from model.instrumentation import count, traced
+from model.multispectral_img_model import COLORMAP_SETTINGS
+
+# フレーム間の移動量の推定に使う縮小したNIRバンドの大きさ（長辺）
+ESTIMATE_SIZE = 128
+# 位相限定相関の窓で減衰させる端の割合（重なりがフレームの端に寄る大きな移動も求められるように小さくする）
+ESTIMATE_TAPER = 0.25
+# 推定した移動量を採用する重なりの最小の割合と、重なり部分の最小の相関係数（下回れば直前の移動量を使う）
+MIN_OVERLAP = 0.2
+MIN_CORRELATION = 0.3
+# キャンバスの1フレームの大きさ（長辺、これに収まるようにフレームを縮小して加算）
+MOSAIC_FRAME_SIZE = 256
+# キャンバスのタイルの大きさ（画素）と、メモリ上に保持するタイルの上限（超えた分は一時フォルダに退避）
+TILE_SIZE = 256
+DEFAULT_MEMORY_BUDGET = 64 * 1024 * 1024
+# 上位レベル（1/2ずつ縮小）の最大数と、オーバービューの既定の大きさ
+MAX_LEVELS = 12
+OVERVIEW_SIZE = 512
+# フレームのない部分の表示色
+BACKGROUND_COLOR = (43, 43, 43)
+
+
+def overlap_correlation(previous, current, dy, dx):
+    """currentを (dy, dx) ずらしてpreviousに重ねた部分の相関係数（重なりがMIN_OVERLAP未満ならNone）"""
+    height, width = current.shape
+    overlap_h, overlap_w = height - abs(dy), width - abs(dx)
+    if overlap_h <= 0 or overlap_w <= 0 or overlap_h * overlap_w < MIN_OVERLAP * height * width:
+        return None
+    cur = current[max(dy, 0):max(dy, 0) + overlap_h, max(dx, 0):max(dx, 0) + overlap_w]
+    prev = previous[max(-dy, 0):max(-dy, 0) + overlap_h, max(-dx, 0):max(-dx, 0) + overlap_w]
+    cur, prev = cur - cur.mean(), prev - prev.mean()
+    denominator = np.sqrt((cur * cur).sum() * (prev * prev).sum())
+    return float((cur * prev).sum() / denominator) if denominator else 0.0
+
+
+def estimate_step(previous, current):
+    """縮小したNIRバンドの位相限定相関で、直前のフレームに対する移動量 (dy, dx) を求める
+    current(y, x) = previous(y - dy, x - dx) となる量を返す。相関のピークは周期的なので、
+    フレームの半分を超える移動（旋回時など）も候補にして重なり部分の相関係数が最大のものを選び、
+    相関係数が低いか重なりが小さい場合は信頼できないとして (移動量, False) を返す"""
+    shift = phase_correlation(previous, current, ESTIMATE_TAPER)
+    height, width = current.shape
+    dy, dx = (int(round(value)) for value in shift)
+    best, best_correlation = (dy, dx), -1.0
+    for cand_y in (dy, dy - height if dy > 0 else dy + height):
+        for cand_x in (dx, dx - width if dx > 0 else dx + width):
+            correlation = overlap_correlation(previous, current, cand_y, cand_x)
+            if correlation is not None and correlation > best_correlation:
+                best, best_correlation = (cand_y, cand_x), correlation
+    shift = shift + (best[0] - dy, best[1] - dx)
+    return shift, best_correlation >= MIN_CORRELATION
+
+
+def feather_weights(shape):
+    """フレームの重み (h, w)（端ほど小さく中心ほど大きい、重なり部分のつなぎ目を目立たなくする）"""
+    height, width = shape
+    wy = np.minimum(np.arange(1, height + 1), np.arange(height, 0, -1))
+    wx = np.minimum(np.arange(1, width + 1), np.arange(width, 0, -1))
+    weights = np.minimum.outer(wy, wx).astype(np.float32)
+    return weights / weights.max()
+
+
+class TileCanvas:
+    """重み付き和と重みをタイル (TILE_SIZE, TILE_SIZE, 2) 単位で保持する疎なキャンバス（座標は負でもよい）
+    レベル0に加算し、レベルLのタイル（1/2^Lに縮小）は下位のタイルが更新されたものだけ参照時に作り直す
+    メモリ上のタイルはLRUで上限までとし、追い出したタイルは一時フォルダに退避して必要時に読み戻す"""
+    def __init__(self, tile_size=TILE_SIZE, memory_budget=DEFAULT_MEMORY_BUDGET):
+        self.tile_size = tile_size
+        self.memory_budget = memory_budget
+        self._tiles = OrderedDict()     # (レベル, タイル行, タイル列) -> (t, t, 2) float32
+        self._spilled = set()           # 一時フォルダに退避したタイル
+        self._stale = set()             # 下位のタイルが更新された上位のタイル
+        self._spill_dir = None
+        self._lock = threading.RLock()  # 加算（ワーカースレッド）と描画（Tkのスレッド）で共有するため
+        self.bounds = None              # レベル0の加算済みの範囲 (y0, x0, y1, x1)
+        self.nbytes = 0
+
+    def add(self, values, weights, y0, x0):
+        """レベル0の (y0, x0) を左上として値 (h, w) を重み付きで加算（NaNの画素は加えない）"""
+        height, width = values.shape
+        valid = np.isfinite(values)
+        weights = np.where(valid, weights, 0).astype(np.float32)
+        weighted = np.where(valid, values, 0).astype(np.float32) * weights
+        size = self.tile_size
+        with self._lock:
+            for ty in range(y0 // size, (y0 + height - 1) // size + 1):
+                for tx in range(x0 // size, (x0 + width - 1) // size + 1):
+                    # タイル内の範囲とフレーム内の範囲
+                    top, left = max(y0, ty * size), max(x0, tx * size)
+                    bottom, right = min(y0 + height, (ty + 1) * size), min(x0 + width, (tx + 1) * size)
+                    tile = self._tile((0, ty, tx), create=True)
+                    region = (slice(top - ty * size, bottom - ty * size), slice(left - tx * size, right - tx * size))
+                    source = (slice(top - y0, bottom - y0), slice(left - x0, right - x0))
+                    tile[region + (0,)] += weighted[source]
+                    tile[region + (1,)] += weights[source]
+                    for level in range(1, MAX_LEVELS + 1):
+                        self._stale.add((level, ty >> level, tx >> level))
+            box = (y0, x0, y0 + height, x0 + width)
+            self.bounds = box if self.bounds is None else (
+                min(self.bounds[0], box[0]), min(self.bounds[1], box[1]),
+                max(self.bounds[2], box[2]), max(self.bounds[3], box[3]))
+
+    def render(self, level, y0, x0, y1, x1):
+        """レベルlevelの範囲 [y0, y1) x [x0, x1) の加重平均 (h, w) float32（加算されていない画素はNaN）"""
+        size = self.tile_size
+        acc = np.zeros((y1 - y0, x1 - x0, 2), dtype=np.float32)
+        with self._lock:
+            for ty in range(y0 // size, (y1 - 1) // size + 1):
+                for tx in range(x0 // size, (x1 - 1) // size + 1):
+                    tile = self.tile(level, ty, tx)
+                    if tile is None:
+                        continue
+                    top, left = max(y0, ty * size), max(x0, tx * size)
+                    bottom, right = min(y1, (ty + 1) * size), min(x1, (tx + 1) * size)
+                    acc[top - y0:bottom - y0, left - x0:right - x0] = \
+                        tile[top - ty * size:bottom - ty * size, left - tx * size:right - tx * size]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(acc[..., 1] > 0, acc[..., 0] / acc[..., 1], np.nan).astype(np.float32)
+
+    def tile(self, level, ty, tx):
+        """タイル (t, t, 2) を取得（上位のレベルは下位の4つのタイルを縮小して作成、加算されていなければNone）"""
+        key = (level, ty, tx)
+        with self._lock:
+            if level == 0 or key not in self._stale:
+                return self._tile(key)
+            children = [self.tile(level - 1, 2 * ty + dy, 2 * tx + dx) for dy in (0, 1) for dx in (0, 1)]
+            size = self.tile_size
+            merged = np.zeros((2 * size, 2 * size, 2), dtype=np.float32)
+            for (dy, dx), child in zip([(0, 0), (0, 1), (1, 0), (1, 1)], children):
+                if child is not None:
+                    merged[dy * size:(dy + 1) * size, dx * size:(dx + 1) * size] = child
+            # 重み付き和と重みを同じく平均するので、加重平均は縮小前の重みで求めたものと一致する
+            tile = self._tile(key, create=True)
+            tile[...] = downsample(merged, 2)
+            self._stale.discard(key)
+            return tile
+
+    def _tile(self, key, create=False):
+        tile = self._tiles.get(key)
+        if tile is not None:
+            self._tiles.move_to_end(key)
+            return tile
+        if key in self._spilled:
+            tile = np.load(self._spill_path(key))
+            count('mosaic_tiles_loaded')
+        elif create:
+            tile = np.zeros((self.tile_size, self.tile_size, 2), dtype=np.float32)
+        else:
+            return None
+        self._tiles[key] = tile
+        self.nbytes += tile.nbytes
+        self._evict()
+        return tile
+
+    def _evict(self):
+        """メモリ上限を超えたタイルを古い順に一時フォルダへ退避（作り直す上位のタイルは捨てる）"""
+        while self.nbytes > self.memory_budget and len(self._tiles) > 1:
+            key, tile = self._tiles.popitem(last=False)
+            self.nbytes -= tile.nbytes
+            if key in self._stale:
+                continue
+            if self._spill_dir is None:
+                self._spill_dir = tempfile.mkdtemp(prefix='mosaic-')
+            np.save(self._spill_path(key), tile)
+            self._spilled.add(key)
+            count('mosaic_tiles_spilled')
+
+    def _spill_path(self, key):
+        return os.path.join(self._spill_dir, '{}_{}_{}.npy'.format(*key))
+
+    def clear(self):
+        """全てのタイルを破棄"""
+        with self._lock:
+            self._tiles.clear()
+            self._spilled.clear()
+            self._stale.clear()
+            self.nbytes = 0
+            self.bounds = None
+            if self._spill_dir is not None:
+                shutil.rmtree(self._spill_dir, ignore_errors=True)
+                self._spill_dir = None
+
+    def close(self):
+        self.clear()
+
+
+class MosaicBuilder:
+    """フライトのフレームを移動量で並べ、植生指数を1枚の縮小したモザイク（オーバービュー）にする
+    フレーム間の移動量は縮小したNIRバンドの位相限定相関で推定し（重なりの少ないフレームは直前の移動量で補う）、
+    植生指数を中心ほど大きい重みでタイル状のキャンバスに加重平均する
+    フレームの追加時は新しいフレームのみ推定・加算し、校正状態や指数が変わった場合は加算し直す（位置はそのまま）"""
+    def __init__(self, model, index_name='ndvi', frame_size=MOSAIC_FRAME_SIZE, memory_budget=DEFAULT_MEMORY_BUDGET,
+                 estimate_size=ESTIMATE_SIZE):
+        self.model = model
+        self.index_name = index_name
+        band_shape = model.datacube_store.frame_shape[:2]
+        self.band_shape = band_shape
+        # キャンバスの1画素に対応するフレームの画素数と、移動量の推定に使う縮小率
+        self.scale = pyramid_factors(band_shape, frame_size)[-1]
+        self.estimate_factor = pyramid_factors(band_shape, estimate_size)[-1]
+        self.canvas = TileCanvas(memory_budget=memory_budget)
+        self.positions = np.empty((0, 2), dtype=np.float64)    # 各フレームの左上のフライト上の位置（フレームの画素）
+        self.reliable = np.empty(0, dtype=bool)     # 移動量を推定できたか（Falseは直前の移動量で補ったフレーム）
+        self.placed = 0     # キャンバスに加算済みのフレーム数
+        self._previous = None   # 直前のフレームの縮小したNIRバンド
+        self._step = np.zeros(2)
+        self._version = model.calibration_version
+        self._weights = feather_weights(tuple(size // self.scale for size in band_shape))
+        self._update_lock = threading.Lock()
+
+    def set_index(self, index_name):
+        """モザイクにする植生指数を変更（キャンバスのみ作り直す）"""
+        if index_name != self.index_name:
+            with self._update_lock:
+                self.index_name = index_name
+                self._reset_canvas()
+
+    def sync(self):
+        """校正状態が変わっていればキャンバスを破棄（フレームの位置はNIRの放射輝度から求めるため変わらない）"""
+        if self._version != self.model.calibration_version:
+            self._reset_canvas()
+
+    def _reset_canvas(self):
+        self.canvas.clear()
+        self.placed = 0
+        self._version = self.model.calibration_version
+
+    @property
+    def pending(self):
+        """キャンバスに加算していないフレーム数"""
+        self.sync()
+        return self.model.get_datacube_len() - self.placed
+
+    @traced('update_mosaic')
+    def update(self, chunk_size=8, progress=None, cancel=None):
+        """未加算のフレームの位置を推定し、植生指数をキャンバスに加算して加算したフレーム数を返す
+        チャンク単位で放射輝度を1度だけ読み、NIRの縮小と植生指数の計算に使う（指数のキャッシュには加えない）"""
+        with self._update_lock:
+            self.sync()
+            version = self._version
+            start, total = self.placed, self.model.get_datacube_len()
+            raw = self.model.raw_frames()
+            nir = BAND_INDEX['nir']
+            for chunk_start in range(start, total, chunk_size):
+                if cancel is not None and cancel.is_set():
+                    break
+                frames = np.arange(chunk_start, min(chunk_start + chunk_size, total))
+                cubes = raw[frames]
+                self._estimate_positions(frames, cubes[..., nir])
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    gains = self.model.gains
+                    if gains is not None and gains.ndim == 2:
+                        gains = gains[frames]
+                    values = self.model.engine.compute_chunk(cubes, [self.index_name], gains=gains)[self.index_name]
+                if version != self.model.calibration_version:
+                    break   # 次のupdateで加算し直す
+                for frame, frame_values in zip(frames, values):
+                    self._place(frame, frame_values)
+                self.placed = int(frames[-1]) + 1
+                if progress is not None:
+                    progress(self.placed - start, total - start)
+            return self.placed - start
+
+    def _estimate_positions(self, frames, nir_bands):
+        """位置が未推定のフレームについて直前のフレームからの移動量を推定し、位置を延長する"""
+        new = [(frame, band) for frame, band in zip(frames, nir_bands) if frame >= len(self.positions)]
+        if not new:
+            return
+        positions, reliable = list(self.positions), list(self.reliable)
+        for frame, band in new:
+            current = downsample(band, self.estimate_factor) if self.estimate_factor > 1 \
+                else band.astype(np.float32)
+            if self._previous is None:
+                positions.append(np.zeros(2))
+                reliable.append(True)
+            else:
+                shift, ok = estimate_step(self._previous, current)
+                if ok:
+                    # 地表の同じ点が移動量だけずれて写るので、フレームの位置は逆向きに進む
+                    self._step = -shift * self.estimate_factor
+                positions.append(positions[-1] + self._step)
+                reliable.append(ok)
+            self._previous = current
+        self.positions = np.array(positions, dtype=np.float64)
+        self.reliable = np.array(reliable, dtype=bool)
+
+    def _place(self, frame, values):
+        if self.scale > 1:
+            values = downsample(values, self.scale)
+        y0, x0 = (int(value) for value in np.round(self.positions[frame] / self.scale))
+        self.canvas.add(values, self._weights, y0, x0)
+        count('mosaic_frames_placed')
+
+    def overview_level(self, max_size=OVERVIEW_SIZE):
+        """キャンバス全体がmax_sizeに収まる最も細かいレベル"""
+        y0, x0, y1, x1 = self.canvas.bounds
+        level = 0
+        while max(y1 - y0, x1 - x0) > max_size << level and level < MAX_LEVELS:
+            level += 1
+        return level
+
+    def render_overview(self, max_size=OVERVIEW_SIZE):
+        """モザイク全体のカラーマップ画像と配置 (原点のy, 原点のx, 1画素あたりのフレームの画素数) を返す
+        配置は画像上の点からフレームを引く（frame_at_pixel）のに使う。未加算ならNoneを返す"""
+        with self.canvas._lock:
+            if self.canvas.bounds is None:
+                return None
+            level = self.overview_level(max_size)
+            y0, x0, y1, x1 = self.canvas.bounds
+            top, left = y0 >> level, x0 >> level
+            values = self.canvas.render(level, top, left, -(-y1 >> level), -(-x1 >> level))
+        cmap, vmin, vmax, _ = COLORMAP_SETTINGS.get(self.index_name, ('jet', -1, 1, 0.2))
+        rgb = get_lut(cmap, vmin, vmax).apply(values)[:, :, :3].copy()
+        rgb[np.isnan(values)] = BACKGROUND_COLOR
+        pixel = self.scale << level
+        return Image.fromarray(rgb, mode='RGB'), (top * pixel, left * pixel, pixel)
+
+    def frame_at(self, y, x):
+        """フライト上の点 (y, x)（フレームの画素）を含む加算済みのフレームのうち、中心が最も近いもの（なければNone）"""
+        positions = self.positions[:self.placed]
+        height, width = self.band_shape
+        inside = ((positions[:, 0] <= y) & (y < positions[:, 0] + height) &
+                  (positions[:, 1] <= x) & (x < positions[:, 1] + width))
+        if not inside.any():
+            return None
+        candidates = np.flatnonzero(inside)
+        centers = positions[candidates] + (height / 2, width / 2)
+        return int(candidates[np.argmin(((centers - (y, x)) ** 2).sum(axis=1))])
+
+    def frame_at_pixel(self, placement, x, y):
+        """オーバービュー画像上の点 (x, y) にあるフレーム"""
+        top, left, pixel = placement
+        return self.frame_at(top + (y + 0.5) * pixel, left + (x + 0.5) * pixel)
+
+    def frame_outline(self, placement, frame):
+        """フレームのオーバービュー画像上の範囲 (x0, y0, x1, y1)（位置が未推定ならNone）"""
+        if frame >= len(self.positions):
+            return None
+        top, left, pixel = placement
+        y, x = self.positions[frame]
+        height, width = self.band_shape
+        return ((x - left) / pixel, (y - top) / pixel, (x + width - left) / pixel, (y + height - top) / pixel)
+
+    def close(self):
+        """退避したタイルの一時フォルダを削除"""
+        self.canvas.close()
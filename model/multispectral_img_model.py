@@ -1,110 +1,454 @@
+import threading
+from collections import OrderedDict
 from PIL import Image
 import numpy as np
-import matplotlib.pyplot as plt
-import copy
+from model.index_store import IndexStore, DEFAULT_MEMORY_BUDGET
+from model.datacube_store import DatacubeStore, DatacubeView
+from model.image_loader import DEFAULT_WORKERS
+from model.vegindex_engine import VegIndexEngine
+from model.colormap_lut import get_lut
+from model.panel_roi import PanelROIExtractor
+from model.panel_calibration import PanelSchedule, PANEL_REFLECTANCE
+from model.sensor_profile import DEFAULT_PROFILE
+from model.instrumentation import span, traced, count
+from model.tiled_processing import TiledIndexProcessor, ArrayTileSource, pyramid_factors
+from model.index_stats import FlightStatistics
+from model.band_registration import BandRegistration, sample_frames
+from model.index_codec import QuantizedIndex, make_codec, quantization_report
+from model.segmentation import (Segmenter, CanopyMetrics, otsu_threshold, DEFAULT_THRESHOLDS, DEFAULT_RADIUS,
+                                DEFAULT_MIN_BLOB_AREA)
+# 表示バンドのラジオボタンでdatacube（全バンド）を表す値
+DATACUBE_BAND = 5
+# 位置合わせ済みのフレームを保持する数（表示中のフレームと先読みの範囲）
+REGISTERED_CACHE_FRAMES = 8
+# 植生マスクを重ねる色と不透明度
+MASK_COLOR = (255, 0, 255)
+MASK_ALPHA = 0.45
+# ラジオボタンの値と植生指数名の対応
+VEGINDEX_NAMES = {1: 'ndvi', 2: 'cigreen', 3: 'gndvi', 4: 'ndre'}
+# 植生指数ごとの表示設定（カラーマップ, 最小値, 最大値, 目盛り間隔）
+COLORMAP_SETTINGS = {'ndvi': ('jet', -1, 1, 0.2),
+                     'cigreen': ('viridis', -1, 10, 1),   # CIgreenは-1から10
+                     'gndvi': ('YlGn', -1, 1, 0.2),
+                     'ndre': ('seismic', -1, 1, 0.2)}
+
+
+def measure_panel_brightness(panel_img, rectangle_area, profile=DEFAULT_PROFILE):
+    '''標準化パネル画像の指定範囲から各バンドの平均放射輝度を求める'''
+    mean = PanelROIExtractor.from_image(panel_img, profile).rect_stats([rectangle_area])['mean'][0]
+    return [round(float(value), 2) for value in mean]
+
+
+def reflectance_gains(panel_brightness):
+    '''パネルの放射輝度から反射率変換のバンドごとの係数を求める'''
+    return PANEL_REFLECTANCE / np.asarray(panel_brightness, dtype=np.float32)
+
 
 class MultispectralImgModel:
-    is_refconvert = 0
-    def __init__(self, imgs):
-        # 初期化：画像リストとインデックスのリストを定義
-        self.image_tmp_list = imgs
-        self.image_8bit_list = self.convert_to_8bit()
+    def __init__(self, imgs=None, index_memory_budget=DEFAULT_MEMORY_BUDGET, datacube_store=None,
+                 processed_cache=None, index_storage='float32'):
+        # 初期化：放射輝度のストア（PIL画像リストからも作成可）とインデックスのリストを定義
+        if datacube_store is None:
+            datacube_store = DatacubeStore.from_images(imgs)
+        self.datacube_store = datacube_store
+        self.processed_cache = processed_cache  # 植生指数のディスクキャッシュ（ProcessedCache、任意）
+        # 校正状態はモデルごとに保持（複数のモデルを同時に扱えるように）
+        self.is_refconvert = 0  # 反射率変換フラグ
+        self.panel_brightness = None
+        self.panel_schedule = None  # フライト中の複数パネルによる補間（Noneなら1枚のパネルを全フレームに適用）
+        self.gains = None   # 反射率変換時のバンドごとの校正係数 (4,) または (N, 4)（読み出し時に適用）
+        self.registration = None    # バンドの位置合わせ（BandRegistration、読み出し時に適用）
+        self._registered_frames = OrderedDict()     # フレーム番号 -> 位置合わせ済みのdatacube（直近のみ）
+        self._registered_lock = threading.Lock()
         self.datacube_list = self.create_datacube()
-        self.datacube_list_copy = copy.deepcopy(self.datacube_list)
-        self.batch_process()        
+        self.engine = VegIndexEngine()
+        # 保持する植生指数の形式（'float32'・'float16'・'int16'、16bitなら同じメモリ上限で2倍のフレームを保持）
+        self.index_storage = index_storage
+        self.index_codecs = {}  # 指数名 -> 量子化の設定（参照時に作成）
+        # 植生指数はアクセス時に計算してLRUキャッシュに保持
+        self.index_store = IndexStore(self.compute_index, index_memory_budget)
+        # 表示サイズより大きいフレームは縮小したピラミッドで表示（全解像度の指数は保持しない）
+        self.display_factor = pyramid_factors(self.datacube_store.frame_shape[:2])[-1]
+        self.display_index_store = IndexStore(self.compute_display_index, index_memory_budget // 4)
+        # 指数を計算するたびにフレームごとの統計量を更新（ヒストグラムの範囲は表示設定と同じ）
+        self.statistics = FlightStatistics({name: settings[1:3] for name, settings in COLORMAP_SETTINGS.items()})
+        self.canopy = {}    # 指数名 -> 植生・土壌の分割によるフレームごとの指標（CanopyMetrics）
+        self.batch_process()
     
+    @traced('batch_process')
     def batch_process(self):
-        '''一括処理 - 放射輝度値と反射率とで2回実行'''
+        '''一括処理 - 放射輝度値と反射率とで2回実行
+        植生指数は遅延リストとして用意し、実際の計算は参照時に行う'''
+        self.index_store.invalidate()
+        self.display_index_store.invalidate()
+        self.statistics.discard_frames()
+        self.canopy.clear()
+        self.calibration_version = self.index_store.version  # 表示キャッシュのキーに使用
         
-        # 植生指数の計算
-        self.ndvi_list = self.calculate_ndvi()
-        self.gndvi_list = self.calculate_gndvi()
-        self.ndre_list = self.calculate_ndre()
-        self.cigreen_list = self.calculate_cigreen()
+        # 植生指数の遅延リスト
+        self.ndvi_list = self.index_list('ndvi')
+        self.gndvi_list = self.index_list('gndvi')
+        self.ndre_list = self.index_list('ndre')
+        self.cigreen_list = self.index_list('cigreen')
+    
+    def compute_index(self, index_name, frame):
+        '''1フレーム分の植生指数を計算（IndexStoreから呼ばれる）
+        ディスクキャッシュがあれば、同じ元ファイル・校正係数で計算済みのものを読み込む'''
+        cube = self.frame_datacube(frame)[np.newaxis]
+        gains = self.gains
+        if gains is not None and gains.ndim == 2:
+            gains = gains[frame:frame + 1]
+        
+        version = self.index_store.version
+        frame_key = self.frame_cache_key(frame)
+        values = None
+        if frame_key:
+            values = self.processed_cache.load_index(frame_key, gains, index_name)
+        if values is None:
+            with span('compute_index', index=index_name, frame=frame):
+                values = self.engine.compute_chunk(cube, [index_name], gains=gains)[index_name][0]
+            count('frames_indexed')
+            count('bytes_allocated', values.nbytes)
+            if frame_key:
+                # スライダー・先読みの経路で呼ばれるため、書き込みは待たない
+                self.processed_cache.save_index(frame_key, gains, index_name, values, background=True)
+        if not self.statistics.has_frame(index_name, frame):
+            self.record_statistics(index_name, frame, self.statistics.new_stats(index_name).update(values), version)
+        return self.encode_index(index_name, values)
+    
+    def compute_display_index(self, index_name, frame):
+        '''表示用に縮小した植生指数を計算（全解像度の指数はタイル単位で計算して破棄する）
+        統計量は縮小前の全解像度の値からタイルごとに集計する'''
+        version = self.index_store.version
+        stats = {index_name: self.statistics.new_stats(index_name)}
+        processor = TiledIndexProcessor([index_name], gains=self.frame_gains(frame), keep_full=False,
+                                        engine=self.engine)
+        result = processor.process(ArrayTileSource(self.frame_datacube(frame)), stats=stats)
+        self.record_statistics(index_name, frame, stats[index_name], version)
+        return self.encode_index(index_name, result['pyramid'][index_name][-1])
+    
+    def index_codec(self, index_name):
+        '''植生指数の量子化の設定（float32のまま保持する場合はNone、int16の範囲は表示範囲）'''
+        if index_name not in self.index_codecs:
+            vmin, vmax = COLORMAP_SETTINGS.get(index_name, ('', -1, 1))[1:3]
+            self.index_codecs[index_name] = make_codec(self.index_storage, vmin, vmax)
+        return self.index_codecs[index_name]
+    
+    def encode_index(self, index_name, values):
+        '''計算した植生指数(float32)を保持する形式に変換（統計量は変換前の値で集計済み）'''
+        codec = self.index_codec(index_name)
+        return values if codec is None else QuantizedIndex.encode(values, codec)
+    
+    def storage_report(self, frame=0, names=None):
+        '''植生指数ごとの量子化によるメモリの削減量と誤差（指定フレームで評価）'''
+        names = list(names or VEGINDEX_NAMES.values())
+        values = self.engine.compute_chunk(self.frame_datacube(frame)[np.newaxis], names,
+                                           gains=self.frame_gains(frame))
+        report = {}
+        for name in names:
+            codec = self.index_codec(name)
+            report[name] = None if codec is None else quantization_report(values[name][0], codec)
+        return report
+    
+    def record_statistics(self, index_name, frame, stats, version):
+        '''計算中に校正係数が変わっていなければフレームの統計量を登録'''
+        if version == self.index_store.version:
+            self.statistics.set_frame(index_name, frame, stats)
+    
+    @traced('compute_statistics')
+    def compute_statistics(self, names=None, chunk_size=8, progress=None, cancel=None):
+        '''未集計のフレームの植生指数をチャンク単位で計算し、統計量のみ集計する（指数は保持しない）
+        1回の走査でフライト全体の統計量が揃う。progress(done, total)・cancel(Event)は任意'''
+        names = list(names or VEGINDEX_NAMES.values())
+        version = self.index_store.version
+        total = self.get_datacube_len()
+        pending = [frame for frame in range(total)
+                   if not all(self.statistics.has_frame(name, frame) for name in names)]
+        for start in range(0, len(pending), chunk_size):
+            if cancel is not None and cancel.is_set():
+                break
+            frames = pending[start:start + chunk_size]
+            result = self.compute_frames(frames, names)
+            for name in names:
+                for values, frame in zip(result[name], frames):
+                    self.record_statistics(name, frame, self.statistics.new_stats(name).update(values), version)
+            if progress is not None:
+                progress(start + len(frames), len(pending))
+        return self.statistics
+    
+    def compute_frames(self, frames, names):
+        '''指定フレームの植生指数をまとめて計算して {名前: (n, h, w)} を返す（キャッシュ・統計量には加えない）'''
+        gains = self.gains[frames] if self.gains is not None and self.gains.ndim == 2 else self.gains
+        return self.engine.compute_chunk(self.raw_frames()[frames], names, gains=gains)
+    
+    def frame_summary(self, index_name, frame):
+        '''指定フレームの統計量の辞書（未集計ならNone）'''
+        stats = self.statistics.frame_stats(index_name, frame)
+        return None if stats is None else stats.summary()
+    
+    def segmentation_threshold(self, index_name, threshold='otsu', progress=None, cancel=None):
+        '''植生と土壌を分ける閾値（'otsu'ならフライト全体のヒストグラムから大津の方法で、Noneなら既定値）'''
+        if threshold is None:
+            return DEFAULT_THRESHOLDS.get(index_name, 0.0)
+        if threshold == 'otsu':
+            self.compute_statistics([index_name], progress=progress, cancel=cancel)
+            return otsu_threshold(self.statistics.flight_stats(index_name))
+        return float(threshold)
+    
+    @traced('compute_segmentation')
+    def compute_segmentation(self, index_name='ndvi', threshold='otsu', radius=DEFAULT_RADIUS,
+                             min_area=DEFAULT_MIN_BLOB_AREA, chunk_size=8, progress=None, cancel=None):
+        '''全フレームを植生・土壌に分け、フレームごとの被覆率と株の数・面積を (N,) の配列で求める
+        チャンク単位で指数の計算・マスクの整形・連結成分のラベル付けをまとめて行い、マスクは保持しない
+        閾値が'otsu'なら先に統計量を集計する（集計済みのフレームは計算しない）。結果はcanopy[index_name]にも保持'''
+        version = self.index_store.version
+        segmenter = Segmenter(self.segmentation_threshold(index_name, threshold, progress, cancel), radius, min_area)
+        total = self.get_datacube_len()
+        metrics = CanopyMetrics(index_name, segmenter, total)
+        for start in range(0, total, chunk_size):
+            if cancel is not None and cancel.is_set():
+                return metrics
+            frames = np.arange(start, min(start + chunk_size, total))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                values = self.compute_frames(frames, [index_name])[index_name]
+            metrics.set_frames(frames, segmenter.measure(values))
+            if progress is not None:
+                progress(frames[-1] + 1, total)
+        if version == self.index_store.version:
+            self.canopy[index_name] = metrics
+        return metrics
+    
+    def frame_mask(self, index_name, frame):
+        '''表示用の植生マスク（表示サイズの指数から作成、分割していなければNone）'''
+        metrics = self.canopy.get(index_name)
+        if metrics is None:
+            return None
+        return metrics.segmenter.masks(np.asarray(self.get_display_index(index_name, frame)))
+    
+    def get_display_index(self, index_name, frame):
+        '''表示用の植生指数（表示サイズ以下のフレームは全解像度のまま）'''
+        if self.display_factor == 1:
+            return self.get_index(index_name, frame)
+        return self.display_index_store.get(index_name, frame)
+    
+    def display_datacube(self, frame):
+        '''表示用の放射輝度datacube(uint8)（表示サイズより大きいフレームは縮小）'''
+        raw = self.frame_datacube(frame)
+        if self.display_factor == 1:
+            return raw
+        return TiledIndexProcessor(band_pyramid=True).process(ArrayTileSource(raw))['bands'][-1]
+    
+    def frame_gains(self, frame):
+        '''指定フレームの校正係数 (4,)（放射輝度のままならNone）'''
+        if self.gains is not None and self.gains.ndim == 2:
+            return self.gains[frame]
+        return self.gains
+    
+    def frame_cache_key(self, frame):
+        '''ディスクキャッシュ上のフレームのキー（キャッシュを使わない場合はNone）'''
+        if self.processed_cache is None or not self.datacube_store.frame_keys:
+            return None
+        if self.registration is not None:
+            return f"{self.datacube_store.frame_keys[frame]}-{self.registration.key}"
+        return self.datacube_store.frame_keys[frame]
+    
+    def raw_frames(self):
+        '''放射輝度(uint8)の (N, H, W, 4)（位置合わせが有効なら読み出し時に補正するビュー）'''
+        if self.registration is None:
+            return self.datacube_store.raw
+        return self.registration.view(self.datacube_store.raw)
+    
+    def frame_datacube(self, frame):
+        '''1フレームの放射輝度(uint8) (H, W, 4)
+        位置合わせした結果は直近の数フレーム分を保持し、植生指数ごと・表示ごとに補正し直さない'''
+        registration = self.registration
+        if registration is None:
+            return self.datacube_store.raw[frame]
+        with self._registered_lock:
+            cube = self._registered_frames.get(frame)
+            if cube is not None:
+                self._registered_frames.move_to_end(frame)
+                return cube
+        cube = registration.apply(self.datacube_store.raw[frame])
+        with self._registered_lock:
+            if registration is self.registration:
+                self._registered_frames[frame] = cube
+                while len(self._registered_frames) > REGISTERED_CACHE_FRAMES:
+                    self._registered_frames.popitem(last=False)
+        return cube
     
+    def estimate_registration(self, shift_cache=None, key=None):
+        '''バンドのずれを一部のフレームから推定（shift_cacheとkeyを渡すとフライト・カメラごとに保存済みの値を使う）'''
+        raw = self.datacube_store.raw
+        if shift_cache is not None and key is not None:
+            return shift_cache.get_or_estimate(key, raw, paths=self.datacube_store.paths)
+        return BandRegistration.estimate(raw[sample_frames(len(raw))])
     
-    def convert_to_8bit(self):
-        """画像を8ビットに変換して保存"""
-        return [img.convert('L') for img in self.image_tmp_list]
+    def set_registration(self, registration):
+        '''バンドの位置合わせを設定（Noneで解除）し、植生指数を再計算する'''
+        with self._registered_lock:
+            self.registration = registration
+            self._registered_frames.clear()
+        self.datacube_list.registration = registration
+        self.batch_process()
+    
+    def compute_indices(self, names=None, chunk_size=8):
+        '''全フレームの植生指数をチャンク単位で一括計算（エクスポート用）'''
+        return self.engine.compute(self.raw_frames(), names, gains=self.gains, chunk_size=chunk_size)
+    
+    def index_list(self, index_name):
+        '''登録済みの任意の植生指数の遅延リストを返す'''
+        return self.index_store.view(index_name, self.get_datacube_len)
+    
+    def get_index(self, index_name, frame):
+        '''指定フレームの植生指数を取得（エクスポート用）'''
+        return self.index_store.get(index_name, frame)
+    
+    def set_index_memory_budget(self, memory_budget):
+        '''植生指数キャッシュのメモリ上限（バイト）を設定'''
+        self.index_store.set_memory_budget(memory_budget)
     
     
     def create_datacube(self):
-        """データキューブ（4つのバンドを持つ3次元配列）を作成"""
-        band_height = int(self.image_8bit_list[0].size[1] / 4)
-        datacube_list = []
-        
-        for img in self.image_8bit_list:
-            img_array = np.array(img)
-            # 4つのバンドに分割
-            bands = [img_array[j * band_height:(j + 1) * band_height, :] for j in range(4)]
-            datacube = np.stack(bands, axis=-1).astype(np.float32)
-            # データクレンジング
-            datacube[np.isnan(datacube)] = 0
-            datacube[datacube < 1.] = 1.
-            datacube_list.append(datacube)
-        return datacube_list
+        """データキューブ（4つのバンドを持つ3次元配列）のビューを作成
+        実体はdatacube_storeのuint8配列で、float32への変換は参照時に行う"""
+        return DatacubeView(self.datacube_store)
     
     
     def calculate_ndvi(self):
-        '''NDVI計算'''
-        return [(dc[:, :, 3] - dc[:, :, 1]) / (dc[:, :, 3] + dc[:, :, 1]) for dc in self.datacube_list]
+        '''NDVI計算（全フレーム）'''
+        return list(self.compute_indices(['ndvi'])['ndvi'])
     
     def calculate_gndvi(self):
-        '''GNDVI計算'''
-        return [(dc[:, :, 3] - dc[:, :, 0]) / (dc[:, :, 3] + dc[:, :, 0]) for dc in self.datacube_list]
+        '''GNDVI計算（全フレーム）'''
+        return list(self.compute_indices(['gndvi'])['gndvi'])
     
     def calculate_ndre(self):
-        '''NDRE計算'''
-        return [(dc[:, :, 3] - dc[:, :, 2]) / (dc[:, :, 3] + dc[:, :, 2]) for dc in self.datacube_list]
+        '''NDRE計算（全フレーム）'''
+        return list(self.compute_indices(['ndre'])['ndre'])
     
     def calculate_cigreen(self):
-        '''CIgreen計算'''
-        return [(dc[:, :, 3] / dc[:, :, 0]) - 1 for dc in self.datacube_list]
+        '''CIgreen計算（全フレーム）'''
+        return list(self.compute_indices(['cigreen'])['cigreen'])
     
     def get_datacube_len(self):
-        return len(self.datacube_list)
+        return len(self.datacube_store)
+    
+    def render_band_image(self, frame, display_band):
+        '''指定バンドの表示用画像を作成（反射率変換後は最小値・最大値で正規化）'''
+        raw = self.display_datacube(frame)
+        if self.is_refconvert == 0:    # 反射率変換前：放射輝度のuint8をそのまま表示
+            display_image = raw if display_band == DATACUBE_BAND else raw[:, :, display_band - 1]
+            return Image.fromarray(np.ascontiguousarray(display_image))
+        
+        datacube = np.multiply(raw, self.frame_gains(frame), dtype=np.float32)
+        display_image = datacube if display_band == DATACUBE_BAND else datacube[:, :, display_band - 1]
+        img = (display_image - np.min(display_image)) / (np.max(display_image) - np.min(display_image))
+        return Image.fromarray((img * 255).astype(np.uint8))
     
     def get_panel_brightness(self, panel_img, rectangle_area):
         self.panel_img = panel_img
         self.rectangle_area = rectangle_area
-        self.panel_brightness = []
-        
-        # 原点座標と高さ、幅を取得
-        self.start_x = self.rectangle_area[0]
-        self.start_y = self.rectangle_area[1]
-        self.end_x = self.rectangle_area[2]
-        self.end_y = self.rectangle_area[3]
-        
-        for i in range(4):
-            self.panel_band = self.panel_img.crop((self.start_x, self.start_y+(i*512), self.end_x, self.end_y+(i*512)))
-            self.panel_brightness.append(round(np.mean(self.panel_band), 2))
+        self.panel_brightness = measure_panel_brightness(panel_img, rectangle_area, self.datacube_store.profile)
         return self.panel_brightness
     
     
+    @traced('convert_to_reflectance')
     def convert_to_reflectance(self):
-        '''全てのdatacube画像を放射輝度から反射率へ変換する'''
-        self.datacube_list = copy.deepcopy(self.datacube_list_copy)
-        ref_list = []   # 反射率変換されたdatacube画像を一時的に格納するリスト
-        for dc in self.datacube_list:
-            for i, value in enumerate(self.panel_brightness):
-                dc[:,:,i] = np.array((dc[:,:,i] / value) * 0.18)
-            ref_list.append(dc)
-        MultispectralImgModel.is_refconvert = 1 # 反射率変換フラグを1に
-        self.datacube_list = ref_list   # 上書き
+        '''全てのdatacube画像を放射輝度から反射率へ変換する（1枚のパネルを全フレームに適用）
+        datacubeはコピーせず、校正係数を設定するだけで読み出し時に適用される'''
+        self.panel_schedule = None
+        self.set_reflectance(True)
+    
+    def set_reflectance(self, enabled):
+        '''放射輝度と反射率の表示を切り替える（パネル範囲を変えた場合も再設定で反映）'''
+        if enabled and self.panel_brightness is None and not self.panel_schedule:
+            raise ValueError("標準化パネルの放射輝度が設定されていません")
+        if not enabled:
+            self.gains = None
+        elif self.panel_schedule:
+            self.gains = self.panel_schedule.gains
+        else:
+            self.gains = reflectance_gains(self.panel_brightness)
+        self.datacube_list.gains = self.gains
+        self.is_refconvert = 1 if enabled else 0
         
-        # 植生指数の再算出
+        # 植生指数の再算出（キャッシュを破棄し、参照時に再計算）
         self.batch_process()
+    
+    def add_panel_sample(self, panel_brightness, position, by_time=False):
+        '''フライト中のパネルを追加し、フレームごとに補間した係数で反射率に変換する
+        positionはフレーム番号（by_time=Trueならframe_positionsと同じ単位の撮影時刻）
+        補間の単位は最初のパネルで決まり、同じフライトで番号と時刻は混在できない'''
+        if self.panel_schedule is None:
+            self.panel_schedule = PanelSchedule(self.frame_positions(by_time), by_time=by_time)
+        elif self.panel_schedule.by_time != by_time:
+            raise ValueError("フレーム番号と撮影時刻のパネルは混在できません")
+        sample_id, frames = self.panel_schedule.add_sample(position, panel_brightness)
+        self.apply_panel_schedule(frames)
+        return sample_id
+    
+    def move_panel_sample(self, sample_id, position):
+        '''登録済みパネルの位置を変更（影響するフレームのみ再計算）'''
+        self.apply_panel_schedule(self.panel_schedule.move_sample(sample_id, position))
+    
+    def remove_panel_sample(self, sample_id):
+        '''登録済みパネルを削除（影響するフレームのみ再計算）'''
+        self.apply_panel_schedule(self.panel_schedule.remove_sample(sample_id))
+    
+    def apply_panel_schedule(self, frames):
+        '''補間した係数を適用し、係数が変わったフレームの植生指数のみ破棄'''
+        self.gains = self.panel_schedule.gains
+        self.datacube_list.gains = self.gains
+        self.is_refconvert = 0 if self.gains is None else 1
+        self.index_store.invalidate_frames(frames)
+        self.display_index_store.invalidate_frames(frames)
+        self.statistics.discard_frames(frames)
+        self.canopy.clear()     # 閾値（大津）がフライト全体のヒストグラムに依存するため全て破棄
+        self.calibration_version = self.index_store.version
+    
+    def append_frames(self, paths, workers=DEFAULT_WORKERS, sync=True):
+        '''フォルダに追加された画像をフレームの末尾に加え、追加したフレーム番号のrangeを返す
+        既存フレームや植生指数のキャッシュはそのままで、植生指数は新しいフレームの参照時に計算される
+        ワーカースレッドで読み込む場合はsync=Falseとし、完了後にメインスレッドでsync_framesを呼ぶ'''
+        frames = self.datacube_store.append(paths, workers=workers, frame_cache=self.processed_cache)
+        if sync:
+            self.sync_frames()
+        return frames
+    
+    def sync_frames(self):
+        '''ストアのフレーム数の増加（追加・バックグラウンドでの読み込み）にパネルの補間を合わせる'''
+        if self.panel_schedule is None:
+            return
+        start = len(self.panel_schedule.positions)
+        if start < self.get_datacube_len():
+            # 追加フレームの位置もパネルと同じ単位（フレーム番号または撮影時刻）で延長
+            frames = range(start, self.get_datacube_len())
+            self.panel_schedule.extend(self.frame_positions(self.panel_schedule.by_time, frames))
+            if self.gains is not None and self.gains.ndim == 2:
+                self.gains = self.panel_schedule.gains
+                self.datacube_list.gains = self.gains
+    
+    def frame_positions(self, by_time=False, frames=None):
+        '''各フレーム（framesを渡すとその番号のフレーム）の位置（フレーム番号、by_time=Trueなら撮影時刻[秒]）'''
+        frames = range(self.get_datacube_len()) if frames is None else frames
+        if by_time:
+            return self.datacube_store.capture_times(frames)
+        return np.array(frames)
 
 
 class Visualizer:
     def __init__(self, mul_img_model):
         self.mul_img_model = mul_img_model
-        self.cmap_init_figure()
+        self.colorbar_key = None    # 最後にカラーバーを作成した(カラーマップ, 最小値, 最大値)
+        self.cmap_fig = None    # matplotlibの図（make_colormapを初めて使う時に作成）
         
         
     def cmap_init_figure(self):
-        """初期カラーマップ表示を設定"""
-        self.cmap_fig, self.cmap_ax = plt.subplots(figsize=(7, 7), dpi=100)
+        """初期カラーマップ表示を設定（matplotlibはここで初めて読み込む）"""
+        from matplotlib.figure import Figure
+        self.cmap_fig = Figure(figsize=(7, 7), dpi=100)
+        self.cmap_ax = self.cmap_fig.add_subplot()
         # 初期表示はNDVIの最初の画像を表示
         self.im = self.cmap_ax.imshow(self.mul_img_model.ndvi_list[0], cmap='jet', vmin=-1, vmax=1)
         self.cmap_ax.set_aspect('equal', adjustable='box')
@@ -114,30 +458,51 @@ class Visualizer:
     
     def make_colormap(self, slider_value, vegindex_num):
         """選択された植生指数とスライダーの値に基づいてカラーマップを更新"""
-        # 植生指数とカラーマップの辞書
-        vegindex_dict = {1: self.mul_img_model.ndvi_list,
-                         2: self.mul_img_model.cigreen_list,
-                         3: self.mul_img_model.gndvi_list,
-                         4: self.mul_img_model.ndre_list}
-        cmap_dict = {1: 'jet', 2: 'viridis', 3: 'YlGn', 4: 'seismic'}
+        # 選択された植生指数に応じてデータとカラーマップを取得
+        index_name = VEGINDEX_NAMES[vegindex_num]
+        cmap, vmin, vmax, tick_interval = COLORMAP_SETTINGS[index_name]
         
-        # 選択された植生指数に応じてデータとカラーマップを更新
-        selected_index = vegindex_dict.get(vegindex_num)
-        cmap = cmap_dict.get(vegindex_num)
+        if self.cmap_fig is None:
+            self.cmap_init_figure()
         
         # 表示する画像とカラーマップを設定
-        self.im.set_data(selected_index[slider_value])
+        self.im.set_data(self.mul_img_model.get_index(index_name, slider_value))
         self.im.set_cmap(cmap)
-        
-        # CIgreenの場合、範囲を-1から10に設定
-        if vegindex_num == 2:
-            self.set_colorbar_range(-1, 10, tick_interval=1)
-        else:
-            self.set_colorbar_range(-1, 1, tick_interval=0.2)
+        self.set_colorbar_range(vmin, vmax, tick_interval)
         
         return self.cmap_fig
     
     
+    def render_colormap(self, slider_value, vegindex_num):
+        """ルックアップテーブルでカラーマップ画像を作成（matplotlibの再描画なし）
+        カラーバー画像は植生指数か範囲が変わった時のみ作成し、それ以外はNoneを返す"""
+        img = self.render_index_image(slider_value, vegindex_num)
+        return img, self.render_colorbar(vegindex_num, img.width)
+    
+    def render_index_image(self, slider_value, vegindex_num, mask=False):
+        """カラーマップ画像のみを作成（先読みスレッドからも呼ばれる）
+        mask=Trueなら植生マスク（分割済みの場合）を半透明で重ねる"""
+        index_name = VEGINDEX_NAMES[vegindex_num]
+        cmap, vmin, vmax, _ = COLORMAP_SETTINGS[index_name]
+        lut = get_lut(cmap, vmin, vmax)
+        values = self.mul_img_model.get_display_index(index_name, slider_value)
+        vegetation = self.mul_img_model.frame_mask(index_name, slider_value) if mask else None
+        if vegetation is None:
+            return lut.to_image(values)
+        rgb = lut.apply(values)[:, :, :3]
+        rgb[vegetation] = rgb[vegetation] * (1 - MASK_ALPHA) + np.multiply(MASK_COLOR, MASK_ALPHA)
+        return Image.fromarray(np.ascontiguousarray(rgb), mode='RGB')
+    
+    def render_colorbar(self, vegindex_num, width, setting=None):
+        """植生指数か範囲が変わった時のみカラーバー画像を作成（変更がなければNone）
+        setting（カラーマップ, 最小値, 最大値, 目盛り間隔）を渡すと指数の表示設定の代わりに使う（差・比の表示）"""
+        cmap, vmin, vmax, tick_interval = setting or COLORMAP_SETTINGS[VEGINDEX_NAMES[vegindex_num]]
+        if self.colorbar_key == (cmap, vmin, vmax):
+            return None
+        self.colorbar_key = (cmap, vmin, vmax)
+        return get_lut(cmap, vmin, vmax).colorbar_image(width, tick_interval)
+    
+    
     def set_colorbar_range(self, vmin, vmax, tick_interval):
         """カラーバーの範囲と目盛りを設定"""
         self.im.set_clim(vmin, vmax)
@@ -0,0 +1,80 @@
+import itertools
+import numpy as np
+
+PANEL_REFLECTANCE = 0.18
+
+
+class PanelSchedule:
+    """フライト中に撮影した複数の標準化パネルから、フレームごとの反射率変換係数を補間する
+    各パネルはフレーム番号または撮影時刻（positions と同じ単位）に対応付け、
+    パネルの放射輝度をバンドごとに線形補間する（範囲外は端のパネルの値を使用）"""
+    def __init__(self, positions, reflectance=PANEL_REFLECTANCE, by_time=False):
+        # positions: 各フレームの位置（by_time=Trueなら撮影時刻、Falseならフレーム番号）
+        self.positions = np.asarray(positions, dtype=np.float64)
+        self.reflectance = reflectance
+        self.by_time = by_time
+        self.samples = {}   # sample_id -> (位置, 放射輝度(4,))
+        self._ids = itertools.count()
+        self.gains = None   # (N, 4) float32
+
+    def __len__(self):
+        return len(self.samples)
+
+    def add_sample(self, position, panel_brightness):
+        """パネルを登録し、(sample_id, 係数が変わったフレーム番号の配列) を返す"""
+        sample_id = next(self._ids)
+        affected = self._affected_range(position)
+        self.samples[sample_id] = (float(position), np.asarray(panel_brightness, dtype=np.float64))
+        return sample_id, self._update(affected)
+
+    def move_sample(self, sample_id, position):
+        """パネルの位置を変更し、係数が変わったフレーム番号の配列を返す"""
+        old_position, brightness = self.samples[sample_id]
+        lo, hi = self._affected_range(old_position, exclude=sample_id)
+        new_lo, new_hi = self._affected_range(position, exclude=sample_id)
+        self.samples[sample_id] = (float(position), brightness)
+        return self._update((min(lo, new_lo), max(hi, new_hi)))
+
+    def remove_sample(self, sample_id):
+        """パネルを削除し、係数が変わったフレーム番号の配列を返す"""
+        affected = self._affected_range(self.samples[sample_id][0], exclude=sample_id)
+        del self.samples[sample_id]
+        return self._update(affected)
+
+    def extend(self, positions):
+        """フレームの追加に合わせて位置を追加し、追加したフレーム番号の配列を返す（既存フレームの係数は再計算しない）"""
+        start = len(self.positions)
+        self.positions = np.concatenate([self.positions, np.asarray(positions, dtype=np.float64)])
+        frames = np.arange(start, len(self.positions))
+        if self.gains is not None:
+            self.gains = np.concatenate([self.gains, self.gains_at(self.positions[frames])])
+        return frames
+
+    def _affected_range(self, position, exclude=None):
+        """位置positionのパネルの追加・削除で補間結果が変わる範囲（前後の隣接パネルの間）"""
+        others = sorted(p for sid, (p, _) in self.samples.items() if sid != exclude)
+        lower = [p for p in others if p <= position]
+        upper = [p for p in others if p >= position]
+        return (lower[-1] if lower else -np.inf, upper[0] if upper else np.inf)
+
+    def _update(self, affected):
+        """影響範囲のフレームのみ係数を再計算"""
+        if not self.samples:
+            self.gains = None
+            return np.arange(len(self.positions))
+        lo, hi = affected
+        if self.gains is None:
+            self.gains = np.empty((len(self.positions), 4), dtype=np.float32)
+            lo, hi = -np.inf, np.inf
+        frames = np.flatnonzero((self.positions >= lo) & (self.positions <= hi))
+        self.gains[frames] = self.gains_at(self.positions[frames])
+        return frames
+
+    def gains_at(self, positions):
+        """任意の位置の反射率変換係数 (len(positions), 4) を補間で求める"""
+        order = sorted(self.samples.values(), key=lambda sample: sample[0])
+        sample_positions = np.array([p for p, _ in order])
+        brightness = np.array([b for _, b in order])
+        interpolated = np.stack([np.interp(positions, sample_positions, brightness[:, band])
+                                 for band in range(brightness.shape[1])], axis=-1)
+        return (self.reflectance / interpolated).astype(np.float32)
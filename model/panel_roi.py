@@ -0,0 +1,115 @@
+import numpy as np
+from model.image_loader import split_bands
+from model.sensor_profile import DEFAULT_PROFILE
+
+# 飽和とみなす画素値（8bit）
+SATURATION_VALUE = 255
+
+
+def normalize_rect(rect, width, height):
+    """矩形 (x0, y0, x1, y1) を左上・右下の順に並べ、画像内の整数座標に収める"""
+    x0, y0, x1, y1 = rect
+    x0, x1 = sorted((int(round(x0)), int(round(x1))))
+    y0, y1 = sorted((int(round(y0)), int(round(y1))))
+    return (min(max(x0, 0), width), min(max(y0, 0), height),
+            min(max(x1, 0), width), min(max(y1, 0), height))
+
+
+def polygon_mask(vertices, width, height):
+    """多角形（頂点 (x, y) の列）の内側を表す(H, W)のマスクを作成（画素中心で判定）"""
+    vertices = np.asarray(vertices, dtype=np.float64)
+    x0, y0 = np.floor(vertices.min(axis=0)).astype(int)
+    x1, y1 = np.ceil(vertices.max(axis=0)).astype(int)
+    x0, y0, x1, y1 = normalize_rect((x0, y0, x1, y1), width, height)
+    mask = np.zeros((height, width), dtype=bool)
+    if x0 == x1 or y0 == y1:
+        return mask
+
+    # 外接矩形内の画素について、辺ごとに交差判定（偶奇規則）
+    px = np.arange(x0, x1) + 0.5
+    py = (np.arange(y0, y1) + 0.5)[:, np.newaxis]
+    inside = np.zeros((y1 - y0, x1 - x0), dtype=bool)
+    for (ax, ay), (bx, by) in zip(vertices, np.roll(vertices, -1, axis=0)):
+        if ay == by:
+            continue
+        crosses = (ay > py) != (by > py)
+        x_cross = ax + (py - ay) * (bx - ax) / (by - ay)
+        inside ^= crosses & (px < x_cross)
+    mask[y0:y1, x0:x1] = inside
+    return mask
+
+
+class PanelROIExtractor:
+    """標準化パネル(H, W, 4)から任意個のROIのバンド別統計量を求める
+    矩形ROIは積分画像を使うため、範囲の大きさに関係なく一定時間で平均・標準偏差・飽和画素数が求まる"""
+    def __init__(self, panel, saturation=SATURATION_VALUE):
+        self.panel = panel
+        self.saturation = saturation
+        self.height, self.width = panel.shape[:2]
+        # 積分画像（和・二乗和・飽和画素数）を全バンドまとめて作成 (H+1, W+1, 4)
+        values = panel.astype(np.int64)
+        self._sum = self._integral(values)
+        self._sq = self._integral(values * values)
+        self._sat = self._integral((panel >= saturation).astype(np.int64))
+
+    @classmethod
+    def from_image(cls, panel_img, profile=DEFAULT_PROFILE, saturation=SATURATION_VALUE):
+        """バンドが並んだパネル画像から作成（バンドの大きさは画像サイズとセンサープロファイルから算出）"""
+        return cls(split_bands(panel_img, profile, sanitize=False), saturation)
+
+    @staticmethod
+    def _integral(values):
+        integral = np.zeros((values.shape[0] + 1, values.shape[1] + 1) + values.shape[2:], dtype=np.int64)
+        np.cumsum(np.cumsum(values, axis=0), axis=1, out=integral[1:, 1:])
+        return integral
+
+    @staticmethod
+    def _box(integral, rects):
+        """積分画像から矩形ごとの合計を一括で求める (ROI数, 4)"""
+        x0, y0, x1, y1 = rects.T
+        return integral[y1, x1] - integral[y0, x1] - integral[y1, x0] + integral[y0, x0]
+
+    def rect_stats(self, rects, median=False):
+        """矩形ROIのリストの統計量を返す（各値は(ROI数, 4)の配列）
+        medianは積分画像で求められないため、median=Trueの場合のみ範囲を切り出して計算する"""
+        rects = np.array([normalize_rect(rect, self.width, self.height) for rect in rects],
+                         dtype=np.intp).reshape(-1, 4)
+        count = ((rects[:, 2] - rects[:, 0]) * (rects[:, 3] - rects[:, 1]))[:, np.newaxis]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = self._box(self._sum, rects) / count
+            var = self._box(self._sq, rects) / count - mean ** 2
+        stats = {'mean': mean,
+                 'std': np.sqrt(np.maximum(var, 0)),
+                 'saturated': self._box(self._sat, rects),
+                 'count': np.repeat(count, self.panel.shape[2], axis=1)}
+        if median:
+            stats['median'] = np.array([self._median(self.panel[y0:y1, x0:x1]) for x0, y0, x1, y1 in rects])
+        return stats
+
+    def mask_stats(self, masks):
+        """マスク（多角形など）ROIのリストの統計量を返す（各値は(ROI数, 4)の配列）"""
+        rows = [self._masked_stats(self.panel[mask]) for mask in masks]
+        return {key: np.array([row[key] for row in rows]) for key in ('mean', 'median', 'std', 'saturated', 'count')}
+
+    def polygon_stats(self, polygons):
+        """多角形ROI（頂点 (x, y) の列）のリストの統計量を返す"""
+        return self.mask_stats([polygon_mask(vertices, self.width, self.height) for vertices in polygons])
+
+    def _median(self, region):
+        pixels = region.reshape(-1, self.panel.shape[2])
+        if not len(pixels):
+            return np.full(self.panel.shape[2], np.nan)
+        return np.median(pixels, axis=0)
+
+    def _masked_stats(self, pixels):
+        """(画素数, 4)の画素からバンド別の統計量を求める"""
+        bands = self.panel.shape[2]
+        if not len(pixels):
+            nan = np.full(bands, np.nan)
+            return {'mean': nan, 'median': nan, 'std': nan,
+                    'saturated': np.zeros(bands, dtype=np.int64), 'count': np.zeros(bands, dtype=np.int64)}
+        return {'mean': pixels.mean(axis=0),
+                'median': np.median(pixels, axis=0),
+                'std': pixels.std(axis=0),
+                'saturated': (pixels >= self.saturation).sum(axis=0),
+                'count': np.full(bands, len(pixels))}
@@ -0,0 +1,164 @@
+import os
+import json
+import queue
+import hashlib
+import threading
+import numpy as np
+from model.instrumentation import count
+
+# ディスクキャッシュのデフォルト上限（バイト）
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+# バックグラウンドで書き込む植生指数の上限件数（超えた分は保存しない、キャッシュなので次回計算し直す）
+DEFAULT_WRITE_QUEUE = 8
+_HASH_CHUNK = 1024 * 1024
+
+
+def calibration_key(gains):
+    """校正係数をキャッシュキー用の文字列に変換（放射輝度のままなら'radiance'）"""
+    if gains is None:
+        return 'radiance'
+    return hashlib.sha1(np.asarray(gains, dtype=np.float32).tobytes()).hexdigest()[:12]
+
+
+class ProcessedCache:
+    """処理済みのdatacubeと植生指数をフレーム単位でディスクに保存するキャッシュ（NPZ形式）
+    キーは元ファイルのパス・更新日時・サイズ・内容のハッシュで、植生指数はさらに校正係数を含む
+    合計サイズが上限を超えると、最後に使われた日時が古いものから削除する
+    表示中に計算した植生指数は書き込み用のスレッドで保存する（スライダー操作中にディスクへの書き込みを待たない）"""
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES, write_queue=DEFAULT_WRITE_QUEUE):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._content_hashes = {}   # (パス, 更新日時, サイズ) -> 内容のハッシュ（_lockで保護）
+        self._writes = queue.Queue(maxsize=write_queue)    # (保存先, 配列の辞書)
+        self._writer = None     # 書き込み用のスレッド（初めてバックグラウンドで保存する時に開始）
+        self._unchecked_bytes = 0   # 前回の削除判定以降に書き込んだサイズ
+        self.hits = {'datacube': 0, 'index': 0}
+        self.misses = {'datacube': 0, 'index': 0}
+
+    def frame_key(self, path, variant=''):
+        """元ファイルのキー（パス・更新日時・サイズ・内容のハッシュ）
+        variantを指定するとキーに含める（同じファイルをバンド配置など別の設定で処理する場合）"""
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        signature = (path, stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            content_hash = self._content_hashes.get(signature)
+        if content_hash is None:
+            # ハッシュの計算中はロックを持たない（同じファイルを同時に計算しても結果は同じ）
+            digest = hashlib.blake2b(digest_size=16)
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(_HASH_CHUNK), b''):
+                    digest.update(block)
+            content_hash = digest.hexdigest()
+            with self._lock:
+                self._content_hashes[signature] = content_hash
+        parts = signature + (content_hash,) + ((variant,) if variant else ())
+        return hashlib.sha1(json.dumps(parts).encode('utf-8')).hexdigest()
+
+    def _path(self, key, suffix):
+        # 1ディレクトリのファイル数を抑えるため先頭2文字で振り分け
+        return os.path.join(self.cache_dir, key[:2], f"{key}{suffix}.npz")
+
+    def _load(self, path, kind, name):
+        try:
+            with np.load(path) as data:
+                value = data[name]
+        except (OSError, KeyError, ValueError):
+            with self._lock:
+                self.misses[kind] += 1
+            count(f"disk_cache_{kind}_miss")
+            return None
+        try:
+            os.utime(path)  # 最終使用日時を更新（削除の順序に使用）
+        except OSError:
+            pass
+        with self._lock:
+            self.hits[kind] += 1
+        count(f"disk_cache_{kind}_hit")
+        return value
+
+    def _save(self, path, compress, **arrays):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            (np.savez_compressed if compress else np.savez)(f, **arrays)
+        os.replace(tmp_path, path)  # 書きかけのファイルを読まないように置き換え
+        # 上限の5%分書き込むごとに削除判定（毎回ディレクトリを走査しないように）
+        with self._lock:
+            self._unchecked_bytes += os.path.getsize(path)
+            check = self._unchecked_bytes > self.max_bytes // 20
+            if check:
+                self._unchecked_bytes = 0
+        if check:
+            self.evict()
+
+    def load_datacube(self, key):
+        """保存済みのdatacube(H, W, 4)を読み込む（なければNone）"""
+        return self._load(self._path(key, ''), 'datacube', 'datacube')
+
+    def save_datacube(self, key, datacube):
+        """datacube(uint8)を圧縮して保存"""
+        self._save(self._path(key, ''), True, datacube=datacube)
+
+    def load_index(self, key, gains, index_name):
+        """保存済みの植生指数を読み込む（なければNone）"""
+        return self._load(self._path(key, f"-{calibration_key(gains)}-{index_name}"), 'index', 'values')
+
+    def save_index(self, key, gains, index_name, values, background=False):
+        """植生指数を保存（background=Trueなら書き込み用のスレッドに渡してすぐに戻る、valuesは変更しないこと）"""
+        path = self._path(key, f"-{calibration_key(gains)}-{index_name}")
+        if not background:
+            self._save(path, False, values=values)
+            return
+        with self._lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_worker, name='cache-writer', daemon=True)
+                self._writer.start()
+        try:
+            self._writes.put_nowait((path, {'values': values}))
+        except queue.Full:
+            count('disk_cache_write_dropped')
+
+    def _write_worker(self):
+        while True:
+            path, arrays = self._writes.get()
+            try:
+                self._save(path, False, **arrays)
+            except OSError:
+                count('disk_cache_write_failed')
+            finally:
+                self._writes.task_done()
+
+    def flush(self):
+        """バックグラウンドの書き込みが全て終わるまで待つ"""
+        self._writes.join()
+
+    def evict(self):
+        """合計サイズが上限を超えていれば、最終使用日時の古いものから削除"""
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith('.npz'):
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        return total
+
+    def summary(self):
+        """ヒット・ミスの集計を文字列で返す"""
+        return (f"キャッシュ datacube: ヒット{self.hits['datacube']} ミス{self.misses['datacube']}"
+                f" / 植生指数: ヒット{self.hits['index']} ミス{self.misses['index']}")
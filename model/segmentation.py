@@ -0,0 +1,248 @@
+import csv
+import numpy as np
+try:
+    from scipy import ndimage
+except ImportError:     # scipyがなければnumpyで連結成分を求める
+    ndimage = None
+
+# 植生と判定する既定の閾値（指数がこの値より大きい画素を植生とする）
+DEFAULT_THRESHOLDS = {'ndvi': 0.3, 'gndvi': 0.3, 'ndre': 0.2, 'cigreen': 1.0}
+# マスクの整形（オープニング・クロージング）の半径（画素、3x3の正方形をこの回数だけ重ねる）
+DEFAULT_RADIUS = 1
+# 株（連結成分）として数える最小の画素数（これより小さい成分はノイズとして数えない）
+DEFAULT_MIN_BLOB_AREA = 16
+# フレームごとの指標の名前（CSVの列順）
+METRIC_NAMES = ('cover', 'blobs', 'mean_blob_area', 'largest_blob')
+
+
+def otsu_threshold(stats):
+    """IndexStatsのヒストグラムから大津の方法で閾値を求める（クラス間分散が最大になるビンの境界）
+    範囲外の画素は両端のビンに含める。フライト全体のヒストグラムを渡せば全フレームで共通の閾値になる"""
+    counts = stats.histogram[1:-1].astype(np.float64)
+    counts[0] += stats.histogram[0]
+    counts[-1] += stats.histogram[-1]
+    edges = stats.bin_edges
+    centers = (edges[:-1] + edges[1:]) / 2
+    weight = np.cumsum(counts)
+    moment = np.cumsum(counts * centers)
+    total = weight[-1]
+    if not total:
+        return float((stats.vmin + stats.vmax) / 2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        between = (moment[-1] * weight - total * moment) ** 2 / (weight * (total - weight))
+    between[~np.isfinite(between)] = -1
+    return float(edges[int(np.argmax(between)) + 1])
+
+
+def _dilate(masks, radius):
+    """(N, h, w) のboolマスクを (2*radius+1) 四方の正方形で膨張（行・列に分けてずらしたマスクのOR）"""
+    out = masks.copy()
+    for _ in range(radius):
+        for axis in (-2, -1):
+            shifted = out.copy()
+            _shift_combine(shifted, out, axis, np.logical_or)
+            out = shifted
+    return out
+
+
+def _erode(masks, radius):
+    """(N, h, w) のboolマスクを正方形で収縮（画像の外は端の画素と同じとみなす）"""
+    out = masks.copy()
+    for _ in range(radius):
+        for axis in (-2, -1):
+            shifted = out.copy()
+            _shift_combine(shifted, out, axis, np.logical_and)
+            out = shifted
+    return out
+
+
+def _shift_combine(out, masks, axis, ufunc):
+    """outに上下（左右）に1画素ずらしたmasksをufuncで合成（フレームの軸はまたがない）"""
+    head = [slice(None)] * masks.ndim
+    tail = [slice(None)] * masks.ndim
+    head[axis], tail[axis] = slice(1, None), slice(None, -1)
+    head, tail = tuple(head), tuple(tail)
+    ufunc(out[head], masks[tail], out=out[head])
+    ufunc(out[tail], masks[head], out=out[tail])
+
+
+def clean_masks(masks, radius=DEFAULT_RADIUS):
+    """オープニング（孤立した画素の除去）とクロージング（小さな穴の充填）でマスクを整形"""
+    if radius <= 0:
+        return masks
+    opened = _dilate(_erode(masks, radius), radius)
+    return _erode(_dilate(opened, radius), radius)
+
+
+def label_components(masks):
+    """(N, h, w) のマスクの8近傍の連結成分に番号を付ける（0は背景、番号は連番とは限らないがフレームの順に大きくなる）
+    scipyがあればndimage.labelで全フレームを一度に処理し、なければnumpyのランのunion-findで求める"""
+    if ndimage is not None:
+        structure = np.zeros((3, 3, 3), dtype=bool)
+        structure[1] = True     # フレームの軸方向にはつながない
+        labels, _ = ndimage.label(masks, structure)
+        return labels
+    return _label_runs(masks)
+
+
+def _label_runs(masks):
+    """ランのunion-findで求めた連結成分を画素に書き込む（各成分の番号はその成分の最初のランの通し番号+1）"""
+    run_rows, starts, stops, roots = _merge_runs(masks)
+    width = masks.shape[-1]
+    # ランの範囲に番号を書き込む（開始位置に+番号、終わりに-番号を置いて行ごとに累積、ランの間は1画素以上空く）
+    delta = np.zeros((masks.size // width, width + 1), dtype=np.int64)
+    delta[run_rows, starts] = roots + 1
+    delta[run_rows, stops] = -(roots + 1)
+    return np.cumsum(delta, axis=1)[:, :width].reshape(masks.shape)
+
+
+def _merge_runs(masks):
+    """行ごとの連続した画素（ラン）を単位に、隣の行で重なるランを併合して連結成分を求める（union-find）
+    ランの抽出・隣接するランの組・根の付け替えはいずれも全フレームまとめて配列で処理する
+    (ランの行の通し番号, 開始列, 終了列（含まない）, 成分の根のラン番号) を返す"""
+    frame_count, height, width = masks.shape
+    rows = masks.reshape(-1, width)
+    padded = np.zeros((len(rows), width + 2), dtype=np.int8)
+    padded[:, 1:-1] = rows
+    # 各行の変化点は ランの開始, 終わり（含まない）, 開始, ... の順に交互に並ぶ
+    changes = np.flatnonzero(np.diff(padded, axis=1))
+    run_rows, columns = np.divmod(changes, width + 1)
+    run_rows, starts, stops = run_rows[0::2], columns[0::2], columns[1::2]
+    if not len(starts):
+        return run_rows, starts, stops, starts
+
+    # 次の行で重なる（斜めも含む）ランの範囲 [lo, hi)、フレームの最後の行は次のフレームとつながない
+    stride = width + 2
+    start_keys = run_rows * stride + starts
+    stop_keys = run_rows * stride + stops
+    next_row = (run_rows + 1) * stride
+    lo = np.searchsorted(stop_keys, next_row + starts, side='left')
+    hi = np.searchsorted(start_keys, next_row + stops, side='right')
+    counts = np.where((run_rows + 1) % height == 0, 0, np.maximum(hi - lo, 0))
+    first = np.repeat(np.arange(len(starts)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    second = np.repeat(lo, counts) + offsets
+
+    # 根の小さい方へ付け替え、経路を圧縮する（数回で収束する）
+    parent = np.arange(len(starts))
+    while True:
+        root_a, root_b = parent[first], parent[second]
+        active = root_a != root_b
+        if not active.any():
+            break
+        np.minimum.at(parent, np.maximum(root_a, root_b)[active], np.minimum(root_a, root_b)[active])
+        while True:
+            compressed = parent[parent]
+            if np.array_equal(compressed, parent):
+                break
+            parent = compressed
+    return run_rows, starts, stops, parent
+
+
+def blob_metrics(labels, min_area=DEFAULT_MIN_BLOB_AREA):
+    """フレームごとの株の数・平均面積・最大面積（min_area未満の成分は数えない）を (N,) の配列で返す
+    全フレームの成分の面積をまとめてbincountで数え、成分のフレームは番号の範囲から求める"""
+    frame_count = len(labels)
+    flat = labels.reshape(frame_count, -1)
+    areas = np.bincount(flat.ravel())
+    # 番号はフレームの順に大きくなるため、各フレームまでの最大の番号から成分のフレームが分かる
+    upper = np.maximum.accumulate(flat.max(axis=1))
+    label_frame = np.searchsorted(upper, np.arange(len(areas)), side='left')
+    return _summarize_blobs(label_frame, areas, frame_count, min_area)
+
+
+def _run_blob_metrics(masks, min_area=DEFAULT_MIN_BLOB_AREA):
+    """blob_metricsと同じ指標をランから求める（画素ごとの番号を作らないため、scipyがない場合はこちらが速い）"""
+    run_rows, starts, stops, roots = _merge_runs(masks)
+    areas = np.bincount(roots, weights=stops - starts, minlength=len(starts))
+    label_frame = run_rows // masks.shape[1]
+    return _summarize_blobs(label_frame, areas, len(masks), min_area, skip_background=False)
+
+
+def _summarize_blobs(label_frame, areas, frame_count, min_area, skip_background=True):
+    """成分ごとのフレームと面積からフレームごとの株の数・平均面積・最大面積を求める"""
+    keep = areas >= max(min_area, 1)
+    if skip_background:
+        keep[0] = False
+    kept_frames, kept_areas = label_frame[keep], areas[keep].astype(np.int64)
+    blobs = np.bincount(kept_frames, minlength=frame_count)
+    total_area = np.bincount(kept_frames, weights=kept_areas, minlength=frame_count)
+    largest = np.zeros(frame_count, dtype=np.int64)
+    np.maximum.at(largest, kept_frames, kept_areas)
+    mean_area = np.where(blobs > 0, total_area / np.maximum(blobs, 1), 0.0)
+    return {'blobs': blobs, 'mean_blob_area': mean_area, 'largest_blob': largest}
+
+
+class Segmenter:
+    """植生指数を閾値で植生・土壌に分け、マスクの整形と連結成分のラベル付けをフレームのまとまりで一度に行う"""
+    def __init__(self, threshold, radius=DEFAULT_RADIUS, min_area=DEFAULT_MIN_BLOB_AREA):
+        self.threshold = float(threshold)
+        self.radius = radius
+        self.min_area = min_area
+
+    def masks(self, values):
+        """植生指数 (N, h, w) または (h, w) から整形済みの植生マスク（NaNは土壌）"""
+        values = np.asarray(values)
+        single = values.ndim == 2
+        masks = clean_masks(np.greater(values, self.threshold, where=~np.isnan(values),
+                                       out=np.zeros(values.shape, dtype=bool)).reshape((-1,) + values.shape[-2:]),
+                            self.radius)
+        return masks[0] if single else masks
+
+    def measure(self, values):
+        """植生指数 (N, h, w) のフレームごとの被覆率と株の指標を (N,) の配列の辞書で返す
+        被覆率は有限な画素に対する植生の画素の割合"""
+        values = np.asarray(values)
+        masks = self.masks(values)
+        valid = np.count_nonzero(np.isfinite(values).reshape(len(values), -1), axis=1)
+        cover = np.count_nonzero(masks.reshape(len(masks), -1), axis=1) / np.maximum(valid, 1)
+        if ndimage is None:
+            blobs = _run_blob_metrics(masks, self.min_area)
+        else:
+            blobs = blob_metrics(label_components(masks), self.min_area)
+        return {'cover': cover, **blobs}
+
+
+class CanopyMetrics:
+    """フライト全体のフレームごとの被覆率・株の指標（フレーム番号で引ける (N,) の配列、未計算はNaN）
+    同じ閾値でマスクを作り直せるように使ったSegmenterも保持する"""
+    def __init__(self, index_name, segmenter, frame_count):
+        self.index_name = index_name
+        self.segmenter = segmenter
+        self.arrays = {name: np.full(frame_count, np.nan) for name in METRIC_NAMES}
+
+    @property
+    def threshold(self):
+        return self.segmenter.threshold
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def __len__(self):
+        return len(self.arrays['cover'])
+
+    def set_frames(self, frames, metrics):
+        for name in METRIC_NAMES:
+            self.arrays[name][frames] = metrics[name]
+
+    def frame(self, frame):
+        """1フレームの指標の辞書（未計算ならNone）"""
+        if frame >= len(self) or np.isnan(self.arrays['cover'][frame]):
+            return None
+        return {name: float(self.arrays[name][frame]) for name in METRIC_NAMES}
+
+    def export_csv(self, path, frame_names=None):
+        """フレームごとの指標をCSVに保存"""
+        fields = ['frame'] + (['name'] if frame_names else []) + list(METRIC_NAMES)
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=fields)
+            writer.writeheader()
+            for frame in range(len(self)):
+                row = self.frame(frame)
+                if row is None:
+                    continue
+                row['frame'] = frame
+                if frame_names:
+                    row['name'] = frame_names[frame]
+                writer.writerow(row)
+        return len(self)
@@ -0,0 +1,106 @@
+import json
+from model.vegindex_engine import BAND_INDEX
+
+# datacubeのチャンネルの並び（BAND_INDEXの順）
+CHANNEL_NAMES = tuple(sorted(BAND_INDEX, key=BAND_INDEX.get))
+LAYOUTS = ('vertical', 'horizontal')
+
+
+class SensorProfile:
+    """カメラごとのバンド配置（1枚のTIFFにバンドをどの順・向きに並べているか）
+    band_orderは画像上の並び順のバンド名で、datacubeは常にCHANNEL_NAMESの順に並べ替える"""
+    def __init__(self, name, band_order=CHANNEL_NAMES, layout='vertical'):
+        if layout not in LAYOUTS:
+            raise ValueError(f"未対応のバンド配置です: {layout}")
+        if sorted(band_order) != sorted(CHANNEL_NAMES):
+            raise ValueError(f"バンドは {', '.join(CHANNEL_NAMES)} を1つずつ指定してください: {band_order}")
+        self.name = name
+        self.band_order = tuple(band_order)
+        self.layout = layout
+        # datacubeのチャンネルごとの画像上の位置
+        self.positions = [self.band_order.index(channel) for channel in CHANNEL_NAMES]
+
+    @property
+    def band_count(self):
+        return len(self.band_order)
+
+    @property
+    def key(self):
+        """配置を表す文字列（キャッシュのキーに使う、同じ名前で配置の異なるプロファイルも区別する）"""
+        return f"{self.name}:{'-'.join(self.band_order)}:{self.layout}"
+
+    def to_dict(self):
+        return {'name': self.name, 'band_order': list(self.band_order), 'layout': self.layout}
+
+    @classmethod
+    def from_dict(cls, value):
+        return cls(value['name'], value.get('band_order', CHANNEL_NAMES), value.get('layout', 'vertical'))
+
+    def band_shape(self, image_size):
+        """画像サイズ (W, H) から1バンドの形状 (h, w) を求める"""
+        width, height = image_size
+        if self.layout == 'vertical':
+            return height // self.band_count, width
+        return height, width // self.band_count
+
+    def image_size(self, band_shape):
+        """1バンドの形状 (h, w) から画像サイズ (W, H) を求める"""
+        height, width = band_shape
+        if self.layout == 'vertical':
+            return width, height * self.band_count
+        return width * self.band_count, height
+
+    def band_rect(self, channel, image_size):
+        """チャンネル（datacube上の番号）のバンドの画像上の範囲 (x0, y0, x1, y1)"""
+        height, width = self.band_shape(image_size)
+        position = self.positions[channel]
+        if self.layout == 'vertical':
+            return 0, position * height, width, (position + 1) * height
+        return position * width, 0, (position + 1) * width, height
+
+    def split(self, img_array):
+        """画像の配列 (H, W) をバンドに分割し、(h, w, 4) を返す（並べ替えがなければコピーなしのビュー）"""
+        height, width = self.band_shape((img_array.shape[1], img_array.shape[0]))
+        if self.layout == 'vertical':
+            bands = img_array[:height * self.band_count].reshape(self.band_count, height, width)
+        else:
+            bands = img_array[:, :width * self.band_count].reshape(height, self.band_count, width).transpose(1, 0, 2)
+        if self.positions != sorted(self.positions):
+            bands = bands[self.positions]   # バンドの並べ替え（この場合のみコピー）
+        return bands.transpose(1, 2, 0)
+
+
+# 既定のプロファイル（縦に Green, Red, RedEdge, NIR）
+DEFAULT_PROFILE = SensorProfile('stacked-grne')
+# 横に Green, Red, RedEdge, NIR を並べるカメラ
+SIDE_BY_SIDE_PROFILE = SensorProfile('side-grne', layout='horizontal')
+PROFILES = {profile.name: profile for profile in (DEFAULT_PROFILE, SIDE_BY_SIDE_PROFILE)}
+
+
+def register_profile(profile):
+    """プロファイルを名前で登録（コマンドラインなどから選べるように）"""
+    PROFILES[profile.name] = profile
+    return profile
+
+
+def get_profile(name):
+    """登録済みのプロファイルを名前で取得"""
+    try:
+        return PROFILES[name]
+    except KeyError:
+        raise ValueError(f"未登録のセンサープロファイルです: {name}") from None
+
+
+def load_profiles(path):
+    """JSONファイルのプロファイルを読み込んで登録し、リストで返す
+    {"name": 名前, "band_order": [画像上の並び順のバンド名], "layout": "vertical"または"horizontal"}
+    またはそのリスト（band_orderとlayoutは省略可）"""
+    with open(path, encoding='utf-8') as f:
+        values = json.load(f)
+    values = values if isinstance(values, list) else [values]
+    try:
+        profiles = [SensorProfile.from_dict(value) for value in values]
+    except (KeyError, TypeError) as e:
+        raise ValueError(f"プロファイルの形式が正しくありません: {path}") from e
+    return [register_profile(profile) for profile in profiles]
+
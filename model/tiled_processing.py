@@ -0,0 +1,186 @@
+import numpy as np
+from PIL import Image
+from model.sensor_profile import DEFAULT_PROFILE
+from model.vegindex_engine import VegIndexEngine
+from model.index_codec import QuantizedIndex
+
+# 1タイルの行数（バンド上の行数、作業メモリはおよそ 行数 x 幅 x 40バイト）
+DEFAULT_TILE_ROWS = 256
+# GUIの表示サイズ（ピラミッドはこの大きさに収まるまで作成）
+DISPLAY_SIZE = 512
+
+
+def pyramid_factors(band_shape, display_size=DISPLAY_SIZE):
+    """ピラミッドの各レベルの縮小率 [1, 2, 4, ...]（最後のレベルがdisplay_sizeに収まる）"""
+    factors = [1]
+    while max(band_shape) // factors[-1] > display_size:
+        factors.append(factors[-1] * 2)
+    return factors
+
+
+def downsample(values, factor=2):
+    """先頭2軸をfactor x factorのブロック平均で縮小（端の余りは切り捨て、float32で返す）
+    ブロック内の位置ごとに間引いた配列を足し合わせる（軸をまたぐmeanより数倍速い）"""
+    height, width = values.shape[0] // factor * factor, values.shape[1] // factor * factor
+    out = np.zeros((height // factor, width // factor) + values.shape[2:], dtype=np.float32)
+    for dy in range(factor):
+        for dx in range(factor):
+            out += values[dy:height:factor, dx:width:factor]
+    out *= 1 / (factor * factor)
+    return out
+
+
+class ArrayTileSource:
+    """メモリ上（またはメモリマップ）のdatacube(h, w, 4)をタイルとして読み出す"""
+    def __init__(self, datacube):
+        self.datacube = datacube
+        self.band_shape = datacube.shape[:2]
+
+    def read_tile(self, y0, y1):
+        return self.datacube[y0:y1]
+
+
+class TiledFrameReader:
+    """TIFFのストリップから必要な行だけを読み出し、バンドのタイル(行数, w, 4)を作成する
+    非圧縮8bitのストリップはファイルから直接読み、圧縮されている場合は1度だけ全体をデコードする"""
+    def __init__(self, path, profile=DEFAULT_PROFILE):
+        self.path = path
+        self.profile = profile
+        with Image.open(path) as img:
+            self.size = img.size
+            self._strips = self._raw_strips(img)
+        self.band_shape = profile.band_shape(self.size)
+        self._file = open(path, 'rb') if self._strips is not None else None
+        self._decoded = None
+        self._last_rows = (None, None)  # 横並びのバンドで同じ行を繰り返し読まないように
+
+    @staticmethod
+    def _raw_strips(img):
+        """非圧縮8bitのストリップなら [(開始行, 終了行, ファイル上の位置)] を返す（それ以外はNone）"""
+        if img.mode != 'L':
+            return None
+        strips = []
+        for codec, (x0, y0, x1, y1), offset, args in img.tile:
+            args = args if isinstance(args, tuple) else (args,)
+            mode, stride, orientation = (args + (0, 1))[:3]
+            if (codec != 'raw' or mode != 'L' or x0 != 0 or x1 != img.size[0]
+                    or stride not in (0, img.size[0]) or orientation != 1):
+                return None
+            strips.append((y0, y1, offset))
+        return strips
+
+    def _rows(self, y0, y1):
+        """画像のy0行目からy1行目までを(行数, W)のuint8配列で返す"""
+        if self._last_rows[0] == (y0, y1):
+            return self._last_rows[1]
+        if self._strips is None:
+            if self._decoded is None:
+                with Image.open(self.path) as img:
+                    self._decoded = np.asarray(img.convert('L'))
+            rows = self._decoded[y0:y1]
+        else:
+            width = self.size[0]
+            rows = np.empty((y1 - y0, width), dtype=np.uint8)
+            for strip_y0, strip_y1, offset in self._strips:
+                start, stop = max(y0, strip_y0), min(y1, strip_y1)
+                if start >= stop:
+                    continue
+                self._file.seek(offset + (start - strip_y0) * width)
+                if self._file.readinto(rows[start - y0:stop - y0]) != (stop - start) * width:
+                    raise OSError(f"ストリップの読み込みに失敗しました: {self.path}")
+        self._last_rows = ((y0, y1), rows)
+        return rows
+
+    def read_tile(self, y0, y1):
+        """バンド上のy0行目からy1行目までのタイル(行数, w, 4)を読み出す（0は1に置き換え）"""
+        tile = np.empty((y1 - y0, self.band_shape[1], len(self.profile.positions)), dtype=np.uint8)
+        for channel in range(tile.shape[2]):
+            x0, band_y0, x1, _ = self.profile.band_rect(channel, self.size)
+            tile[..., channel] = self._rows(band_y0 + y0, band_y0 + y1)[:, x0:x1]
+        return np.maximum(tile, 1, out=tile)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._decoded = None
+        self._last_rows = (None, None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class TiledIndexProcessor:
+    """大きなフレームを行方向のタイルに分けて植生指数を計算する（作業メモリはタイルの大きさで決まる）
+    表示用に1/2, 1/4, ...に縮小したピラミッドも同時に作成する"""
+    def __init__(self, index_names=(), gains=None, tile_rows=DEFAULT_TILE_ROWS, display_size=DISPLAY_SIZE,
+                 engine=None, keep_full=True, band_pyramid=False):
+        self.index_names = list(index_names)
+        self.gains = gains  # このフレームの校正係数 (4,)
+        self.tile_rows = tile_rows
+        self.display_size = display_size
+        self.engine = engine or VegIndexEngine()
+        self.keep_full = keep_full          # Falseなら全解像度の指数を保持せずピラミッドのみ作成
+        self.band_pyramid = band_pyramid    # Trueならバンド画像(uint8)のピラミッドも作成
+
+    def process(self, source, outputs=None, stats=None, codecs=None):
+        """source（TiledFrameReaderまたはArrayTileSource）の全タイルを処理して結果の辞書を返す
+        outputs {名前: (h, w)の配列} を渡すと全解像度の指数をそこへ書き込む（メモリマップファイルなど）
+        stats {名前: IndexStats} を渡すと全解像度の指数をタイルごとに統計量へ加える
+        codecs {名前: コーデック} を渡すとその指数はタイルごとに量子化して保持する（indicesはQuantizedIndex）
+        結果: {'factors': 縮小率, 'indices': {名前: 全解像度}, 'pyramid': {名前: [レベル...]}, 'bands': [レベル...]}
+        ピラミッドのレベルはfactors[1:]に対応する（縮小不要な大きさなら空）"""
+        height, width = source.band_shape
+        factors = pyramid_factors((height, width), self.display_size)
+        # タイルの境界が全レベルのブロックに揃うように行数を調整
+        tile_rows = -(-self.tile_rows // factors[-1]) * factors[-1]
+
+        codecs = codecs or {}
+        full = {}
+        for name in self.index_names:
+            if outputs is not None and name in outputs:
+                full[name] = outputs[name]
+            elif self.keep_full:
+                dtype = codecs[name].dtype if name in codecs else np.float32
+                full[name] = np.empty((height, width), dtype=dtype)
+        scratch = {name: np.empty((tile_rows, width), dtype=np.float32) for name in self.index_names}
+        pyramid = {name: [np.empty((height // f, width // f), dtype=np.float32) for f in factors[1:]]
+                   for name in self.index_names}
+        bands = [np.empty((height // f, width // f, 4), dtype=np.uint8) for f in factors[1:]] \
+            if self.band_pyramid else []
+
+        for y0 in range(0, height, tile_rows):
+            y1 = min(y0 + tile_rows, height)
+            tile = source.read_tile(y0, y1)
+            out = {name: (full[name][y0:y1] if name in full and name not in codecs
+                          else scratch[name][:y1 - y0])[np.newaxis]
+                   for name in self.index_names}
+            if self.index_names:
+                self.engine.compute_chunk(tile[np.newaxis], self.index_names, out, self.gains)
+            for name in self.index_names:
+                if name in codecs and name in full:
+                    full[name][y0:y1] = codecs[name].encode(out[name][0])
+                self._fill_levels(pyramid[name], out[name][0], y0, factors)
+                if stats is not None and name in stats:
+                    stats[name].update(out[name][0])
+            if bands:
+                self._fill_levels(bands, tile, y0, factors)
+
+        return {'factors': factors,
+                'indices': {name: (QuantizedIndex(full[name], codecs[name]) if name in codecs and name in full
+                                   else full.get(name)) for name in self.index_names},
+                'pyramid': pyramid,
+                'bands': bands}
+
+    @staticmethod
+    def _fill_levels(levels, tile, y0, factors):
+        """タイルを順に2倍ずつ縮小し、各レベルの対応する行に書き込む"""
+        reduced = tile
+        for level, factor in zip(levels, factors[1:]):
+            reduced = downsample(reduced)
+            start = y0 // factor
+            rows = min(len(reduced), len(level) - start)
+            level[start:start + rows] = np.rint(reduced[:rows]) if level.dtype == np.uint8 else reduced[:rows]
@@ -0,0 +1,147 @@
+import numpy as np
+
+# datacubeのバンド並び（縦に Green, Red, RedEdge, NIR）
+BAND_INDEX = {'green': 0, 'red': 1, 'rededge': 2, 'nir': 3}
+DEFAULT_CHUNK_SIZE = 8
+
+
+class BandTerms:
+    """チャンク(n, H, W, 4)のバンド配列と共有項を必要時に1度だけ作成して使い回す"""
+    def __init__(self, cube, gains=None):
+        self.cube = cube
+        self.gains = None if gains is None else np.asarray(gains, dtype=np.float32)
+        self._cache = {}
+
+    @property
+    def shape(self):
+        return self.cube.shape[:-1]
+
+    def band(self, name):
+        """float32のバンド配列（校正係数を適用済み）"""
+        key = ('band', name)
+        if key not in self._cache:
+            k = BAND_INDEX[name]
+            if self.gains is None:
+                band = self.cube[..., k].astype(np.float32)
+            else:
+                # gainsは(4,)またはフレームごとの(n, 4)、変換と乗算を1回で行う
+                gain = self.gains[..., k]
+                gain = gain.reshape(gain.shape + (1, 1)) if gain.ndim else gain
+                band = np.multiply(self.cube[..., k], gain, dtype=np.float32)
+            self._cache[key] = band
+        return self._cache[key]
+
+    def sum(self, a, b):
+        """バンドの和（NIR+Redなど複数の指数で共有）"""
+        key = ('sum',) + tuple(sorted((a, b)))
+        if key not in self._cache:
+            self._cache[key] = np.add(self.band(a), self.band(b))
+        return self._cache[key]
+
+    def diff(self, a, b):
+        """バンドの差（NIR-Redなど複数の指数で共有）"""
+        key = ('diff', a, b)
+        if key not in self._cache:
+            self._cache[key] = np.subtract(self.band(a), self.band(b))
+        return self._cache[key]
+
+
+def normalized_difference(a, b):
+    """(a - b) / (a + b) 型の指数の計算式を作成"""
+    def formula(terms, out):
+        np.divide(terms.diff(a, b), terms.sum(a, b), out=out)
+    return formula
+
+
+def chlorophyll_index(a, b):
+    """a / b - 1 型の指数（CIgreenなど）の計算式を作成"""
+    def formula(terms, out):
+        np.divide(terms.band(a), terms.band(b), out=out)
+        out -= 1
+    return formula
+
+
+def savi(terms, out, soil_factor=0.5):
+    '''SAVI = (1 + L)(NIR - Red) / (NIR + Red + L)'''
+    np.add(terms.sum('nir', 'red'), soil_factor, out=out)
+    np.divide(terms.diff('nir', 'red'), out, out=out)
+    out *= 1 + soil_factor
+
+
+def evi2(terms, out):
+    '''EVI2 = 2.5(NIR - Red) / (NIR + 2.4Red + 1)'''
+    np.multiply(terms.band('red'), 2.4, out=out)
+    out += terms.band('nir')
+    out += 1
+    np.divide(terms.diff('nir', 'red'), out, out=out)
+    out *= 2.5
+
+
+def msavi(terms, out):
+    '''MSAVI = (2NIR + 1 - sqrt((2NIR + 1)^2 - 8(NIR - Red))) / 2'''
+    nir2 = terms.band('nir') * 2 + 1
+    np.square(nir2, out=out)
+    out -= 8 * terms.diff('nir', 'red')
+    np.sqrt(out, out=out)
+    np.subtract(nir2, out, out=out)
+    out /= 2
+
+
+DEFAULT_FORMULAS = {
+    'ndvi': normalized_difference('nir', 'red'),
+    'gndvi': normalized_difference('nir', 'green'),
+    'ndre': normalized_difference('nir', 'rededge'),
+    'cigreen': chlorophyll_index('nir', 'green'),
+    'savi': savi,
+    'evi2': evi2,
+    'msavi': msavi,
+}
+
+
+class VegIndexEngine:
+    """(N, H, W, 4)のdatacubeから複数の植生指数をチャンク単位で一括計算
+    計算式は formula(terms, out) の形で登録し、termsの共有項を使って out に書き込む"""
+    def __init__(self, formulas=None):
+        self.formulas = dict(DEFAULT_FORMULAS if formulas is None else formulas)
+
+    def register(self, name, formula):
+        """植生指数の計算式を登録"""
+        self.formulas[name] = formula
+
+    @property
+    def index_names(self):
+        return list(self.formulas)
+
+    def compute_chunk(self, cube, names, out=None, gains=None):
+        """1チャンク分の指数を計算して {名前: (n, H, W)} を返す（outを渡すとそこへ書き込む）"""
+        terms = BandTerms(cube, gains)
+        if out is None:
+            out = {name: np.empty(terms.shape, dtype=np.float32) for name in names}
+        for name in names:
+            self.formulas[name](terms, out[name])
+        return out
+
+    def iter_chunks(self, cube, names, gains=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        """チャンクごとに (開始フレーム, {名前: 配列}) を返すストリーム処理用ジェネレータ
+        出力バッファは使い回すため、保持する場合は呼び出し側でコピーする"""
+        gains = None if gains is None else np.asarray(gains, dtype=np.float32)
+        buffers = None
+        for start in range(0, len(cube), chunk_size):
+            chunk = cube[start:start + chunk_size]
+            if buffers is None or len(chunk) != chunk_size:
+                buffers = {name: np.empty(chunk.shape[:-1], dtype=np.float32) for name in names}
+            chunk_gains = gains[start:start + chunk_size] if gains is not None and gains.ndim == 2 else gains
+            yield start, self.compute_chunk(chunk, names, buffers, chunk_gains)
+
+    def compute(self, cube, names=None, out=None, gains=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        """datacube全体の指数を計算して {名前: (N, H, W)} を返す"""
+        names = names or self.index_names
+        if out is None:
+            out = {name: np.empty(cube.shape[:-1], dtype=np.float32) for name in names}
+        gains = None if gains is None else np.asarray(gains, dtype=np.float32)
+        for start in range(0, len(cube), chunk_size):
+            stop = min(start + chunk_size, len(cube))
+            chunk_gains = gains[start:stop] if gains is not None and gains.ndim == 2 else gains
+            self.compute_chunk(cube[start:stop], names,
+                               {name: out[name][start:stop] for name in names}, chunk_gains)
+        return out
@@ -1,15 +1,22 @@
 import tkinter as tk
 import customtkinter
-from PIL import Image, ImageTk
-import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-from matplotlib.figure import Figure
-from model.multispectral_img_model import MultispectralImgModel
+from PIL import ImageTk
 
 # 定数設定
 FONT_TYPE = "meiryo"
 WINDOW_SIZE = "1350x750"
+# 画像表示領域の大きさ（これより大きい画像は縦横比を保って縮小）
+DISPLAY_SIZE = 512
+# 比較の表示の選択肢と比較の方法（Noneは比較しない）
+COMPARE_MODES = {"比較しない": None, "差分": 'diff', "比": 'ratio'}
+# センサープロファイルの選択肢のうち、JSONファイルから読み込む項目
+PROFILE_LOAD_CHOICE = "ファイルから読み込み..."
+
+
+def fit_size(size, display_size=DISPLAY_SIZE):
+    """縦横比を保ってdisplay_size四方に収まる表示サイズ"""
+    scale = display_size / max(size)
+    return max(1, round(size[0] * scale)), max(1, round(size[1] * scale))
 
 class ApplicationView(customtkinter.CTk):
     def __init__(self, controller):
@@ -51,7 +58,7 @@ class MenuFrame(customtkinter.CTkFrame):
         """フォルダ選択、処理開始、ラジオボタンなどのウィジェットを作成"""
         self.create_button('フォルダ選択', 0, self.controller.select_dir_callback)
         self.label_dir_name = self.create_label('フォルダ名: なし', 1)
-        self.create_button('前処理開始', 2, self.controller.start_processing_callback, "#696969")
+        self.button_start = self.create_button('前処理開始', 2, self.controller.start_processing_callback, "#696969")
 
         # バンド選択ラジオボタン
         self.create_label('表示するバンドを選択', 3, pady=(50, 0))
@@ -67,11 +74,48 @@ class MenuFrame(customtkinter.CTkFrame):
 
         # 反射率変換実行ボタン
         self.create_button("反射率変換", 14, self.controller.reflectance_event)
+        # 放射輝度と反射率の表示切り替え（反射率変換後に有効）
+        self.switch_reflectance = customtkinter.CTkSwitch(self, text="反射率で表示", state="disabled",
+                                                          command=self.controller.switch_reflectance_event)
+        self.switch_reflectance.grid(row=17, padx=10, pady=(30, 0), sticky="w")
+        # バンドの位置合わせ（レンズごとのずれを補正）
+        self.switch_registration = customtkinter.CTkSwitch(self, text="バンド位置合わせ",
+                                                           command=self.controller.registration_event)
+        self.switch_registration.grid(row=18, padx=10, pady=(10, 0), sticky="w")
+        # フォルダ監視（撮影中に追加された画像を順次読み込む）
+        self.switch_watch = customtkinter.CTkSwitch(self, text="フォルダ監視", command=self.controller.switch_watch_event)
+        self.switch_watch.grid(row=19, padx=10, pady=(10, 0), sticky="w")
+        # 処理時間・カウンタの表示とトレースの保存
+        self.switch_metrics = customtkinter.CTkSwitch(self, text="計測を表示", command=self.controller.metrics_event)
+        self.switch_metrics.grid(row=20, padx=10, pady=(10, 0), sticky="w")
+        customtkinter.CTkButton(self, text="トレース保存", command=self.controller.save_trace_callback,
+                                width=100).grid(row=21, padx=10, pady=(10, 0), sticky="w")
+        # フライト全体のモザイク（クリックしたフレームへ移動）
+        customtkinter.CTkButton(self, text="モザイク表示", command=self.controller.mosaic_callback,
+                                width=100).grid(row=22, padx=10, pady=(10, 0), sticky="w")
+        # カメラのバンド配置（次の前処理開始から使う）
+        self.option_profile = customtkinter.CTkOptionMenu(self, values=self.controller.profile_choices(), width=150,
+                                                          command=self.controller.profile_event)
+        self.option_profile.grid(row=23, padx=10, pady=(10, 0), sticky="w")
+        
+        # 画像読み込みの進捗表示
+        self.label_progress = self.create_label('読み込み: -', 15, pady=(30, 0))
+        progress_frame = customtkinter.CTkFrame(self, fg_color="transparent")
+        progress_frame.grid(row=16, padx=10, pady=(5, 0), sticky="w")
+        self.progress_bar = customtkinter.CTkProgressBar(progress_frame, width=90)
+        self.progress_bar.grid(row=0, column=0, sticky="w")
+        self.progress_bar.set(0)
+        # 読み込みの中止（処理中のみ有効）
+        self.button_cancel = customtkinter.CTkButton(progress_frame, text="中止", width=45, state="disabled",
+                                                     command=self.controller.cancel_processing_callback)
+        self.button_cancel.grid(row=0, column=1, padx=(5, 0))
         
         
     def create_button(self, text, row, command, color=None):
         """ボタンウィジェットを作成"""
-        customtkinter.CTkButton(self, text=text, command=command, fg_color=color).grid(row=row, padx=10, pady=(30, 0), sticky="w")
+        button = customtkinter.CTkButton(self, text=text, command=command, fg_color=color)
+        button.grid(row=row, padx=10, pady=(30, 0), sticky="w")
+        return button
 
     def create_label(self, text, row, pady=(10, 0)):
         """ラベルウィジェットを作成"""
@@ -79,6 +123,16 @@ class MenuFrame(customtkinter.CTkFrame):
         label.grid(row=row, padx=10, pady=pady, sticky="w")
         return label
     
+    def set_processing(self, processing):
+        """処理中は開始ボタンを無効にし、中止ボタンを有効にする"""
+        self.button_start.configure(state="disabled" if processing else "normal")
+        self.button_cancel.configure(state="normal" if processing else "disabled")
+    
+    def update_progress(self, done, total):
+        """画像読み込みの進捗を表示"""
+        self.progress_bar.set(done / total if total else 0)
+        self.label_progress.configure(text=f"読み込み: {done}/{total}")
+    
     def create_radio_buttons(self, options, variable, start_row, command):
         """ラジオボタンウィジェットを一括で作成"""
         for idx, (text, value) in enumerate(options, start=start_row):
@@ -93,7 +147,7 @@ class SpectralImgFrame(customtkinter.CTkFrame):
         super().__init__(window, width=width, height=height)
         self.controller = window.controller
         self.canvas = None
-        self.image_label = customtkinter.CTkLabel(self, width=512, height=512, text="スペクトル画像",
+        self.image_label = customtkinter.CTkLabel(self, width=DISPLAY_SIZE, height=DISPLAY_SIZE, text="スペクトル画像",
                                                   fg_color="transparent", font=window.fonts)
         self.image_label.grid(row=0, column=0, columnspan=3, padx=10, pady=(10, 20), sticky="n")
     
@@ -101,7 +155,8 @@ class SpectralImgFrame(customtkinter.CTkFrame):
         """スライダーウィジェットを作成し、スライダーおよびボタンを配置"""
         self.img_len = img_len - 1
         self.slider = customtkinter.CTkSlider(
-            self, width=400, from_=0, to=self.img_len, number_of_steps=self.img_len, command=self.controller.slider_event
+            self, width=400, from_=0, to=max(self.img_len, 1), number_of_steps=max(self.img_len, 1),
+            command=self.controller.slider_event
         )
         self.slider.grid(row=1, column=0, columnspan=3, padx=15, pady=(10, 10), sticky="ew")
         self.slider.set(0)
@@ -115,22 +170,27 @@ class SpectralImgFrame(customtkinter.CTkFrame):
 
         self.increment_button = customtkinter.CTkButton(self, text='next', command=self.controller.increment_slider, width=100)
         self.increment_button.grid(row=2, column=2, padx=10, pady=(10, 20), sticky="w")
+        
+        # 表示中のフレームの植生指数の統計量と、フライト全体の統計量の書き出し
+        self.stats_label = customtkinter.CTkLabel(self, text="", justify="left", anchor="w")
+        self.stats_label.grid(row=3, column=0, columnspan=2, padx=10, pady=(0, 10), sticky="w")
+        self.export_stats_button = customtkinter.CTkButton(self, text='統計を保存', width=100,
+                                                           command=self.controller.export_stats_callback)
+        self.export_stats_button.grid(row=3, column=2, padx=10, pady=(0, 10), sticky="w")
     
+    def show_frame_stats(self, text):
+        """フレームの統計量（または書き出しの進捗）を表示"""
+        self.stats_label.configure(text=text)
     
-    def display_spectral(self, datacube_list, display_band, slider_value):
-        """指定されたバンドのスペクトル画像を表示"""
-        datacube = datacube_list[slider_value]
-        display_image = datacube if display_band == 5 else datacube[:, :, display_band - 1]
-        
-        if MultispectralImgModel.is_refconvert == 0:    # 反射率変換前
-            img = Image.fromarray(np.uint8(display_image))
-        else:                                           # 反射率変換後
-            img = (display_image - np.min(display_image)) / (np.max(display_image) - np.min(display_image))
-            img = (img * 255).astype(np.uint8)
-            img = Image.fromarray(img)
-        
-        # 画像を表示
-        imgtk = customtkinter.CTkImage(light_image=img, dark_image=img, size=(512, 512))
+    def update_slider_range(self, img_len):
+        """フレームの追加に合わせてスライダーの範囲を広げる（ウィジェットは作り直さない）"""
+        self.img_len = img_len - 1
+        self.slider.configure(to=max(self.img_len, 1), number_of_steps=max(self.img_len, 1))
+    
+    def display_spectral(self, img):
+        """指定されたバンドのスペクトル画像を表示（画像はモデルまたは先読みで作成済み）
+        表示領域に合わせて縦横比を保ったまま拡大・縮小する"""
+        imgtk = customtkinter.CTkImage(light_image=img, dark_image=img, size=fit_size(img.size))
         self.image_label.configure(image=imgtk, text="")
         self.image_label.image = imgtk
 
@@ -139,22 +199,79 @@ class VegIndexFrame(customtkinter.CTkFrame):
     def __init__(self, window=None, width=None, height=None):
         """植生指数表示用フレームの初期化"""
         super().__init__(window, width=width, height=height)
+        self.controller = window.controller
         self.canvas = None
-        self.image_label = customtkinter.CTkLabel(self, width=512, height=512, text="植生指数",
+        self.photo = None           # カラーマップ画像（常設、内容のみ貼り替え）
+        self.colorbar_photo = None  # カラーバー画像（植生指数や範囲の変更時のみ貼り替え）
+        self.colorbar_label = None
+        self.metrics_label = None   # 計測表示（有効時のみ）
+        self.image_label = customtkinter.CTkLabel(self, width=DISPLAY_SIZE, height=DISPLAY_SIZE, text="植生指数",
                                                   fg_color="transparent", font=window.fonts)
         self.image_label.grid()
+        # 植生・土壌の分割（マスクの重ね表示と表示中のフレームの被覆率・株の数）
+        self.switch_mask = customtkinter.CTkSwitch(self, text="植生マスク", command=self.controller.segmentation_event)
+        self.switch_mask.grid(row=3, column=0, padx=10, pady=(10, 0), sticky="w")
+        self.canopy_label = customtkinter.CTkLabel(self, text="", justify="left", anchor="w")
+        self.canopy_label.grid(row=4, column=0, padx=10, pady=(0, 5), sticky="w")
+        # 別のフライト（比較フォルダ）との植生指数の差・比の表示
+        compare_frame = customtkinter.CTkFrame(self, fg_color="transparent")
+        compare_frame.grid(row=5, column=0, padx=10, pady=(0, 5), sticky="w")
+        customtkinter.CTkButton(compare_frame, text="比較フォルダ", width=100,
+                                command=self.controller.compare_dir_callback).grid(row=0, column=0, sticky="w")
+        self.option_compare = customtkinter.CTkOptionMenu(compare_frame, values=list(COMPARE_MODES), width=110,
+                                                          command=self.controller.compare_mode_event)
+        self.option_compare.grid(row=0, column=1, padx=(10, 0), sticky="w")
+        self.compare_label = customtkinter.CTkLabel(self, text="比較: なし", justify="left", anchor="w")
+        self.compare_label.grid(row=6, column=0, padx=10, pady=(0, 5), sticky="w")
 
-    def display_veg_index(self, fig):
-        """植生指数のカラーマップを表示"""
-        # 既存のラベルやキャンバスを削除して再描画
-        if self.image_label:
+    def display_veg_index(self, img, colorbar=None):
+        """植生指数のカラーマップを表示
+        初回のみウィジェットを作成し、以降は既存の画像に貼り付けるだけで更新する"""
+        if self.photo is None or (self.photo.width(), self.photo.height()) != img.size:
             self.image_label.destroy()
-        if self.canvas:
-            self.canvas.get_tk_widget().destroy()
+            self.photo = ImageTk.PhotoImage(img)
+            self.image_label = self.create_image_label(self.photo, row=0, pady=(10, 0))
+        else:
+            self.photo.paste(img)
         
-        self.canvas = FigureCanvasTkAgg(fig, master=self)
-        self.canvas.draw()
-        self.canvas.get_tk_widget().grid()
+        if colorbar is not None:
+            if self.colorbar_photo is None or (self.colorbar_photo.width(), self.colorbar_photo.height()) != colorbar.size:
+                if self.colorbar_label is not None:
+                    self.colorbar_label.destroy()
+                self.colorbar_photo = ImageTk.PhotoImage(colorbar)
+                self.colorbar_label = self.create_image_label(self.colorbar_photo, row=1, pady=(10, 0))
+            else:
+                self.colorbar_photo.paste(colorbar)
+    
+    def show_compare(self, text):
+        """比較するフォルダと対応付けたフレーム数（または読み込みの進捗）を表示"""
+        self.compare_label.configure(text=text)
+    
+    def show_canopy(self, text):
+        """植生マスクの被覆率・株の数（または計算の進捗）を表示"""
+        self.canopy_label.configure(text=text)
+    
+    def show_metrics(self, text):
+        """カラーバーの下に処理時間とカウンタを表示"""
+        if self.metrics_label is None:
+            self.metrics_label = customtkinter.CTkLabel(self, text="", justify="left", anchor="w",
+                                                        font=("Consolas", 11))
+            self.metrics_label.grid(row=2, column=0, padx=9, pady=(5, 0), sticky="w")
+        self.metrics_label.configure(text=text)
+    
+    def hide_metrics(self):
+        """計測表示を消す"""
+        if self.metrics_label is not None:
+            self.metrics_label.destroy()
+            self.metrics_label = None
+    
+    def create_image_label(self, photo, row, pady):
+        """画像表示用のラベルを作成（背景はフレームの色に合わせる）"""
+        label = tk.Label(self, image=photo, borderwidth=0, highlightthickness=0,
+                         bg=self._apply_appearance_mode(self.cget("fg_color")))
+        label.grid(row=row, column=0, padx=9, pady=pady)
+        label.image = photo  # 参照を保持
+        return label
 
 
 
@@ -179,7 +296,7 @@ class PanelWindowView(customtkinter.CTkToplevel):
         self.text_label = self.create_label("パネル部分をドラッグして選択してください", row=2, text_color="orangered")
 
         # Canvas準備
-        self.canvas_panel = tk.Canvas(self, width=512, height=512)
+        self.canvas_panel = tk.Canvas(self, width=DISPLAY_SIZE, height=DISPLAY_SIZE)
         self.canvas_panel.create_rectangle(0, 0, 513, 513, fill="")
         self.canvas_panel.create_text(250, 250, text="標準化パネル画像", font=self.fonts)
         self.canvas_panel.grid(row=3, column=0, padx=(150,0), pady=(40, 0), sticky='nsew')
@@ -195,6 +312,8 @@ class PanelWindowView(customtkinter.CTkToplevel):
             
         # 反射率変換実行
         customtkinter.CTkButton(self, text='パネル範囲決定', command=self.panel_controller.confirm_rect).place(x=280, y=680)
+        # フライト中の複数パネルを登録（現在のフレームに対応付けて時間補間）
+        customtkinter.CTkButton(self, text='このフレームに追加', command=self.panel_controller.add_sample).place(x=440, y=680)
         
 
     def display_canvas_panel(self, panel_img):
@@ -209,8 +328,15 @@ class PanelWindowView(customtkinter.CTkToplevel):
         self.canvas_panel.bind("<ButtonRelease-1>", self.panel_controller.release_action)
         
         
-    def update_brightness_label(self, i, brightness):
-        self.label_brightness[i].configure(text=f"{self.bands[i]}: {brightness}")
+    def update_brightness_label(self, i, brightness, median=None, std=None, saturated=None):
+        text = f"{self.bands[i]}: {brightness}"
+        if median is not None:
+            text += f"  中央値: {median:g}"
+        if std is not None:
+            text += f"  標準偏差: {std:.2f}"
+        if saturated:
+            text += f"  飽和画素: {saturated}"
+        self.label_brightness[i].configure(text=text)
         
 
     def create_button(self, text, row, command, padx=10, pady=(30, 0), column=None, columnspan=None, color=None, rowspan=None, sticky="w"):
@@ -223,3 +349,43 @@ class PanelWindowView(customtkinter.CTkToplevel):
         label.grid(row=row, padx=10, pady=pady, sticky=sticky)
         return label
 
+
+class MosaicWindowView(customtkinter.CTkToplevel):
+    def __init__(self, master, controller):
+        """フライト全体のモザイク表示ウィンドウ"""
+        super().__init__()
+        self.mosaic_controller = controller
+        self.title('モザイク（フライト全体）')
+        self.geometry("560x620")
+        self.photo = None   # モザイク画像（大きさが変わった場合のみ作り直す）
+        self.protocol("WM_DELETE_WINDOW", self.mosaic_controller.close)
+        
+        self.status_label = customtkinter.CTkLabel(self, text="モザイク: 作成中", anchor="w")
+        self.status_label.grid(row=0, column=0, padx=10, pady=(10, 0), sticky="w")
+        customtkinter.CTkLabel(self, text="クリックしたフレームを表示します").grid(row=1, column=0, padx=10, sticky="w")
+        self.canvas_mosaic = tk.Canvas(self, width=DISPLAY_SIZE, height=DISPLAY_SIZE, bg="#2b2b2b",
+                                       highlightthickness=0)
+        self.canvas_mosaic.grid(row=2, column=0, padx=20, pady=(10, 0))
+        self.canvas_mosaic.bind("<Button-1>", self.mosaic_controller.overview_click)
+    
+    def display_mosaic(self, img):
+        """モザイク画像を表示（同じ大きさなら既存の画像に貼り付けるだけ）"""
+        if self.photo is None or (self.photo.width(), self.photo.height()) != img.size:
+            self.photo = ImageTk.PhotoImage(img)
+            self.canvas_mosaic.delete("mosaic")
+            self.canvas_mosaic.create_image(0, 0, image=self.photo, anchor=tk.NW, tag="mosaic")
+            self.canvas_mosaic.tag_lower("mosaic")
+        else:
+            self.photo.paste(img)
+    
+    def show_frame_outline(self, rect):
+        """表示中のフレームの範囲を枠で示す（Noneなら消す）"""
+        if rect is None:
+            self.canvas_mosaic.delete("frame_outline")
+        elif not self.canvas_mosaic.find_withtag("frame_outline"):
+            self.canvas_mosaic.create_rectangle(*rect, outline="white", width=2, tag="frame_outline")
+        else:
+            self.canvas_mosaic.coords("frame_outline", *rect)
+    
+    def show_status(self, text):
+        self.status_label.configure(text=text)